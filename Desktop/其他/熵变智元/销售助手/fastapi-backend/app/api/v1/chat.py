@@ -6,6 +6,7 @@
 from datetime import datetime, timedelta
 from typing import List, Optional, Dict, Any, Union
 from fastapi import APIRouter, Depends, HTTPException, status, Query, Path, BackgroundTasks, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update, delete, func, and_, or_, desc
 from sqlalchemy.orm import selectinload, joinedload
@@ -19,13 +20,17 @@ from app.core.redis import redis_client
 from app.models.user import User
 from app.models.device import WeChatAccount, DeviceStatus
 from app.models.chat import (
-    Contact, ChatSession, ChatMessage, MessageTemplate, ConversationSummary,
+    Contact, ChatSession, ChatMessage, MessageTemplate, ConversationSummary, FAQEntry,
     ChatType, MessageType, MessageDirection, MessageStatus, AIProcessStatus
 )
 from app.api.deps import get_current_user, get_current_active_user
 from app.services.gewe_service import GeWeService
 from app.services.ai_service import AIService
 from app.services.websocket_manager import WebSocketManager
+from app.services.resolution_cache import resolution_cache
+from app.services.history_cache import session_history_cache, history_entry
+from app.services.message_archiver import message_archiver
+from app.services.faq_index import faq_service
 from app.utils.permissions import require_permission
 
 logger = logging.getLogger(__name__)
@@ -208,6 +213,29 @@ class CreateTemplateRequest(BaseModel):
     is_shared: bool = Field(False, description="是否共享")
 
 
+class FAQEntryResponse(BaseModel):
+    """FAQ条目响应"""
+    id: str
+    question: str
+    similar_questions: List[str]
+    answer: str
+    category: Optional[str]
+    hit_count: int
+    last_hit_at: Optional[datetime]
+    is_active: bool
+    
+    class Config:
+        from_attributes = True
+
+
+class CreateFAQRequest(BaseModel):
+    """创建FAQ请求"""
+    question: str = Field(..., max_length=500, description="标准问题")
+    similar_questions: List[str] = Field(default=[], description="相似问法")
+    answer: str = Field(..., description="答案")
+    category: Optional[str] = Field(None, max_length=50, description="分类")
+
+
 # ==================== API路由 ====================
 
 @router.get("/stats", response_model=ChatStatsResponse)
@@ -463,6 +491,7 @@ async def update_chat_session(
         session.updated_at = datetime.utcnow()
         await db.commit()
         await db.refresh(session)
+        await resolution_cache.invalidate_session(session.id)
         
         logger.info(f"会话配置更新成功: {session_id}")
         return ChatSessionResponse.from_orm(session)
@@ -545,6 +574,13 @@ async def get_session_messages(
                 detail="会话不存在"
             )
         
+        # 无筛选的第一页优先读取会话消息缓存
+        cacheable = page == 1 and not message_type and not direction
+        if cacheable:
+            entries = await session_history_cache.get_recent(session.id, size)
+            if entries is not None:
+                return [ChatMessageResponse(**entry) for entry in reversed(entries)]
+        
         # 构建消息查询
         query = select(ChatMessage).where(ChatMessage.session_id == session_id)
         
@@ -557,11 +593,21 @@ async def get_session_messages(
         
         # 分页（按时间倒序，最新消息在前）
         offset = (page - 1) * size
-        query = query.offset(offset).limit(size).order_by(desc(ChatMessage.created_at))
+        if cacheable and size <= session_history_cache.size:
+            # 多取到缓存容量，顺带回填会话消息缓存
+            query = query.limit(session_history_cache.size).order_by(desc(ChatMessage.created_at))
+        else:
+            query = query.offset(offset).limit(size).order_by(desc(ChatMessage.created_at))
         
         result = await db.execute(query)
         messages = result.scalars().all()
         
+        if cacheable and size <= session_history_cache.size:
+            await session_history_cache.seed(
+                session.id, [history_entry(msg) for msg in reversed(messages)]
+            )
+            messages = messages[:size]
+        
         return [ChatMessageResponse.from_orm(msg) for msg in messages]
         
     except HTTPException:
@@ -574,6 +620,34 @@ async def get_session_messages(
         )
 
 
+@router.get("/sessions/{session_id}/messages/archived")
+async def get_archived_session_messages(
+    session_id: str = Path(..., description="会话ID"),
+    start: Optional[datetime] = Query(None, description="开始时间"),
+    end: Optional[datetime] = Query(None, description="结束时间"),
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """流式读取会话已归档的历史消息（NDJSON，按时间正序）"""
+    session_result = await db.execute(
+        select(ChatSession.id)
+        .where(
+            ChatSession.id == session_id,
+            ChatSession.organization_id == current_user.organization_id
+        )
+    )
+    if session_result.scalar_one_or_none() is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="会话不存在"
+        )
+    
+    return StreamingResponse(
+        message_archiver.iter_archived_messages(session_id, start, end),
+        media_type="application/x-ndjson"
+    )
+
+
 @router.post("/send", response_model=ChatMessageResponse)
 async def send_message(
     request: SendMessageRequest,
@@ -643,11 +717,13 @@ async def send_message(
         db.add(message)
         await db.commit()
         await db.refresh(message)
+        await session_history_cache.append(session.id, history_entry(message))
         
         # 异步发送消息到GeWe
         background_tasks.add_task(
             send_message_to_gewe,
             message_id=str(message.id),
+            session_id=str(session.id),
             app_id=session.wechat_account.gewe_app_id,
             to_wxid=session.contact.wxid,
             content=content,
@@ -762,6 +838,7 @@ async def update_contact(
         contact.updated_at = datetime.utcnow()
         await db.commit()
         await db.refresh(contact)
+        await resolution_cache.invalidate_contact(contact.id)
         
         logger.info(f"联系人信息更新成功: {contact_id}")
         return ContactResponse.from_orm(contact)
@@ -864,6 +941,140 @@ async def create_message_template(
         )
 
 
+@router.get("/faq", response_model=List[FAQEntryResponse])
+async def get_faq_entries(
+    page: int = Query(1, ge=1, description="页码"),
+    size: int = Query(20, ge=1, le=100, description="每页数量"),
+    category: Optional[str] = Query(None, description="分类筛选"),
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """获取FAQ列表"""
+    try:
+        query = select(FAQEntry).where(
+            FAQEntry.organization_id == current_user.organization_id,
+            FAQEntry.is_active == True
+        )
+        
+        if category:
+            query = query.where(FAQEntry.category == category)
+        
+        offset = (page - 1) * size
+        query = query.offset(offset).limit(size).order_by(
+            desc(FAQEntry.hit_count),
+            desc(FAQEntry.created_at)
+        )
+        
+        result = await db.execute(query)
+        entries = result.scalars().all()
+        
+        return [
+            FAQEntryResponse(
+                id=str(entry.id),
+                question=entry.question,
+                similar_questions=entry.similar_questions or [],
+                answer=entry.answer,
+                category=entry.category,
+                hit_count=entry.hit_count or 0,
+                last_hit_at=entry.last_hit_at,
+                is_active=entry.is_active
+            )
+            for entry in entries
+        ]
+        
+    except Exception as e:
+        logger.error(f"获取FAQ列表失败: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="获取FAQ列表失败"
+        )
+
+
+@router.post("/faq", response_model=FAQEntryResponse)
+async def create_faq_entry(
+    faq_data: CreateFAQRequest,
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """创建FAQ条目"""
+    try:
+        entry = FAQEntry(
+            organization_id=current_user.organization_id,
+            user_id=current_user.id,
+            question=faq_data.question,
+            similar_questions=faq_data.similar_questions,
+            answer=faq_data.answer,
+            category=faq_data.category
+        )
+        
+        db.add(entry)
+        await db.commit()
+        await db.refresh(entry)
+        
+        # 通知所有进程重建本组织的FAQ索引
+        await faq_service.invalidate(current_user.organization_id)
+        
+        logger.info(f"FAQ条目创建成功: {entry.id}")
+        return FAQEntryResponse(
+            id=str(entry.id),
+            question=entry.question,
+            similar_questions=entry.similar_questions or [],
+            answer=entry.answer,
+            category=entry.category,
+            hit_count=entry.hit_count or 0,
+            last_hit_at=entry.last_hit_at,
+            is_active=entry.is_active
+        )
+        
+    except Exception as e:
+        logger.error(f"创建FAQ条目失败: {str(e)}")
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="创建FAQ失败"
+        )
+
+
+@router.delete("/faq/{faq_id}")
+async def delete_faq_entry(
+    faq_id: str = Path(..., description="FAQ ID"),
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """停用FAQ条目"""
+    try:
+        result = await db.execute(
+            update(FAQEntry)
+            .where(
+                FAQEntry.id == faq_id,
+                FAQEntry.organization_id == current_user.organization_id
+            )
+            .values(is_active=False)
+        )
+        
+        if result.rowcount == 0:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="FAQ不存在"
+            )
+        
+        await db.commit()
+        await faq_service.invalidate(current_user.organization_id)
+        
+        logger.info(f"FAQ条目已停用: {faq_id}")
+        return {"message": "FAQ已删除"}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"删除FAQ条目失败: {str(e)}")
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="删除FAQ失败"
+        )
+
+
 # ==================== WebSocket处理 ====================
 
 @router.websocket("/ws/{session_id}")
@@ -919,6 +1130,7 @@ async def websocket_chat_endpoint(
 
 async def send_message_to_gewe(
     message_id: str,
+    session_id: str,
     app_id: str,
     to_wxid: str,
     content: str,
@@ -952,6 +1164,7 @@ async def send_message_to_gewe(
             )
             await db.commit()
         
+        await session_history_cache.update(session_id, message_id, {"status": MessageStatus.SENT.value})
         logger.info(f"消息发送成功: {message_id}")
         
     except Exception as e:
@@ -968,4 +1181,6 @@ async def send_message_to_gewe(
                 )
             )
             await db.commit()
+        
+        await session_history_cache.update(session_id, message_id, {"status": MessageStatus.FAILED.value})
 
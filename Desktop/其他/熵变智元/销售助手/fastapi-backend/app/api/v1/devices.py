@@ -23,6 +23,7 @@ from app.models.device import (
 from app.api.deps import get_current_user, get_current_active_user
 from app.services.gewe_service import GeWeService
 from app.services.device_monitor import DeviceMonitor
+from app.services.resolution_cache import resolution_cache
 from app.utils.permissions import require_permission
 
 logger = logging.getLogger(__name__)
@@ -468,6 +469,7 @@ async def update_wechat_account(
         
         await db.commit()
         await db.refresh(account)
+        await resolution_cache.invalidate_account(account.id)
         
         logger.info(f"微信账号更新成功: {account.id}")
         
@@ -744,6 +746,7 @@ async def delete_wechat_account(
         db.add(log_entry)
         
         await db.commit()
+        await resolution_cache.invalidate_account(account.id)
         
         logger.info(f"微信账号删除成功: {account.id}")
         
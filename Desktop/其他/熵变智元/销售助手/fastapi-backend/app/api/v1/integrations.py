@@ -7,6 +7,7 @@ import logging
 from datetime import datetime
 from typing import Dict, Any, List, Optional
 from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer
 from pydantic import BaseModel, Field
 
@@ -15,6 +16,25 @@ from app.models.user import User
 from app.services.gewe_service import gewe_service, WorkflowConfig
 from app.services.fastgpt_service import fastgpt_service, ChatContext
 from app.services.notification_service import notification_service
+from app.services.message_stream import webhook_stream, ai_task_stream
+from app.services.message_dedup import message_deduplicator
+from app.services.message_batcher import message_batcher
+from app.services.resolution_cache import resolution_cache
+from app.services.history_cache import session_history_cache
+from app.services.message_archiver import message_archiver
+from app.services.message_coalescer import message_coalescer
+from app.services.chat_processor import chat_processor
+from app.services.session_lease import session_lease
+from app.services.ai_priority import ai_priority_classifier
+from app.services.load_shedder import load_shedder
+from app.services.http_clients import http_clients
+from app.services.circuit_breaker import circuit_breakers
+from app.services.singleflight import singleflight
+from app.services.reply_cache import ai_reply_cache
+from app.services.faq_index import faq_service
+from app.services.token_estimator import token_estimator
+from app.services.context_builder import context_builder
+from app.services.keyword_engine import keyword_engine
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -66,6 +86,8 @@ class WorkflowRegistrationRequest(BaseModel):
     api_key: str
     model_config: Dict[str, Any]
     variables: Optional[Dict[str, Any]] = None
+    reply_cache: bool = False
+    reply_cache_context_free: bool = False
 
 
 class WebhookSetupRequest(BaseModel):
@@ -75,6 +97,12 @@ class WebhookSetupRequest(BaseModel):
     events: List[str] = Field(default_factory=list)
 
 
+class KeywordDictionaryRequest(BaseModel):
+    """关键词词典更新请求"""
+    # 分类（intent/sentiment/keywords/safety）-> 标签 -> 关键词列表
+    dictionaries: Dict[str, Dict[str, List[str]]]
+
+
 # ==================== 集成概览 ====================
 
 @router.get("/overview", response_model=IntegrationOverviewResponse)
@@ -229,19 +257,75 @@ async def gewe_webhook_callback(
 ):
     """处理GeWe Webhook回调"""
     try:
-        # 异步处理webhook消息
-        background_tasks.add_task(
-            gewe_service.process_webhook_message,
-            message_data
-        )
+        # 消息流积压超过水位线时拒收，GeWe按 Retry-After 稍后重试
+        retry_after = await load_shedder.webhook_retry_after()
+        if retry_after:
+            return JSONResponse(
+                status_code=503,
+                content={"success": False, "error": "服务繁忙，请稍后重试"},
+                headers={"Retry-After": str(retry_after)}
+            )
+        
+        # 写入消息流后立即返回，由各worker的消费组异步处理
+        entry_id = await webhook_stream.publish(message_data)
+        
+        if not entry_id:
+            # 消息流不可用时退回进程内后台任务，与消息流消费者走同一处理逻辑（入库并投递AI任务）
+            background_tasks.add_task(
+                chat_processor.handle_webhook,
+                message_data
+            )
         
-        return {"success": True, "message": "消息已接收"}
+        return {"success": True, "message": "消息已接收", "entry_id": entry_id}
     
     except Exception as e:
         logger.error(f"处理GeWe Webhook失败: {str(e)}")
         return {"success": False, "error": str(e)}
 
 
+@router.get("/gewe/webhook/stream")
+async def get_webhook_stream_metrics(
+    current_user: User = Depends(get_current_user)
+):
+    """获取消息流积压指标"""
+    try:
+        return {
+            "success": True,
+            "data": {
+                "webhook": {
+                    **await webhook_stream.get_lag_metrics(),
+                    "local": webhook_stream.get_stats()
+                },
+                "ai_tasks": {
+                    **await ai_task_stream.get_lag_metrics(),
+                    "local": ai_task_stream.get_stats()
+                },
+                "dedup": message_deduplicator.get_stats(),
+                "batcher": message_batcher.get_stats(),
+                "resolution_cache": resolution_cache.get_stats(),
+                "history_cache": session_history_cache.get_stats(),
+                "coalescer": message_coalescer.get_stats(),
+                "ai_lanes": chat_processor.ai_lanes.get_stats(),
+                "session_lease": session_lease.get_stats(),
+                "recovery": chat_processor.recovery_stats,
+                "ai_service": chat_processor.ai_service.get_stats(),
+                "faq": faq_service.get_stats(),
+                "token_estimator": token_estimator.get_stats(),
+                "context_builder": context_builder.get_stats(),
+                "keyword_engine": keyword_engine.get_stats(),
+                "ai_priority": ai_priority_classifier.get_stats(),
+                "backpressure": load_shedder.get_stats(),
+                "http_clients": http_clients.get_stats(),
+                "circuit_breakers": circuit_breakers.get_stats(),
+                "singleflight": singleflight.get_stats(),
+                "archiver": message_archiver.get_stats()
+            }
+        }
+    except Exception as e:
+        logger.error(f"获取消息流指标失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取指标失败: {str(e)}")
+
+
 # ==================== FastGPT集成管理 ====================
 
 @router.get("/fastgpt/health")
@@ -330,7 +414,9 @@ async def register_workflow(
             api_endpoint=request.api_endpoint,
             api_key=request.api_key,
             model_config=request.model_config,
-            variables=request.variables
+            variables=request.variables,
+            reply_cache=request.reply_cache,
+            reply_cache_context_free=request.reply_cache_context_free
         )
         
         # 注册工作流
@@ -386,6 +472,8 @@ async def delete_workflow(
     try:
         if workflow_id in fastgpt_service.workflow_configs:
             del fastgpt_service.workflow_configs[workflow_id]
+            ai_reply_cache.configure_workflow(workflow_id, False)
+            await ai_reply_cache.purge(workflow_id)
             return {
                 "success": True,
                 "message": "工作流删除成功"
@@ -398,6 +486,63 @@ async def delete_workflow(
         raise HTTPException(status_code=500, detail=f"删除失败: {str(e)}")
 
 
+@router.delete("/ai/reply-cache")
+async def purge_reply_cache(
+    workflow_id: Optional[str] = None,
+    current_user: User = Depends(require_permissions(["admin"]))
+):
+    """清除AI回复缓存（指定工作流或全部）"""
+    try:
+        deleted = await ai_reply_cache.purge(workflow_id)
+        return {
+            "success": True,
+            "message": "AI回复缓存已清除",
+            "deleted": deleted
+        }
+    
+    except Exception as e:
+        logger.error(f"清除AI回复缓存失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"清除失败: {str(e)}")
+
+
+@router.get("/ai/keywords")
+async def get_keyword_dictionary(
+    current_user: User = Depends(require_permissions(["admin"]))
+):
+    """获取本组织的自定义关键词词典"""
+    try:
+        dictionary = await keyword_engine.get_dictionary(current_user.organization_id)
+        return {
+            "success": True,
+            "data": dictionary
+        }
+    
+    except Exception as e:
+        logger.error(f"获取关键词词典失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取失败: {str(e)}")
+
+
+@router.put("/ai/keywords")
+async def update_keyword_dictionary(
+    request: KeywordDictionaryRequest,
+    current_user: User = Depends(require_permissions(["admin"]))
+):
+    """更新本组织的自定义关键词词典（在默认词典基础上扩展）"""
+    try:
+        await keyword_engine.save_dictionary(current_user.organization_id, request.dictionaries)
+        return {
+            "success": True,
+            "message": "关键词词典已更新",
+            "keywords": sum(
+                len(words) for groups in request.dictionaries.values() for words in groups.values()
+            )
+        }
+    
+    except Exception as e:
+        logger.error(f"更新关键词词典失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"更新失败: {str(e)}")
+
+
 # ==================== 服务管理操作 ====================
 
 @router.post("/services/restart")
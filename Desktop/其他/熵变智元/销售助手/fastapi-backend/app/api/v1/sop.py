@@ -26,6 +26,7 @@ from app.models.sop import (
 from app.api.deps import get_current_user, get_current_active_user
 from app.services.sop_executor import SOPExecutor
 from app.services.websocket_manager import websocket_manager
+from app.services.sop_trigger_index import sop_trigger_index
 from app.utils.permissions import require_permission
 
 logger = logging.getLogger(__name__)
@@ -495,6 +496,8 @@ async def create_sop_template(
         await db.commit()
         await db.refresh(template)
         
+        await sop_trigger_index.publish_template(template)
+        
         logger.info(f"SOP模板创建成功: {template.id}")
         
         return SOPTemplateResponse.from_orm(template)
@@ -599,6 +602,9 @@ async def update_sop_template(
         await db.commit()
         await db.refresh(template)
         
+        # 触发关键词或状态可能变化，更新所属组织的触发索引
+        await sop_trigger_index.publish_template(template)
+        
         logger.info(f"SOP模板更新成功: {template.id}")
         
         return SOPTemplateResponse.from_orm(template)
@@ -652,6 +658,9 @@ async def activate_sop_template(
         template.updated_at = datetime.utcnow()
         
         await db.commit()
+        await db.refresh(template)
+        
+        await sop_trigger_index.publish_template(template)
         
         return {"message": "模板已激活", "template_id": template_id}
         
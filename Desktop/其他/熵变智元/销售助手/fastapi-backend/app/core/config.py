@@ -99,6 +99,110 @@ class Settings(BaseSettings):
     AI_REQUEST_TIMEOUT: int = Field(default=60, env="AI_REQUEST_TIMEOUT")
     AI_MAX_RETRIES: int = Field(default=2, env="AI_MAX_RETRIES")
     
+    # 出站HTTP连接池（GeWe、FastGPT和AI服务共享，长连接复用）
+    HTTP_CLIENT_HTTP2: bool = Field(default=True, env="HTTP_CLIENT_HTTP2")  # 需要安装h2
+    HTTP_CLIENT_MAX_CONNECTIONS: int = Field(default=200, env="HTTP_CLIENT_MAX_CONNECTIONS")  # 每个上游
+    HTTP_CLIENT_MAX_KEEPALIVE: int = Field(default=50, env="HTTP_CLIENT_MAX_KEEPALIVE")  # 每个上游保留的空闲连接
+    HTTP_CLIENT_KEEPALIVE_EXPIRY: float = Field(default=60.0, env="HTTP_CLIENT_KEEPALIVE_EXPIRY")  # 空闲连接保留时间（秒）
+    
+    # AI上游自适应并发（AIMD：健康时加性增长，超时/429/延迟劣化时乘性下降）
+    AI_CONCURRENCY_INITIAL: int = Field(default=10, env="AI_CONCURRENCY_INITIAL")
+    AI_CONCURRENCY_MIN: int = Field(default=2, env="AI_CONCURRENCY_MIN")
+    AI_CONCURRENCY_MAX: int = Field(default=200, env="AI_CONCURRENCY_MAX")
+    AI_CONCURRENCY_DECREASE_FACTOR: float = Field(default=0.7, env="AI_CONCURRENCY_DECREASE_FACTOR")
+    AI_CONCURRENCY_LATENCY_TOLERANCE: float = Field(default=2.0, env="AI_CONCURRENCY_LATENCY_TOLERANCE")  # p95超过基线的倍数视为劣化
+    
+    # 流式回复（上游SSE增量推送给会话的WebSocket订阅者）
+    AI_STREAM_ENABLED: bool = Field(default=True, env="AI_STREAM_ENABLED")
+    AI_STREAM_FLUSH_MS: int = Field(default=100, env="AI_STREAM_FLUSH_MS")  # 增量合并推送间隔（毫秒）
+    
+    # 对冲请求（非流式AI请求超过近期延迟分位数仍未返回时再发一个，先返回者胜出）
+    HEDGING_ENABLED: bool = Field(default=False, env="HEDGING_ENABLED")
+    HEDGING_QUANTILE: float = Field(default=0.95, env="HEDGING_QUANTILE")  # 对冲阈值取近期延迟的分位数
+    HEDGING_MIN_DELAY: float = Field(default=1.0, env="HEDGING_MIN_DELAY")  # 秒
+    HEDGING_MAX_DELAY: float = Field(default=20.0, env="HEDGING_MAX_DELAY")  # 秒
+    HEDGING_MIN_SAMPLES: int = Field(default=50, env="HEDGING_MIN_SAMPLES")  # 样本不足时不对冲
+    HEDGING_BUDGET_RATIO: float = Field(default=0.05, env="HEDGING_BUDGET_RATIO")  # 额外请求占比上限
+    HEDGING_BUDGET_BURST: int = Field(default=10, env="HEDGING_BUDGET_BURST")  # 预算令牌桶容量
+    
+    # 熔断器（按 上游 + 接口 统计错误率和慢调用比例，熔断期间请求立即失败）
+    CIRCUIT_BREAKER_ENABLED: bool = Field(default=True, env="CIRCUIT_BREAKER_ENABLED")
+    CIRCUIT_BREAKER_WINDOW: float = Field(default=60.0, env="CIRCUIT_BREAKER_WINDOW")  # 统计窗口（秒）
+    CIRCUIT_BREAKER_MIN_REQUESTS: int = Field(default=20, env="CIRCUIT_BREAKER_MIN_REQUESTS")  # 窗口内请求数不足时不熔断
+    CIRCUIT_BREAKER_FAILURE_RATE: float = Field(default=0.5, env="CIRCUIT_BREAKER_FAILURE_RATE")  # 超时、网络错误、5xx和429
+    CIRCUIT_BREAKER_SLOW_RATE: float = Field(default=0.8, env="CIRCUIT_BREAKER_SLOW_RATE")
+    CIRCUIT_BREAKER_SLOW_CALL_SECONDS: dict = Field(
+        default={
+            "gewe": 10.0,
+            "fastgpt": 45.0,
+            "ai_service": 45.0,
+            "default": 30.0
+        },
+        env="CIRCUIT_BREAKER_SLOW_CALL_SECONDS"
+    )  # 上游 -> 慢调用阈值（秒）
+    CIRCUIT_BREAKER_OPEN_SECONDS: float = Field(default=30.0, env="CIRCUIT_BREAKER_OPEN_SECONDS")  # 熔断后多久开始探测
+    CIRCUIT_BREAKER_HALF_OPEN_PROBES: int = Field(default=3, env="CIRCUIT_BREAKER_HALF_OPEN_PROBES")  # 半开状态放行的探测请求数
+    
+    # 并发请求合并（参数相同的读请求同时发起时只请求一次上游，其余共享结果）
+    SINGLEFLIGHT_ENABLED: bool = Field(default=True, env="SINGLEFLIGHT_ENABLED")
+    
+    # AI任务优先级（按意图、联系人标签、私聊/群聊加权，分数越高越先处理）
+    AI_PRIORITY_ENABLED: bool = Field(default=True, env="AI_PRIORITY_ENABLED")
+    AI_PRIORITY_INTENT_WEIGHTS: dict = Field(
+        default={
+            "purchase_intent": 30,
+            "complaint": 30,
+            "inquiry_price": 20,
+            "inquiry_product": 10,
+            "general": 0
+        },
+        env="AI_PRIORITY_INTENT_WEIGHTS"
+    )
+    AI_PRIORITY_TAG_WEIGHTS: dict = Field(
+        default={"VIP": 20, "重要客户": 20, "意向客户": 10},
+        env="AI_PRIORITY_TAG_WEIGHTS"
+    )
+    AI_PRIORITY_PRIVATE_WEIGHT: int = Field(default=10, env="AI_PRIORITY_PRIVATE_WEIGHT")
+    AI_PRIORITY_GROUP_WEIGHT: int = Field(default=-10, env="AI_PRIORITY_GROUP_WEIGHT")
+    AI_PRIORITY_HIGH_THRESHOLD: int = Field(default=30, env="AI_PRIORITY_HIGH_THRESHOLD")  # 不低于该分数为高优先级
+    AI_PRIORITY_LOW_THRESHOLD: int = Field(default=0, env="AI_PRIORITY_LOW_THRESHOLD")  # 低于该分数为低优先级
+    AI_PRIORITY_AGING_RATE: float = Field(default=1.0, env="AI_PRIORITY_AGING_RATE")  # 每等待1秒增加的分数，防止低优先级饿死
+    
+    # AI回复缓存（按工作流开启；无上下文的FAQ类工作流可设 context_free，键中不含会话上下文）
+    AI_REPLY_CACHE_ENABLED: bool = Field(default=True, env="AI_REPLY_CACHE_ENABLED")
+    AI_REPLY_CACHE_WORKFLOWS: dict = Field(default={}, env="AI_REPLY_CACHE_WORKFLOWS")  # 工作流ID -> {"context_free": bool}
+    AI_REPLY_CACHE_TTL: int = Field(default=3600, env="AI_REPLY_CACHE_TTL")  # 秒
+    AI_REPLY_CACHE_MAX_SIZE: int = Field(default=10000, env="AI_REPLY_CACHE_MAX_SIZE")  # 进程内条数上限
+    AI_REPLY_CACHE_MAX_INPUT_CHARS: int = Field(default=50, env="AI_REPLY_CACHE_MAX_INPUT_CHARS")  # 只缓存短问题
+    AI_REPLY_CACHE_CONTEXT_TURNS: int = Field(default=2, env="AI_REPLY_CACHE_CONTEXT_TURNS")  # 计入缓存键的最近对话条数
+    AI_REPLY_CACHE_PREFIX: str = Field(default="entropy_cache:ai_reply", env="AI_REPLY_CACHE_PREFIX")
+    AI_REPLY_CACHE_CHANNEL: str = Field(default="entropy_cache:ai_reply_purge", env="AI_REPLY_CACHE_CHANNEL")
+    
+    # 本地FAQ检索（字符n-gram TF-IDF，命中时不调用AI）
+    FAQ_ENABLED: bool = Field(default=True, env="FAQ_ENABLED")
+    FAQ_MATCH_THRESHOLD: float = Field(default=0.85, env="FAQ_MATCH_THRESHOLD")  # 余弦相似度阈值
+    FAQ_MATCH_MARGIN: float = Field(default=0.05, env="FAQ_MATCH_MARGIN")  # 与次优条目的最小差距
+    FAQ_MAX_INPUT_CHARS: int = Field(default=100, env="FAQ_MAX_INPUT_CHARS")  # 只检索短问题
+    FAQ_NGRAM_MIN: int = Field(default=1, env="FAQ_NGRAM_MIN")
+    FAQ_NGRAM_MAX: int = Field(default=3, env="FAQ_NGRAM_MAX")
+    FAQ_INDEX_CHECK_INTERVAL: float = Field(default=5.0, env="FAQ_INDEX_CHECK_INTERVAL")  # 检查语料版本的间隔（秒）
+    FAQ_INDEX_VERSION_PREFIX: str = Field(default="entropy_cache:faq_version", env="FAQ_INDEX_VERSION_PREFIX")
+    
+    # 关键词词典（意图、情感、话题和内容安全；组织自定义词条变更后按版本重建）
+    KEYWORD_DICT_CHECK_INTERVAL: float = Field(default=5.0, env="KEYWORD_DICT_CHECK_INTERVAL")  # 检查词典版本的间隔（秒）
+    KEYWORD_DICT_VERSION_PREFIX: str = Field(default="entropy_cache:keyword_dict_version", env="KEYWORD_DICT_VERSION_PREFIX")
+    
+    # SOP关键词触发索引（模板变更时通知其他进程同步）
+    SOP_TRIGGER_INDEX_CHANNEL: str = Field(default="entropy_cache:sop_trigger_index", env="SOP_TRIGGER_INDEX_CHANNEL")
+    
+    # Token估算（与计费分词器的切分规律对齐；CJK比例按所用模型的分词器调整）
+    TOKEN_ESTIMATE_CJK_RATIO: float = Field(default=1.2, env="TOKEN_ESTIMATE_CJK_RATIO")  # 每个汉字的token数
+    TOKEN_ESTIMATE_CHARS_PER_TOKEN: float = Field(default=4.0, env="TOKEN_ESTIMATE_CHARS_PER_TOKEN")  # 英文字母数/token
+    TOKEN_ESTIMATE_MESSAGE_OVERHEAD: int = Field(default=4, env="TOKEN_ESTIMATE_MESSAGE_OVERHEAD")  # 每条对话消息的固定开销
+    TOKEN_ESTIMATE_CACHE_SIZE: int = Field(default=20000, env="TOKEN_ESTIMATE_CACHE_SIZE")
+    TOKEN_ESTIMATE_CACHE_MIN_CHARS: int = Field(default=16, env="TOKEN_ESTIMATE_CACHE_MIN_CHARS")  # 更短的文本直接计算
+    TOKEN_ESTIMATE_CACHE_MAX_CHARS: int = Field(default=4000, env="TOKEN_ESTIMATE_CACHE_MAX_CHARS")  # 更长的文本不缓存
+    
     # AI成本配置
     AI_MODELS_PRICING: dict = Field(
         default={
@@ -131,6 +235,101 @@ class Settings(BaseSettings):
     TASK_QUEUE_PREFIX: str = Field(default="entropy_tasks", env="TASK_QUEUE_PREFIX")
     TASK_RESULT_EXPIRE: int = Field(default=3600, env="TASK_RESULT_EXPIRE")  # 1小时
     
+    # 消息流配置（Redis Streams，持久化的入站消息和AI任务队列）
+    WEBHOOK_STREAM_KEY: str = Field(default="entropy_stream:gewe_webhook", env="WEBHOOK_STREAM_KEY")
+    AI_TASK_STREAM_KEY: str = Field(default="entropy_stream:ai_tasks", env="AI_TASK_STREAM_KEY")
+    AI_TASK_STREAM_SHARDS: int = Field(default=16, env="AI_TASK_STREAM_SHARDS")  # AI任务流按会话分片数，同一会话固定写入一个分片，每个分片同一时刻只由一个worker消费
+    STREAM_SHARD_LEASE_MS: int = Field(default=15000, env="STREAM_SHARD_LEASE_MS")  # 分片所有权租约（毫秒），worker失联超过该时长后分片由其他worker接管
+    STREAM_CONSUMER_GROUP: str = Field(default="chat_ingest", env="STREAM_CONSUMER_GROUP")
+    STREAM_MAX_LEN: int = Field(default=100000, env="STREAM_MAX_LEN")  # 近似裁剪长度
+    STREAM_READ_COUNT: int = Field(default=50, env="STREAM_READ_COUNT")  # 单次读取条数
+    STREAM_BLOCK_MS: int = Field(default=5000, env="STREAM_BLOCK_MS")  # 阻塞读取超时（毫秒）
+    STREAM_RECLAIM_IDLE_MS: int = Field(default=60000, env="STREAM_RECLAIM_IDLE_MS")  # 超过该空闲时间的待确认消息会被认领
+    STREAM_RECLAIM_INTERVAL: int = Field(default=30, env="STREAM_RECLAIM_INTERVAL")  # 秒
+    STREAM_MAX_DELIVERIES: int = Field(default=5, env="STREAM_MAX_DELIVERIES")  # 超过后转入死信流
+    STREAM_MAX_HANDLERS: int = Field(default=200, env="STREAM_MAX_HANDLERS")  # 每个消费者同时执行的处理函数上限，达到后暂停读取
+    
+    # 消息去重配置（GeWe会重试回调）
+    DEDUP_KEY_PREFIX: str = Field(default="entropy_dedup:gewe_msg", env="DEDUP_KEY_PREFIX")
+    DEDUP_TTL_SECONDS: int = Field(default=86400, env="DEDUP_TTL_SECONDS")  # 1天
+    DEDUP_PROCESSING_TTL_SECONDS: int = Field(default=30, env="DEDUP_PROCESSING_TTL_SECONDS")  # 处理中的占用时长，应小于消息流认领阈值
+    DEDUP_BLOOM_ENABLED: bool = Field(default=False, env="DEDUP_BLOOM_ENABLED")
+    DEDUP_BLOOM_CAPACITY: int = Field(default=1000000, env="DEDUP_BLOOM_CAPACITY")
+    DEDUP_BLOOM_ERROR_RATE: float = Field(default=0.000001, env="DEDUP_BLOOM_ERROR_RATE")
+    
+    # 入站消息批量写入配置（攒批窗口越大吞吐越高，单条延迟也越高）
+    CHAT_BATCH_ENABLED: bool = Field(default=True, env="CHAT_BATCH_ENABLED")
+    CHAT_BATCH_MAX_SIZE: int = Field(default=100, env="CHAT_BATCH_MAX_SIZE")  # 单批最大条数
+    CHAT_BATCH_MAX_WAIT_MS: int = Field(default=10, env="CHAT_BATCH_MAX_WAIT_MS")  # 攒批最长等待（毫秒）
+    CHAT_BATCH_WORKERS: int = Field(default=2, env="CHAT_BATCH_WORKERS")  # 并发写入批次数
+    
+    # 账号/联系人/会话解析缓存（进程内LRU，通过Redis发布订阅跨进程失效）
+    RESOLUTION_CACHE_ENABLED: bool = Field(default=True, env="RESOLUTION_CACHE_ENABLED")
+    RESOLUTION_CACHE_MAX_SIZE: int = Field(default=50000, env="RESOLUTION_CACHE_MAX_SIZE")
+    RESOLUTION_CACHE_TTL: int = Field(default=600, env="RESOLUTION_CACHE_TTL")  # 10分钟
+    RESOLUTION_CACHE_CHANNEL: str = Field(default="entropy_cache:resolution_invalidate", env="RESOLUTION_CACHE_CHANNEL")
+    
+    # 连发消息合并配置（同一会话短时间内的多条消息合并为一次AI请求）
+    CHAT_COALESCE_ENABLED: bool = Field(default=True, env="CHAT_COALESCE_ENABLED")
+    CHAT_COALESCE_DEBOUNCE_MS: int = Field(default=1500, env="CHAT_COALESCE_DEBOUNCE_MS")  # 最后一条消息后的静默时间
+    CHAT_COALESCE_MAX_WAIT_MS: int = Field(default=6000, env="CHAT_COALESCE_MAX_WAIT_MS")  # 从第一条消息起的最长等待
+    
+    # AI处理分片配置（按会话哈希到固定通道，同一会话严格有序，通道间并行）
+    CHAT_AI_LANES: int = Field(default=32, env="CHAT_AI_LANES")
+    CHAT_AI_QUEUE_SIZE: int = Field(default=5000, env="CHAT_AI_QUEUE_SIZE")  # 所有通道排队任务上限，满时阻塞消费
+    
+    # 会话处理租约（通道只在进程内有序；多worker部署时AI任务流按会话分片，分片交接期间由该租约保证会话跨进程串行）
+    CHAT_SESSION_LEASE_ENABLED: bool = Field(default=True, env="CHAT_SESSION_LEASE_ENABLED")  # 仅单worker部署时可关闭
+    CHAT_SESSION_LEASE_PREFIX: str = Field(default="entropy_lease:chat_session", env="CHAT_SESSION_LEASE_PREFIX")
+    CHAT_SESSION_LEASE_MS: int = Field(default=30000, env="CHAT_SESSION_LEASE_MS")  # 租约时长（毫秒），持有期间自动续约
+    CHAT_SESSION_LEASE_POLL_MS: int = Field(default=100, env="CHAT_SESSION_LEASE_POLL_MS")  # 租约被占用时的重试间隔
+    
+    # 会话最近消息缓存（Redis定长列表，供AI上下文和消息列表首页读取）
+    CHAT_HISTORY_CACHE_ENABLED: bool = Field(default=True, env="CHAT_HISTORY_CACHE_ENABLED")
+    CHAT_HISTORY_CACHE_PREFIX: str = Field(default="entropy_history:session", env="CHAT_HISTORY_CACHE_PREFIX")
+    CHAT_HISTORY_CACHE_SIZE: int = Field(default=50, env="CHAT_HISTORY_CACHE_SIZE")  # 每个会话保留的消息条数
+    CHAT_HISTORY_CACHE_TTL: int = Field(default=259200, env="CHAT_HISTORY_CACHE_TTL")  # 3天无消息后过期
+    
+    # AI上下文（聊天历史按token预算从新到旧装入，更早的对话以滚动摘要代替）
+    AI_CONTEXT_HISTORY_TOKENS: int = Field(default=1500, env="AI_CONTEXT_HISTORY_TOKENS")  # 聊天历史（含摘要）的token预算
+    AI_CONTEXT_MAX_INPUT_TOKENS: int = Field(default=6000, env="AI_CONTEXT_MAX_INPUT_TOKENS")  # 单次请求输入上限，超过时裁剪最早的历史
+    AI_CONTEXT_SUMMARY_ENABLED: bool = Field(default=True, env="AI_CONTEXT_SUMMARY_ENABLED")
+    AI_CONTEXT_SUMMARY_TOKENS: int = Field(default=300, env="AI_CONTEXT_SUMMARY_TOKENS")  # 摘要在预算中的上限
+    AI_CONTEXT_SUMMARY_EVERY: int = Field(default=20, env="AI_CONTEXT_SUMMARY_EVERY")  # 窗口外未摘要的消息达到该数量时更新摘要
+    AI_CONTEXT_SUMMARY_MAX_MESSAGES: int = Field(default=100, env="AI_CONTEXT_SUMMARY_MAX_MESSAGES")  # 每次更新最多合并的消息数
+    
+    # 待处理消息恢复（多worker通过 FOR UPDATE SKIP LOCKED 认领租约过期的消息）
+    CHAT_RECOVERY_INTERVAL: int = Field(default=5, env="CHAT_RECOVERY_INTERVAL")  # 秒
+    CHAT_RECOVERY_LEASE: int = Field(default=120, env="CHAT_RECOVERY_LEASE")  # 租约时长（秒），超过后视为丢失
+    CHAT_PROCESSING_LEASE: int = Field(default=600, env="CHAT_PROCESSING_LEASE")  # 处理中租约（秒），超过后恢复为待处理，需大于AI调用超时
+    CHAT_RECOVERY_BATCH_SIZE: int = Field(default=100, env="CHAT_RECOVERY_BATCH_SIZE")
+    CHAT_RECOVERY_MAX_AGE: int = Field(default=86400, env="CHAT_RECOVERY_MAX_AGE")  # 只恢复该时长内的消息（秒），需覆盖过载推迟的时长
+    
+    # 消息表按月分区与冷数据归档（过期分区分离后导出为压缩JSONL再删除）
+    CHAT_PARTITION_PREMAKE_MONTHS: int = Field(default=2, env="CHAT_PARTITION_PREMAKE_MONTHS")  # 提前创建的月份数
+    CHAT_ARCHIVE_ENABLED: bool = Field(default=True, env="CHAT_ARCHIVE_ENABLED")
+    CHAT_ARCHIVE_PATH: str = Field(default="./archives/chat_messages", env="CHAT_ARCHIVE_PATH")
+    CHAT_ARCHIVE_RETENTION_DAYS: int = Field(default=30, env="CHAT_ARCHIVE_RETENTION_DAYS")  # 整个分区都早于该天数才归档
+    CHAT_ARCHIVE_INTERVAL: int = Field(default=86400, env="CHAT_ARCHIVE_INTERVAL")  # 秒
+    CHAT_ARCHIVE_LOCK_KEY: str = Field(default="entropy_lock:chat_archive", env="CHAT_ARCHIVE_LOCK_KEY")
+    
+    # 过载保护（队列有界，超过水位线时按策略降级，而不是让内存和延迟一起无限增长）
+    BACKPRESSURE_ENABLED: bool = Field(default=True, env="BACKPRESSURE_ENABLED")
+    BACKPRESSURE_SAMPLE_INTERVAL: float = Field(default=1.0, env="BACKPRESSURE_SAMPLE_INTERVAL")  # 消息流积压采样间隔（秒）
+    WEBHOOK_BACKLOG_HIGH_WATER: int = Field(default=20000, env="WEBHOOK_BACKLOG_HIGH_WATER")  # 回调流积压超过后拒收并要求重试
+    WEBHOOK_RETRY_AFTER: int = Field(default=10, env="WEBHOOK_RETRY_AFTER")  # 拒收时建议的重试间隔（秒）
+    CHAT_BATCH_QUEUE_SIZE: int = Field(default=5000, env="CHAT_BATCH_QUEUE_SIZE")  # 批量写入队列上限，满时阻塞消费
+    AI_BACKLOG_HIGH_WATER: int = Field(default=500, env="AI_BACKLOG_HIGH_WATER")  # 超过后群聊消息的AI处理推迟
+    AI_BACKLOG_CRITICAL: int = Field(default=2000, env="AI_BACKLOG_CRITICAL")  # 超过后只处理高优先级消息
+    FASTGPT_QUEUE_SIZE: int = Field(default=1000, env="FASTGPT_QUEUE_SIZE")  # FastGPT每个调度通道的队列上限
+    FASTGPT_DISPATCH_LANES: dict = Field(
+        default={
+            "interactive": {"concurrency": 64, "priority": 10},
+            "batch": {"concurrency": 8, "priority": 0}
+        },
+        env="FASTGPT_DISPATCH_LANES"
+    )  # 通道 -> 并发上限和获取上游并发槽位的优先级（交互式对话优先于批量/分析任务）
+    
     # 缓存配置
     CACHE_EXPIRE_TIME: int = Field(default=3600, env="CACHE_EXPIRE_TIME")  # 1小时
     CACHE_PREFIX: str = Field(default="entropy_cache", env="CACHE_PREFIX")
@@ -16,6 +16,10 @@ from app.services.gewe_service import gewe_service
 from app.services.fastgpt_service import fastgpt_service
 from app.services.websocket_manager import websocket_manager
 from app.services.notification_service import notification_service
+from app.services.chat_processor import chat_processor
+from app.services.message_stream import webhook_stream, ai_task_stream
+from app.services.http_clients import http_clients
+from app.services.singleflight import singleflight
 
 logger = logging.getLogger(__name__)
 
@@ -44,7 +48,15 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
         logger.info("启动集成监控服务...")
         await integration_monitor.start_monitoring()
         
-        # 5. 初始化定时任务
+        # 5. 启动FastGPT请求调度
+        logger.info("启动FastGPT请求调度...")
+        await fastgpt_service.start()
+        
+        # 6. 启动聊天消息处理服务（消息流消费者）
+        logger.info("启动聊天消息处理服务...")
+        await chat_processor.start()
+        
+        # 7. 初始化定时任务
         logger.info("启动后台任务...")
         await _start_background_tasks()
         
@@ -69,10 +81,22 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
             logger.info("停止后台任务...")
             await _stop_background_tasks()
             
-            # 3. 清理WebSocket连接
+            # 3. 停止聊天消息处理服务
+            logger.info("停止聊天消息处理服务...")
+            await chat_processor.stop()
+            
+            # 4. 停止FastGPT请求调度，等待处理中的请求完成
+            logger.info("停止FastGPT请求调度...")
+            await fastgpt_service.stop()
+            
+            # 5. 清理WebSocket连接
             logger.info("清理WebSocket连接...")
             await websocket_manager.disconnect_all()
             
+            # 6. 关闭出站HTTP连接池
+            logger.info("关闭出站HTTP连接池...")
+            await http_clients.close()
+            
             logger.info("应用关闭完成！")
             
         except Exception as e:
@@ -271,6 +295,10 @@ async def _stats_aggregation_task():
                     "timestamp": asyncio.get_event_loop().time(),
                     "gewe": gewe_stats,
                     "fastgpt": fastgpt_stats,
+                    "streams": {
+                        "webhook": await webhook_stream.get_lag_metrics(),
+                        "ai_tasks": await ai_task_stream.get_lag_metrics()
+                    },
                     "websocket": {
                         "total_connections": websocket_manager.get_connection_count(),
                         "active_users": websocket_manager.get_user_count()
@@ -299,7 +327,12 @@ async def _stats_aggregation_task():
 
 # 健康检查端点的辅助函数
 async def get_system_health() -> dict:
-    """获取系统整体健康状态"""
+    """获取系统整体健康状态（同时发起的检查共享一次结果）"""
+    return await singleflight.do(("get_system_health",), _collect_system_health)
+
+
+async def _collect_system_health() -> dict:
+    """检查各服务并汇总健康状态"""
     try:
         # 获取各服务状态
         gewe_health = await gewe_service.health_check()
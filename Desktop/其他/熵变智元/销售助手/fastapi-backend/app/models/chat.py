@@ -3,7 +3,7 @@
 包含聊天会话、消息记录、联系人管理等核心模型
 """
 
-from sqlalchemy import Column, String, Boolean, DateTime, Text, ForeignKey, Enum as SQLEnum, Integer, Index
+from sqlalchemy import Column, String, Boolean, DateTime, Text, ForeignKey, Enum as SQLEnum, Integer, Index, UniqueConstraint
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -113,7 +113,8 @@ class Contact(Base):
     
     # 索引
     __table_args__ = (
-        Index('idx_contact_wxid_account', 'wxid', 'wechat_account_id'),
+        # 同一微信账号下联系人唯一，入站消息通过 ON CONFLICT 原子创建
+        UniqueConstraint('wechat_account_id', 'wxid', name='uq_contact_account_wxid'),
         Index('idx_contact_last_message', 'last_message_at'),
         Index('idx_contact_type', 'contact_type'),
     )
@@ -202,7 +203,8 @@ class ChatSession(Base):
     
     # 索引
     __table_args__ = (
-        Index('idx_session_account_contact', 'wechat_account_id', 'contact_id'),
+        # 同一微信账号与联系人只有一个会话
+        UniqueConstraint('wechat_account_id', 'contact_id', name='uq_session_account_contact'),
         Index('idx_session_last_message', 'last_message_at'),
         Index('idx_session_unread', 'unread_count'),
     )
@@ -260,6 +262,7 @@ class ChatMessage(Base):
     
     # AI处理相关
     ai_process_status = Column(SQLEnum(AIProcessStatus), default=AIProcessStatus.PENDING, comment="AI处理状态")
+    ai_claimed_at = Column(DateTime(timezone=True), nullable=True, comment="AI处理租约时间（投递或认领时刷新）")
     ai_response_message_id = Column(UUID(as_uuid=True), nullable=True, comment="AI回复消息ID")
     ai_processing_time = Column(Integer, nullable=True, comment="AI处理耗时(毫秒)")
     ai_cost = Column(String(20), nullable=True, comment="AI处理成本")
@@ -272,8 +275,8 @@ class ChatMessage(Base):
     # 扩展信息
     extra_data = Column(JSONB, nullable=True, default={}, comment="扩展数据")
     
-    # 时间字段
-    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
+    # 时间字段（分区键，需包含在主键中）
+    created_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now(), comment="创建时间")
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), comment="更新时间")
     
     # 关系
@@ -286,6 +289,8 @@ class ChatMessage(Base):
         Index('idx_message_direction', 'direction'),
         Index('idx_message_ai_status', 'ai_process_status'),
         Index('idx_message_gewe_id', 'gewe_message_id'),
+        # 按月范围分区，过期分区整体分离归档（分区由 message_archiver 创建）
+        {"postgresql_partition_by": "RANGE (created_at)"}
     )
     
     def __repr__(self):
@@ -333,6 +338,22 @@ class ChatMessage(Base):
         self.ai_process_status = AIProcessStatus.SKIPPED
 
 
+class ChatMessageKey(Base):
+    """GeWe消息ID去重表（分区表无法建立跨分区的唯一索引，由此表拦截重试回调造成的重复消息）"""
+    __tablename__ = "chat_message_keys"
+
+    gewe_message_id = Column(String(100), primary_key=True, comment="GeWe消息ID")
+    message_id = Column(UUID(as_uuid=True), nullable=False, comment="消息ID")
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
+    
+    __table_args__ = (
+        Index('idx_message_key_created', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f"<ChatMessageKey(gewe_message_id={self.gewe_message_id}, message_id={self.message_id})>"
+
+
 class MessageTemplate(Base):
     """消息模板模型"""
     __tablename__ = "message_templates"
@@ -382,8 +403,52 @@ class MessageTemplate(Base):
         self.last_used_at = datetime.utcnow()
 
 
+class FAQEntry(Base):
+    """常见问题模型（本地知识检索的问答语料）"""
+    __tablename__ = "faq_entries"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    organization_id = Column(UUID(as_uuid=True), ForeignKey("organizations.id"), nullable=False)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=True)
+    
+    # 问答内容
+    question = Column(Text, nullable=False, comment="标准问题")
+    similar_questions = Column(JSONB, nullable=True, default=[], comment="相似问法")
+    answer = Column(Text, nullable=False, comment="答案")
+    category = Column(String(50), nullable=True, comment="分类")
+    
+    # 命中统计
+    hit_count = Column(Integer, default=0, comment="命中次数")
+    last_hit_at = Column(DateTime(timezone=True), nullable=True, comment="最后命中时间")
+    
+    # 状态
+    is_active = Column(Boolean, default=True, comment="是否启用")
+    
+    # 时间字段
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), comment="更新时间")
+    
+    # 关系
+    organization = relationship("Organization")
+    
+    __table_args__ = (
+        Index("idx_faq_org_active", "organization_id", "is_active"),
+    )
+    
+    def __repr__(self):
+        return f"<FAQEntry(id={self.id}, question='{self.question[:20]}')>"
+    
+    @property
+    def questions(self) -> List[str]:
+        """标准问题和全部相似问法"""
+        return [self.question] + [q for q in (self.similar_questions or []) if q]
+
+
 class ConversationSummary(Base):
-    """对话摘要模型"""
+    """
+    对话摘要模型
+    AI上下文使用的滚动摘要：summary_date 为已摘要的最后一条消息时间，message_count 为累计摘要的消息数
+    """
     __tablename__ = "conversation_summaries"
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -425,3 +490,8 @@ Index('idx_messages_ai_pending',
       ChatMessage.created_at,
       postgresql_where=ChatMessage.ai_process_status == AIProcessStatus.PENDING)
 
+# AI上下文按会话读取最新的滚动摘要
+Index('idx_conversation_summaries_session_date',
+      ConversationSummary.session_id,
+      ConversationSummary.summary_date)
+
@@ -0,0 +1,215 @@
+"""
+自适应并发限制
+对AI上游采用AIMD策略：延迟和错误率健康时加性提高并发上限，
+遇到超时、429/5xx过载响应或p95延迟劣化时乘性降低
+"""
+
+import asyncio
+import logging
+import itertools
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, Optional, List
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# 视为上游过载的HTTP状态码
+OVERLOAD_STATUS_CODES = {429, 502, 503, 504}
+
+
+class LimiterSlot:
+    """并发槽位，退出时按结果调整上限"""
+    
+    def __init__(self, limiter: "AdaptiveConcurrencyLimiter", priority: float = 0):
+        self.limiter = limiter
+        self.priority = priority
+        self.status_code: Optional[int] = None
+        self._started_at = 0.0
+    
+    def record(self, status_code: int) -> None:
+        """记录响应状态码"""
+        self.status_code = status_code
+    
+    async def __aenter__(self) -> "LimiterSlot":
+        await self.limiter.acquire(self.priority)
+        self._started_at = time.monotonic()
+        return self
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        latency = time.monotonic() - self._started_at
+        
+        if exc_val is not None:
+            overloaded = isinstance(exc_val, (httpx.TimeoutException, asyncio.TimeoutError))
+        else:
+            overloaded = self.status_code in OVERLOAD_STATUS_CODES
+        
+        await self.limiter.release(latency, overloaded, succeeded=exc_val is None and not overloaded)
+        return False
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD自适应并发限制器"""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.min_limit = settings.AI_CONCURRENCY_MIN
+        self.max_limit = settings.AI_CONCURRENCY_MAX
+        self.decrease_factor = settings.AI_CONCURRENCY_DECREASE_FACTOR
+        self.latency_tolerance = settings.AI_CONCURRENCY_LATENCY_TOLERANCE
+        
+        self._limit = float(settings.AI_CONCURRENCY_INITIAL)
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        
+        # 等待中的请求 [(优先级, 开始等待时间, 序号)]，槽位空出时按老化后的优先级放行
+        self._waiters: List[tuple] = []
+        self._waiter_seq = itertools.count()
+        self.aging_rate = settings.AI_PRIORITY_AGING_RATE
+        
+        # 最近的请求延迟，定期计算p95并与基线比较
+        self._latencies = deque(maxlen=200)
+        self._check_every = 20
+        self._samples_since_check = 0
+        self._baseline_p95: Optional[float] = None
+        self._current_p95: Optional[float] = None
+        self._last_decrease = 0.0
+        
+        # 统计信息
+        self.stats = {
+            "requests": 0,
+            "increases": 0,
+            "decreases": 0,
+            "overload_signals": 0,
+            "latency_regressions": 0,
+            "last_decrease_time": None
+        }
+    
+    @property
+    def limit(self) -> int:
+        """当前并发上限"""
+        return max(self.min_limit, int(self._limit))
+    
+    @property
+    def waiting(self) -> int:
+        """等待槽位的请求数"""
+        return len(self._waiters)
+    
+    def slot(self, priority: float = 0) -> LimiterSlot:
+        """获取一个并发槽位（async with 使用），priority 越高越先获得"""
+        return LimiterSlot(self, priority)
+    
+    def _is_next(self, waiter: tuple) -> bool:
+        """是否轮到该请求：有空闲槽位且老化后的优先级最高（同分先到先得）"""
+        if self.in_flight >= self.limit:
+            return False
+        
+        now = time.monotonic()
+        best = max(
+            self._waiters,
+            key=lambda item: (item[0] + (now - item[1]) * self.aging_rate, -item[2])
+        )
+        return best is waiter
+    
+    async def acquire(self, priority: float = 0):
+        """等待可用的并发槽位"""
+        async with self._condition:
+            waiter = (priority, time.monotonic(), next(self._waiter_seq))
+            self._waiters.append(waiter)
+            try:
+                await self._condition.wait_for(lambda: self._is_next(waiter))
+            finally:
+                self._waiters.remove(waiter)
+                # 队首变化，唤醒其余等待者重新判断
+                self._condition.notify_all()
+            self.in_flight += 1
+            self.stats["requests"] += 1
+    
+    async def release(self, latency: float, overloaded: bool, succeeded: bool = True):
+        """释放槽位并根据结果调整上限"""
+        async with self._condition:
+            saturated = self.in_flight * 2 >= self.limit
+            self.in_flight -= 1
+            
+            if overloaded:
+                self.stats["overload_signals"] += 1
+                self._decrease("上游过载")
+            elif succeeded:
+                self._latencies.append(latency)
+                self._samples_since_check += 1
+                
+                if self._samples_since_check >= self._check_every and self._latency_regressed():
+                    self.stats["latency_regressions"] += 1
+                    self._decrease("p95延迟劣化")
+                elif saturated:
+                    # 只有并发确实被用满时才增长，避免空闲时上限无限膨胀
+                    self._increase()
+            
+            self._condition.notify_all()
+    
+    def _increase(self):
+        """加性增长：每轮（约limit个成功请求）上限+1"""
+        if self._limit >= self.max_limit:
+            return
+        self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+        self.stats["increases"] += 1
+    
+    def _decrease(self, reason: str):
+        """乘性下降，一个延迟周期内最多下降一次"""
+        now = time.monotonic()
+        cooldown = max(1.0, self._current_p95 or 0.0)
+        if now - self._last_decrease < cooldown:
+            return
+        
+        old_limit = self.limit
+        self._limit = max(float(self.min_limit), self._limit * self.decrease_factor)
+        self._last_decrease = now
+        self._latencies.clear()
+        self._samples_since_check = 0
+        self.stats["decreases"] += 1
+        self.stats["last_decrease_time"] = datetime.utcnow()
+        logger.warning(f"AI并发上限下调({reason}): {self.name} {old_limit} -> {self.limit}")
+    
+    def _latency_regressed(self) -> bool:
+        """p95延迟是否明显高于基线"""
+        self._samples_since_check = 0
+        ordered = sorted(self._latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        self._current_p95 = p95
+        
+        if self._baseline_p95 is None:
+            self._baseline_p95 = p95
+            return False
+        
+        if p95 > self._baseline_p95 * self.latency_tolerance:
+            # 持续变慢时基线也逐步上移，避免上限被长期压在最小值
+            self._baseline_p95 = self._baseline_p95 * 0.9 + p95 * 0.1
+            return True
+        
+        # 健康时基线缓慢跟随，允许上游正常的延迟漂移
+        self._baseline_p95 = self._baseline_p95 * 0.95 + p95 * 0.05
+        return False
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            **self.stats,
+            "name": self.name,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "p95_ms": round(self._current_p95 * 1000, 2) if self._current_p95 is not None else None,
+            "baseline_p95_ms": round(self._baseline_p95 * 1000, 2) if self._baseline_p95 is not None else None
+        }
+
+
+# 全局自适应并发限制实例（按上游区分）
+fastgpt_limiter = AdaptiveConcurrencyLimiter("fastgpt")
+ai_service_limiter = AdaptiveConcurrencyLimiter("ai_service")
@@ -0,0 +1,96 @@
+"""
+AI任务优先级预分类
+入站时用关键词意图、联系人标签和私聊/群聊快速打分，决定AI任务的优先级档位；
+调度时等待时间按 AI_PRIORITY_AGING_RATE 折算为分数，低优先级任务不会被无限推迟
+"""
+
+import logging
+from typing import Dict, Any, List, Optional
+
+from app.core.config import settings
+from app.models.chat import ChatType
+from app.services.keyword_engine import keyword_engine, CATEGORY_INTENT
+
+logger = logging.getLogger(__name__)
+
+
+PRIORITY_HIGH = "high"
+PRIORITY_NORMAL = "normal"
+PRIORITY_LOW = "low"
+
+
+def detect_intent(text: Optional[str], organization_id: Any = None) -> str:
+    """关键词匹配意图"""
+    if not text:
+        return "general"
+    
+    return keyword_engine.scan(text, organization_id).first(CATEGORY_INTENT, "general")
+
+
+class AIPriorityClassifier:
+    """AI任务优先级预分类器"""
+    
+    def __init__(self):
+        self.enabled = settings.AI_PRIORITY_ENABLED
+        self.intent_weights = settings.AI_PRIORITY_INTENT_WEIGHTS
+        self.tag_weights = settings.AI_PRIORITY_TAG_WEIGHTS
+        self.private_weight = settings.AI_PRIORITY_PRIVATE_WEIGHT
+        self.group_weight = settings.AI_PRIORITY_GROUP_WEIGHT
+        self.high_threshold = settings.AI_PRIORITY_HIGH_THRESHOLD
+        self.low_threshold = settings.AI_PRIORITY_LOW_THRESHOLD
+        
+        # 统计信息
+        self.stats = {
+            "classified": 0,
+            PRIORITY_HIGH: 0,
+            PRIORITY_NORMAL: 0,
+            PRIORITY_LOW: 0
+        }
+    
+    def score(
+        self,
+        content: Optional[str],
+        chat_type: Optional[ChatType] = None,
+        tags: Optional[List[str]] = None
+    ) -> int:
+        """计算优先级分数（越高越先处理）"""
+        if not self.enabled:
+            return 0
+        
+        score = self.intent_weights.get(detect_intent(content), 0)
+        
+        if chat_type == ChatType.GROUP:
+            score += self.group_weight
+        elif chat_type == ChatType.PRIVATE:
+            score += self.private_weight
+        
+        # 多个标签取权重最高的一个，避免标签堆叠
+        tag_scores = [self.tag_weights[tag] for tag in (tags or []) if tag in self.tag_weights]
+        if tag_scores:
+            score += max(tag_scores)
+        
+        self.stats["classified"] += 1
+        self.stats[self.level(score)] += 1
+        return score
+    
+    def level(self, score: float) -> str:
+        """分数对应的优先级档位"""
+        if score >= self.high_threshold:
+            return PRIORITY_HIGH
+        if score < self.low_threshold:
+            return PRIORITY_LOW
+        return PRIORITY_NORMAL
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "high_threshold": self.high_threshold,
+            "low_threshold": self.low_threshold,
+            "aging_rate": settings.AI_PRIORITY_AGING_RATE
+        }
+
+
+# 全局AI任务优先级分类实例
+ai_priority_classifier = AIPriorityClassifier()
@@ -14,6 +14,18 @@ import httpx
 from app.core.config import settings
 from app.core.redis import redis_client
 from app.utils.rate_limiter import RateLimiter
+from app.services.adaptive_limiter import ai_service_limiter, OVERLOAD_STATUS_CODES
+from app.services.request_hedger import ai_service_hedger, ai_service_stream_hedger
+from app.services.circuit_breaker import circuit_breakers, CircuitOpenError
+from app.services.singleflight import singleflight
+from app.services.ai_stream import DeltaCallback, read_completion_stream
+from app.services.keyword_engine import (
+    keyword_engine, CATEGORY_INTENT, CATEGORY_SENTIMENT, CATEGORY_TOPIC, CATEGORY_SAFETY
+)
+from app.services.http_clients import http_clients
+from app.services.reply_cache import ai_reply_cache
+from app.services.token_estimator import token_estimator
+from app.services.context_builder import SUMMARY_PREFIX, format_history_line, fit_history
 
 logger = logging.getLogger(__name__)
 
@@ -32,19 +44,8 @@ class TokenCalculator:
     
     @staticmethod
     def estimate_tokens(text: str) -> int:
-        """估算文本的token数量（简化算法）"""
-        if not text:
-            return 0
-        
-        # 中文字符按1.5个token计算，英文单词按平均token计算
-        chinese_chars = len([c for c in text if '\u4e00' <= c <= '\u9fff'])
-        english_chars = len(text) - chinese_chars
-        
-        # 简化计算：中文1.5token/字，英文4字符/token
-        chinese_tokens = chinese_chars * 1.5
-        english_tokens = english_chars / 4
-        
-        return int(chinese_tokens + english_tokens)
+        """估算文本的token数量（使用共享的Token估算器）"""
+        return token_estimator.estimate(text)
     
     @staticmethod
     def calculate_cost(
@@ -75,8 +76,9 @@ class AIService:
         self.timeout = settings.AI_REQUEST_TIMEOUT
         self.max_retries = settings.AI_MAX_RETRIES
         
-        # 创建HTTP客户端
-        self.client = httpx.AsyncClient(
+        # HTTP客户端（进程内共享连接池，多个AIService实例复用同一组长连接）
+        self.client = http_clients.get(
+            "ai_service",
             base_url=self.base_url,
             timeout=self.timeout,
             headers={
@@ -91,14 +93,31 @@ class AIService:
             max_requests_per_hour=3000    # 每小时最多3000次请求
         )
         
+        # 自适应并发限制（AIMD）
+        self.limiter = ai_service_limiter
+        
+        # 慢请求对冲
+        self.hedger = ai_service_hedger
+        self.stream_hedger = ai_service_stream_hedger
+        
         # Token计算器
         self.token_calculator = TokenCalculator()
+        
+        # 流式回复和上下文裁剪统计
+        self.stats = {
+            "streamed_requests": 0,
+            "stream_errors": 0,
+            "context_trimmed": 0,
+            "total_first_token_time": 0,
+            "last_first_token_time": None
+        }
     
     async def __aenter__(self):
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.client.aclose()
+        # 共享连接池在应用关闭时由 http_clients 统一关闭
+        pass
     
     async def test_connection(self) -> bool:
         """测试AI服务连接"""
@@ -114,9 +133,17 @@ class AIService:
         method: str,
         endpoint: str,
         data: Dict[str, Any] = None,
-        retry_count: int = 0
+        retry_count: int = 0,
+        priority: float = 0
     ) -> Dict[str, Any]:
-        """发起AI API请求"""
+        """发起AI API请求（priority 越高越先获得并发槽位）"""
+        
+        # 熔断中直接失败，不消耗限流令牌，也不排队等待并发槽位
+        breaker = circuit_breakers.get("ai_service", endpoint)
+        try:
+            breaker.check()
+        except CircuitOpenError as e:
+            raise AIServiceError(f"AI接口熔断中: {str(e)}", status_code=503)
         
         # 限流控制
         await self.rate_limiter.acquire()
@@ -124,11 +151,21 @@ class AIService:
         try:
             logger.debug(f"AI API请求: {method} {endpoint}")
             
-            # 发起请求
-            response = await self.client.request(
-                method=method,
-                url=endpoint,
-                json=data if method.upper() in ["POST", "PUT", "PATCH"] else None
+            # 发起请求（每次尝试占用一个自适应并发槽位）
+            async def send() -> httpx.Response:
+                async with self.limiter.slot(priority) as slot, breaker.guard() as call:
+                    response = await self.client.request(
+                        method=method,
+                        url=endpoint,
+                        json=data if method.upper() in ["POST", "PUT", "PATCH"] else None
+                    )
+                    slot.record(response.status_code)
+                    call.record(response.status_code)
+                return response
+            
+            # 慢请求对冲，上游过载的响应不会胜出
+            response = await self.hedger.run(
+                send, accept=lambda response: response.status_code not in OVERLOAD_STATUS_CODES
             )
             
             # 检查响应状态
@@ -151,18 +188,22 @@ class AIService:
             logger.debug(f"AI API响应成功: {endpoint}")
             return result
             
+        except CircuitOpenError as e:
+            # 半开探测名额已满，重试也会被拒绝，直接失败
+            raise AIServiceError(f"AI接口熔断中: {str(e)}", status_code=503)
+            
         except httpx.TimeoutException:
             logger.warning(f"AI API请求超时: {endpoint}")
             if retry_count < self.max_retries:
                 await asyncio.sleep(2 ** retry_count)
-                return await self._make_request(method, endpoint, data, retry_count + 1)
+                return await self._make_request(method, endpoint, data, retry_count + 1, priority)
             raise AIServiceError("请求超时")
             
         except httpx.NetworkError as e:
             logger.warning(f"AI API网络错误: {endpoint}, {str(e)}")
             if retry_count < self.max_retries:
                 await asyncio.sleep(2 ** retry_count)
-                return await self._make_request(method, endpoint, data, retry_count + 1)
+                return await self._make_request(method, endpoint, data, retry_count + 1, priority)
             raise AIServiceError(f"网络错误: {str(e)}")
             
         except AIServiceError:
@@ -171,14 +212,106 @@ class AIService:
             logger.error(f"AI API请求异常: {endpoint}, {str(e)}")
             raise AIServiceError(f"请求异常: {str(e)}")
     
+    async def _stream_request(
+        self,
+        endpoint: str,
+        data: Dict[str, Any],
+        on_delta: DeltaCallback,
+        retry_count: int = 0,
+        priority: float = 0
+    ) -> Dict[str, Any]:
+        """发起流式AI API请求，增量文本回调 on_delta，返回拼接后的完整结果"""
+        
+        # 熔断中直接失败，不消耗限流令牌，也不排队等待并发槽位
+        breaker = circuit_breakers.get("ai_service", endpoint)
+        try:
+            breaker.check()
+        except CircuitOpenError as e:
+            self.stats["stream_errors"] += 1
+            raise AIServiceError(f"AI接口熔断中: {str(e)}", status_code=503)
+        
+        # 限流控制
+        await self.rate_limiter.acquire()
+        
+        received_delta = False
+        
+        async def track_delta(delta: str):
+            nonlocal received_delta
+            received_delta = True
+            await on_delta(delta)
+        
+        try:
+            logger.debug(f"AI API流式请求: POST {endpoint}")
+            started = time.monotonic()
+            
+            # 每次尝试占用一个自适应并发槽位直到流结束
+            async def send_stream(push: DeltaCallback) -> Dict[str, Any]:
+                async with self.limiter.slot(priority) as slot, breaker.guard() as call:
+                    async with self.client.stream("POST", endpoint, json={**data, "stream": True}) as response:
+                        slot.record(response.status_code)
+                        call.record(response.status_code)
+                        
+                        if response.status_code >= 400:
+                            await response.aread()
+                            error_data = {}
+                            try:
+                                error_data = response.json()
+                            except:
+                                pass
+                            
+                            raise AIServiceError(
+                                message=f"AI API请求失败: {response.status_code}",
+                                status_code=response.status_code,
+                                response_data=error_data
+                            )
+                        
+                        return await read_completion_stream(response, push, started)
+            
+            # 首token超过阈值仍未到达时对冲，只转发先收到增量的请求
+            result = await self.stream_hedger.run_stream(send_stream, track_delta)
+            
+            self.stats["streamed_requests"] += 1
+            if result["first_token_time"] is not None:
+                self.stats["total_first_token_time"] += result["first_token_time"]
+                self.stats["last_first_token_time"] = result["first_token_time"]
+            
+            logger.debug(f"AI API流式响应完成: {endpoint}, 首token {result['first_token_time']}ms")
+            return result
+            
+        except CircuitOpenError as e:
+            self.stats["stream_errors"] += 1
+            raise AIServiceError(f"AI接口熔断中: {str(e)}", status_code=503)
+            
+        except (httpx.TimeoutException, httpx.NetworkError) as e:
+            self.stats["stream_errors"] += 1
+            logger.warning(f"AI API流式请求中断: {endpoint}, {str(e)}")
+            # 已经推送过增量内容的不再重试，避免订阅者看到重复的回复
+            if not received_delta and retry_count < self.max_retries:
+                await asyncio.sleep(2 ** retry_count)
+                return await self._stream_request(endpoint, data, on_delta, retry_count + 1, priority)
+            raise AIServiceError("请求超时" if isinstance(e, httpx.TimeoutException) else f"网络错误: {str(e)}")
+            
+        except AIServiceError:
+            self.stats["stream_errors"] += 1
+            raise
+        except Exception as e:
+            self.stats["stream_errors"] += 1
+            logger.error(f"AI API流式请求异常: {endpoint}, {str(e)}")
+            raise AIServiceError(f"请求异常: {str(e)}")
+    
     async def process_message(
         self,
         user_message: str,
         context: Dict[str, Any],
         workflow_id: str = None,
-        model_name: str = None
+        model_name: str = None,
+        on_delta: Optional[DeltaCallback] = None,
+        priority: float = 0
     ) -> Dict[str, Any]:
-        """处理用户消息，获取AI回复"""
+        """
+        处理用户消息，获取AI回复
+        传入 on_delta 时以流式方式请求，增量文本逐段回调；priority 为任务优先级分数
+        """
         try:
             start_time = time.time()
             
@@ -186,6 +319,13 @@ class AIService:
             workflow_id = workflow_id or "default"
             model_name = model_name or self.default_model
             
+            # 开启回复缓存的工作流，重复的短问题直接复用之前的回复
+            cache_key = ai_reply_cache.cache_key(workflow_id, user_message, context)
+            if cache_key:
+                cached = await ai_reply_cache.get(cache_key)
+                if cached:
+                    return await self._cached_result(cached, workflow_id, start_time, on_delta)
+            
             # 构建请求数据
             request_data = {
                 "userChatInput": user_message,
@@ -194,12 +334,31 @@ class AIService:
                 "model": model_name
             }
             
-            # 估算输入token数
-            input_text = user_message + json.dumps(context, ensure_ascii=False)
-            estimated_input_tokens = self.token_calculator.estimate_tokens(input_text)
+            # 估算输入token数（按实际发送的变量估算，历史记录逐行命中估算缓存）
+            estimated_input_tokens = (
+                token_estimator.estimate(user_message)
+                + token_estimator.estimate_value(request_data["variables"])
+            )
+            
+            # 超过单次请求输入上限时裁剪最早的历史
+            excess = estimated_input_tokens - settings.AI_CONTEXT_MAX_INPUT_TOKENS
+            histories = request_data["variables"].get("histories")
+            if excess > 0 and histories:
+                history_tokens = token_estimator.estimate(histories)
+                request_data["variables"]["histories"] = fit_history(histories, max(0, history_tokens - excess))
+                estimated_input_tokens -= history_tokens - token_estimator.estimate(request_data["variables"]["histories"])
+                self.stats["context_trimmed"] += 1
+                logger.warning(f"AI请求输入超过上限，已裁剪聊天历史: 超出 {excess} tokens")
             
             # 调用AI API
-            result = await self._make_request("POST", "/chat/completions", request_data)
+            if on_delta and settings.AI_STREAM_ENABLED:
+                result = await self._stream_request(
+                    "/chat/completions", request_data, on_delta, priority=priority
+                )
+            else:
+                result = await self._make_request(
+                    "POST", "/chat/completions", request_data, priority=priority
+                )
             
             # 计算处理时间
             processing_time = int((time.time() - start_time) * 1000)
@@ -224,25 +383,39 @@ class AIService:
             )
             
             # 分析意图和情感（简化实现）
-            intent_info = await self._analyze_intent(user_message)
+            intent_info = await self._analyze_intent(user_message, context.get("organization_id"))
             
             logger.info(f"AI消息处理成功，耗时: {processing_time}ms，成本: ${cost}")
             
+            tokens = {
+                "input": actual_input_tokens,
+                "output": output_tokens,
+                "total": actual_input_tokens + output_tokens
+            }
+            if cache_key and ai_response:
+                await ai_reply_cache.set(cache_key, {
+                    "response": ai_response,
+                    "tokens": tokens,
+                    "cost": cost,
+                    "model": model_name,
+                    "intent": intent_info.get("intent"),
+                    "sentiment": intent_info.get("sentiment"),
+                    "keywords": intent_info.get("keywords", [])
+                })
+            
             return {
                 "success": True,
                 "response": ai_response,
                 "processing_time": processing_time,
-                "tokens": {
-                    "input": actual_input_tokens,
-                    "output": output_tokens,
-                    "total": actual_input_tokens + output_tokens
-                },
+                "first_token_time": result.get("first_token_time"),
+                "tokens": tokens,
                 "cost": cost,
                 "model": model_name,
                 "workflow_id": workflow_id,
                 "intent": intent_info.get("intent"),
                 "sentiment": intent_info.get("sentiment"),
-                "keywords": intent_info.get("keywords", [])
+                "keywords": intent_info.get("keywords", []),
+                "cached": False
             }
             
         except AIServiceError:
@@ -251,6 +424,35 @@ class AIService:
             logger.error(f"AI消息处理失败: {str(e)}")
             raise AIServiceError(f"消息处理失败: {str(e)}")
     
+    async def _cached_result(
+        self,
+        cached: Dict[str, Any],
+        workflow_id: str,
+        start_time: float,
+        on_delta: Optional[DeltaCallback] = None
+    ) -> Dict[str, Any]:
+        """由缓存的回复构造处理结果（未调用上游，token和成本为0）"""
+        if on_delta and settings.AI_STREAM_ENABLED:
+            await on_delta(cached["response"])
+        
+        processing_time = int((time.time() - start_time) * 1000)
+        logger.info(f"AI回复缓存命中，耗时: {processing_time}ms")
+        
+        return {
+            "success": True,
+            "response": cached["response"],
+            "processing_time": processing_time,
+            "first_token_time": processing_time,
+            "tokens": {"input": 0, "output": 0, "total": 0},
+            "cost": 0.0,
+            "model": cached.get("model"),
+            "workflow_id": workflow_id,
+            "intent": cached.get("intent"),
+            "sentiment": cached.get("sentiment"),
+            "keywords": cached.get("keywords", []),
+            "cached": True
+        }
+    
     def _build_variables(self, context: Dict[str, Any]) -> Dict[str, Any]:
         """构建AI工作流所需的变量"""
         variables = {
@@ -258,7 +460,11 @@ class AIService:
             "nickName": context.get("contact_nickname", "朋友"),
             "accountNo": context.get("account_id", ""),
             "nickId": context.get("contact_wxid", ""),
-            "histories": self._format_chat_history(context.get("chat_history", [])),
+            "histories": self._format_chat_history(
+                context.get("chat_history", []),
+                max_messages=None,
+                summary=context.get("conversation_summary")
+            ),
         }
         
         # 添加图片URL（如果有）
@@ -271,54 +477,38 @@ class AIService:
         
         return variables
     
-    def _format_chat_history(self, chat_history: List[Dict[str, Any]]) -> str:
-        """格式化聊天历史为AI可理解的文本"""
-        if not chat_history:
-            return ""
+    def _format_chat_history(
+        self,
+        chat_history: List[Dict[str, Any]],
+        max_messages: Optional[int] = 10,
+        summary: Optional[str] = None
+    ) -> str:
+        """
+        格式化聊天历史为AI可理解的文本
+        max_messages 为空时不限条数（已由上下文构建按token预算装入），summary 为更早对话的滚动摘要
+        """
+        formatted_history = [SUMMARY_PREFIX + summary] if summary else []
+        
+        if chat_history and max_messages:
+            chat_history = chat_history[-max_messages:]
         
-        formatted_history = []
-        for msg in chat_history[-10:]:  # 只取最近10条消息
-            role = "用户" if msg.get("direction") == "incoming" else "我"
-            content = msg.get("content", "")
-            timestamp = msg.get("created_at", "")
-            
-            if content:
-                formatted_history.append(f"{role}({timestamp}): {content}")
+        for msg in chat_history or []:
+            line = format_history_line(msg)
+            if line:
+                formatted_history.append(line)
         
         return "\n".join(formatted_history)
     
-    async def _analyze_intent(self, message: str) -> Dict[str, Any]:
+    async def _analyze_intent(self, message: str, organization_id: Any = None) -> Dict[str, Any]:
         """分析消息意图和情感（简化实现）"""
         try:
             # 这里可以集成更复杂的NLP分析
-            # 目前使用简单的关键词匹配
-            
-            # 意图分类
-            intent = "general"
-            if any(word in message for word in ["价格", "多少钱", "费用", "收费"]):
-                intent = "inquiry_price"
-            elif any(word in message for word in ["购买", "要买", "下单"]):
-                intent = "purchase_intent"
-            elif any(word in message for word in ["咨询", "了解", "介绍"]):
-                intent = "inquiry_product"
-            elif any(word in message for word in ["投诉", "问题", "故障"]):
-                intent = "complaint"
-            
-            # 情感分析
-            sentiment = "neutral"
-            positive_words = ["好", "不错", "满意", "喜欢", "感谢"]
-            negative_words = ["差", "不好", "失望", "生气", "烂"]
-            
-            if any(word in message for word in positive_words):
-                sentiment = "positive"
-            elif any(word in message for word in negative_words):
-                sentiment = "negative"
-            
-            # 关键词提取（简化）
-            keywords = []
-            for word in ["产品", "服务", "价格", "质量", "售后"]:
-                if word in message:
-                    keywords.append(word)
+            # 目前使用关键词匹配：意图、情感和话题词典一次扫描完成
+            matches = await keyword_engine.analyze(message, organization_id)
+            
+            intent = matches.first(CATEGORY_INTENT, "general")
+            sentiment = matches.first(CATEGORY_SENTIMENT, "neutral")
+            keywords = matches.labels.get(CATEGORY_TOPIC, [])
             
             return {
                 "intent": intent,
@@ -337,12 +527,12 @@ class AIService:
     async def batch_process_messages(
         self,
         messages: List[Dict[str, Any]],
-        max_concurrent: int = 5
+        max_concurrent: Optional[int] = None
     ) -> List[Dict[str, Any]]:
-        """批量处理消息"""
+        """批量处理消息（默认并发由自适应限制器控制）"""
         try:
             # 创建任务队列
-            semaphore = asyncio.Semaphore(max_concurrent)
+            semaphore = asyncio.Semaphore(max_concurrent or max(1, len(messages)))
             
             async def process_single_message(msg_data):
                 async with semaphore:
@@ -432,14 +622,39 @@ class AIService:
                 "action_items": []
             }
     
-    async def check_content_safety(self, content: str) -> Dict[str, Any]:
+    async def summarize_conversation(self, previous_summary: Optional[str], lines: List[str]) -> str:
+        """把新的聊天记录合并进会话的滚动摘要（供上下文构建在后台调用）"""
+        prompt = f"""
+        以下是与客户对话的已有摘要和之后的新对话，请合并为一份新的摘要，
+        保留客户的需求、意向、关注点、已承诺的事项和待跟进事项，不超过{settings.AI_CONTEXT_SUMMARY_TOKENS}字，直接输出摘要正文。
+        
+        已有摘要：
+        {previous_summary or "无"}
+        
+        新对话：
+        {chr(10).join(lines)}
+        """
+        
+        request_data = {
+            "userChatInput": prompt,
+            "variables": {"role": "对话分析助手"},
+            "model": self.default_model
+        }
+        
+        # 摘要在后台生成，获取并发槽位时让位于实时回复
+        result = await self._make_request(
+            "POST", "/chat/completions", request_data, priority=settings.AI_PRIORITY_LOW_THRESHOLD - 100
+        )
+        return result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
+    
+    async def check_content_safety(self, content: str, organization_id: Any = None) -> Dict[str, Any]:
         """内容安全检查"""
         try:
             # 这里可以集成内容审核API
-            # 目前使用简单的关键词过滤
-            
-            unsafe_keywords = ["政治", "暴力", "色情", "赌博", "诈骗"]
-            is_safe = not any(keyword in content for keyword in unsafe_keywords)
+            # 目前使用关键词过滤（组织可扩展安全词典）
+            matches = await keyword_engine.analyze(content, organization_id)
+            categories = matches.labels.get(CATEGORY_SAFETY, [])
+            is_safe = not categories
             
             if not is_safe:
                 logger.warning(f"检测到不安全内容: {content[:50]}...")
@@ -447,7 +662,7 @@ class AIService:
             return {
                 "is_safe": is_safe,
                 "confidence": 0.9 if is_safe else 0.1,
-                "categories": [] if is_safe else ["unsafe_content"]
+                "categories": categories
             }
             
         except Exception as e:
@@ -461,7 +676,9 @@ class AIService:
     async def get_model_list(self) -> List[Dict[str, Any]]:
         """获取可用的AI模型列表"""
         try:
-            result = await self._make_request("GET", "/models")
+            result = await singleflight.do(
+                ("ai_service.get_model_list",), lambda: self._make_request("GET", "/models")
+            )
             return result.get("data", [])
         except Exception as e:
             logger.error(f"获取模型列表失败: {str(e)}")
@@ -470,7 +687,9 @@ class AIService:
     async def get_workflow_list(self) -> List[Dict[str, Any]]:
         """获取可用的工作流列表"""
         try:
-            result = await self._make_request("GET", "/workflows")
+            result = await singleflight.do(
+                ("ai_service.get_workflow_list",), lambda: self._make_request("GET", "/workflows")
+            )
             return result.get("data", [])
         except Exception as e:
             logger.error(f"获取工作流列表失败: {str(e)}")
@@ -489,6 +708,19 @@ class AIService:
         """计算指定token数量的成本"""
         model_name = model_name or self.default_model
         return self.token_calculator.calculate_cost(input_tokens, output_tokens, model_name)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        streamed = self.stats["streamed_requests"]
+        return {
+            **self.stats,
+            "avg_first_token_time": round(self.stats["total_first_token_time"] / streamed, 2) if streamed else None,
+            "concurrency": self.limiter.get_stats(),
+            "hedging": self.hedger.get_stats(),
+            "stream_hedging": self.stream_hedger.get_stats(),
+            "circuit_breakers": circuit_breakers.get_stats("ai_service"),
+            "reply_cache": ai_reply_cache.get_stats()
+        }
 
 
 # 全局AI服务实例
@@ -0,0 +1,169 @@
+"""
+AI流式回复
+解析上游SSE（OpenAI兼容的 stream: true 格式），把增量文本按间隔合并后推送给会话的WebSocket订阅者
+"""
+
+import json
+import logging
+import time
+import uuid
+from typing import Dict, Any, List, Optional, Tuple, AsyncIterator, Callable, Awaitable
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+DeltaCallback = Callable[[str], Awaitable[Any]]
+
+# 携带回复文本的SSE事件（FastGPT detail模式下还会推送流程节点等其他事件）
+ANSWER_EVENTS = {None, "answer", "fastAnswer"}
+
+
+async def iter_sse_events(response: httpx.Response) -> AsyncIterator[Tuple[Optional[str], str]]:
+    """逐个解析SSE事件，返回 (事件名, data)"""
+    event: Optional[str] = None
+    data_lines: List[str] = []
+    
+    async for line in response.aiter_lines():
+        if not line:
+            if data_lines:
+                yield event, "\n".join(data_lines)
+            event = None
+            data_lines = []
+            continue
+        
+        if line.startswith(":"):
+            continue
+        
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        
+        if field == "event":
+            event = value
+        elif field == "data":
+            data_lines.append(value)
+    
+    if data_lines:
+        yield event, "\n".join(data_lines)
+
+
+async def read_completion_stream(
+    response: httpx.Response,
+    on_delta: Optional[DeltaCallback] = None,
+    started: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    读取流式响应，每段增量文本回调 on_delta
+    返回与非流式接口结构相同的完整结果，first_token_time 为从 started 起到首个token的毫秒数
+    """
+    started = started or time.monotonic()
+    first_token_time: Optional[int] = None
+    parts: List[str] = []
+    usage: Dict[str, Any] = {}
+    
+    async for event, data in iter_sse_events(response):
+        if event not in ANSWER_EVENTS:
+            continue
+        if data.strip() == "[DONE]":
+            break
+        
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            logger.debug(f"忽略无法解析的流式数据: {data[:100]}")
+            continue
+        
+        if chunk.get("usage"):
+            usage = chunk["usage"]
+        
+        for choice in chunk.get("choices") or []:
+            delta = (choice.get("delta") or {}).get("content")
+            if not delta:
+                continue
+            
+            if first_token_time is None:
+                first_token_time = int((time.monotonic() - started) * 1000)
+            parts.append(delta)
+            
+            if on_delta:
+                await on_delta(delta)
+    
+    return {
+        "choices": [{"message": {"role": "assistant", "content": "".join(parts)}}],
+        "usage": usage,
+        "first_token_time": first_token_time
+    }
+
+
+class ReplyStreamPublisher:
+    """把一次AI回复的增量文本推送给会话的WebSocket订阅者（按间隔合并，减少推送帧数）"""
+    
+    def __init__(self, ws_manager, session_id: Any, reply_id: Any = None):
+        self.ws_manager = ws_manager
+        self.session_id = str(session_id)
+        # 与最终写入的回复消息ID一致，前端据此用正式消息替换正在生成的回复
+        self.reply_id = str(reply_id or uuid.uuid4())
+        self.flush_interval = settings.AI_STREAM_FLUSH_MS / 1000
+        
+        self.started = False
+        self._buffer: List[str] = []
+        self._seq = 0
+        self._last_flush = 0.0
+    
+    async def push(self, delta: str):
+        """收到一段增量文本"""
+        if not self.started:
+            self.started = True
+            await self._send("ai_reply_start", {})
+        
+        self._buffer.append(delta)
+        
+        # 首段立即推送，之后按间隔合并
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            await self._flush()
+    
+    async def finish(self, content: str, message_id: Any = None):
+        """回复生成完成"""
+        if not self.started:
+            return
+        
+        await self._flush()
+        await self._send("ai_reply_end", {
+            "content": content,
+            "message_id": str(message_id) if message_id else None
+        })
+    
+    async def abort(self, reason: str):
+        """回复被取消或失败，前端丢弃正在生成的内容"""
+        if not self.started:
+            return
+        
+        self._buffer.clear()
+        await self._send("ai_reply_abort", {"reason": reason})
+    
+    async def _flush(self):
+        """推送缓冲的增量文本"""
+        if not self._buffer:
+            return
+        
+        delta = "".join(self._buffer)
+        self._buffer.clear()
+        self._seq += 1
+        self._last_flush = time.monotonic()
+        await self._send("ai_reply_delta", {"seq": self._seq, "delta": delta})
+    
+    async def _send(self, event_type: str, data: Dict[str, Any]):
+        """推送事件，失败不影响回复生成"""
+        try:
+            await self.ws_manager.send_to_session(self.session_id, {
+                "type": event_type,
+                "session_id": self.session_id,
+                "reply_id": self.reply_id,
+                **data
+            })
+        except Exception as e:
+            logger.debug(f"推送流式回复失败: {self.session_id}, {str(e)}")
@@ -6,24 +6,42 @@
 import asyncio
 import json
 import logging
+import uuid
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import selectinload
 
+from app.core.config import settings
 from app.core.database import get_db
 from app.core.redis import redis_client
 from app.models.device import WeChatAccount, DeviceStatus
 from app.models.chat import (
-    Contact, ChatSession, ChatMessage, 
+    Contact, ChatSession, ChatMessage, FAQEntry,
     ChatType, MessageType, MessageDirection, MessageStatus, AIProcessStatus
 )
 from app.models.user import User
 from app.services.ai_service import AIService, AIServiceError
 from app.services.gewe_service import GeWeService
-from app.services.websocket_manager import WebSocketManager
+from app.services.websocket_manager import websocket_manager
 from app.services.notification_service import NotificationService
+from app.services.message_stream import webhook_stream, ai_task_stream
+from app.services.message_dedup import message_deduplicator
+from app.services.message_batcher import message_batcher
+from app.services.resolution_cache import resolution_cache
+from app.services.history_cache import session_history_cache, history_entry
+from app.services.message_archiver import message_archiver
+from app.services.message_coalescer import message_coalescer
+from app.services.session_lanes import SessionLaneExecutor
+from app.services.session_lease import session_lease
+from app.services.ai_stream import ReplyStreamPublisher
+from app.services.ai_priority import ai_priority_classifier
+from app.services.load_shedder import load_shedder
+from app.services.reply_cache import ai_reply_cache
+from app.services.faq_index import faq_service
+from app.services.context_builder import context_builder
 
 logger = logging.getLogger(__name__)
 
@@ -34,13 +52,29 @@ class ChatProcessor:
     def __init__(self):
         self.ai_service = AIService()
         self.gewe_service = GeWeService()
-        self.ws_manager = WebSocketManager()
+        self.ws_manager = websocket_manager
         self.notification_service = NotificationService()
         self.is_running = False
         
-        # 处理队列
-        self.message_queue = asyncio.Queue()
-        self.processing_tasks = []
+        # AI处理通道：按会话分片，同一会话严格有序，通道间并行
+        self.ai_lanes = SessionLaneExecutor(
+            settings.CHAT_AI_LANES,
+            name="ai_process",
+            aging_rate=settings.AI_PRIORITY_AGING_RATE,
+            max_size=settings.CHAT_AI_QUEUE_SIZE
+        )
+        load_shedder.register("ai_lanes", self.ai_lanes.qsize, settings.CHAT_AI_QUEUE_SIZE)
+        
+        # 进行中的AI回复（session_id -> 任务信息），新消息到达时可取代尚未发送的回复
+        self._inflight_replies: Dict[str, Dict[str, Any]] = {}
+        
+        # 待处理消息恢复统计
+        self.recovery_stats = {
+            "scans": 0,
+            "recovered": 0,
+            "errors": 0,
+            "last_recovered_time": None
+        }
     
     async def start(self):
         """启动消息处理服务"""
@@ -51,26 +85,49 @@ class ChatProcessor:
         self.is_running = True
         logger.info("启动聊天消息处理服务")
         
-        # 启动处理任务
-        for i in range(3):  # 启动3个并发处理任务
-            task = asyncio.create_task(self._process_message_queue())
-            self.processing_tasks.append(task)
+        # 消息按月分区写入，开始消费前确保当月及后续分区存在
+        try:
+            await message_archiver.ensure_partitions()
+        except Exception as e:
+            logger.error(f"创建消息分区失败: {str(e)}")
+        
+        # 启动AI处理通道
+        self.ai_lanes.start(self._handle_ai_job)
+        
+        # 启动解析缓存失效监听和入站消息批量写入
+        await resolution_cache.start()
+        await ai_reply_cache.start()
+        await session_lease.start()
+        if settings.CHAT_BATCH_ENABLED:
+            await message_batcher.start()
+        
+        # 连发消息合并窗口关闭后进入会话所在的处理通道
+        message_coalescer.start(self._dispatch_ai_job)
+        
+        # 启动消息流消费者（每个worker进程加入同一消费组；AI任务流按会话分片，worker之间分配分片）
+        await webhook_stream.start(self._handle_webhook_entry)
+        await ai_task_stream.start(self._handle_ai_task_entry)
         
         # 启动定期任务
-        asyncio.create_task(self._process_pending_messages())
-        asyncio.create_task(self._cleanup_old_messages())
+        asyncio.create_task(self._recover_pending_messages())
+        asyncio.create_task(self._maintain_message_partitions())
     
     async def stop(self):
         """停止消息处理服务"""
         self.is_running = False
         logger.info("停止聊天消息处理服务")
         
-        # 取消所有处理任务
-        for task in self.processing_tasks:
-            task.cancel()
+        # 停止消息流消费者，未确认的消息由其他worker认领
+        await webhook_stream.stop()
+        await ai_task_stream.stop()
+        await message_batcher.stop()
+        await message_coalescer.stop()
+        await resolution_cache.stop()
+        await ai_reply_cache.stop()
+        await session_lease.stop()
         
-        # 等待任务完成
-        await asyncio.gather(*self.processing_tasks, return_exceptions=True)
+        # 停止AI处理通道，未确认的任务由其他worker认领
+        await self.ai_lanes.stop()
     
     async def handle_incoming_message(self, callback_data: Dict[str, Any]) -> bool:
         """处理来自GeWe的消息回调"""
@@ -82,30 +139,48 @@ class ChatProcessor:
             if not message_data:
                 return False
             
-            # 查找或创建联系人和会话
-            async with get_db() as db:
-                contact, session = await self._get_or_create_contact_session(db, message_data)
-                
-                # 创建消息记录
-                message = await self._create_message_record(db, session, message_data)
-                
-                # 更新会话和联系人统计
-                session.update_last_message(message)
-                session.increment_unread()
-                contact.update_message_stats(MessageDirection.INCOMING)
-                
-                await db.commit()
-                await db.refresh(message)
+            # 重复回调在任何数据库操作之前直接丢弃
+            gewe_message_id = message_data.get("gewe_message_id")
+            app_id = message_data.get("app_id")
+            if not await message_deduplicator.claim(gewe_message_id, app_id):
+                logger.debug(f"忽略重复的GeWe消息回调: {gewe_message_id}")
+                return True
+            
+            try:
+                persisted = await self._persist_incoming_message(message_data)
+            
+            except IntegrityError:
+                # 去重标记过期或Redis不可用时，由唯一索引拦截重复消息
+                persisted = None
+            except BaseException:
+                # 包括服务停止时的取消，释放占用以便消息流重新投递
+                await asyncio.shield(message_deduplicator.release(gewe_message_id, app_id))
+                raise
+            
+            # 消息已入库（或已存在），延长去重占用
+            await message_deduplicator.confirm(gewe_message_id, app_id)
+            
+            if persisted is None:
+                # 被唯一索引跳过的重复消息
+                message_deduplicator.record_db_conflict()
+                logger.debug(f"数据库唯一索引拦截重复消息: {gewe_message_id}")
+                return True
+            
+            session, message = persisted
             
             # 推送到WebSocket
             await self._broadcast_new_message(session.id, message)
             
-            # 加入AI处理队列
+            # 加入AI处理队列（按意图、联系人标签和聊天类型预估优先级）
             if self._should_process_with_ai(message, session):
-                await self.message_queue.put({
-                    "message_id": str(message.id),
-                    "type": "ai_process"
-                })
+                priority = ai_priority_classifier.score(
+                    message.content,
+                    session.chat_type,
+                    session.contact.tags if session.contact else None
+                )
+                await self._enqueue_ai_task(
+                    str(message.id), str(session.id), priority, session.chat_type
+                )
             
             logger.info(f"消息处理完成: {message.id}")
             return True
@@ -114,6 +189,97 @@ class ChatProcessor:
             logger.error(f"处理消息回调失败: {str(e)}")
             return False
     
+    async def _persist_incoming_message(
+        self,
+        message_data: Dict[str, Any]
+    ) -> Optional[Tuple[ChatSession, ChatMessage]]:
+        """写入入站消息，返回 (会话, 消息)，重复消息返回None"""
+        if settings.CHAT_BATCH_ENABLED:
+            # 攒批写入：批量解析联系人和会话，多行INSERT，合并计数更新
+            return await message_batcher.submit(message_data)
+        
+        # 单条立即写入，与批量写入共用解析缓存和写入逻辑
+        return await message_batcher.persist(message_data)
+    
+    async def handle_webhook(self, payload: Dict[str, Any]) -> bool:
+        """处理GeWe回调（消息流消费者和消息流不可用时的进程内处理共用）"""
+        if "message" in payload or "messageId" in payload:
+            # 聊天消息回调
+            return await self.handle_incoming_message(payload)
+        
+        # 联系人变化、账号状态等其他事件
+        await self.gewe_service.process_webhook_message(payload)
+        return True
+    
+    async def _handle_webhook_entry(self, payload: Dict[str, Any], entry_id: str):
+        """消费GeWe回调消息流"""
+        if not await self.handle_webhook(payload):
+            raise RuntimeError(f"消息回调处理失败: {payload.get('messageId', entry_id)}")
+    
+    async def _handle_ai_task_entry(self, payload: Dict[str, Any], entry_id: Optional[str]):
+        """消费AI任务消息流，放入本地处理队列，处理完成后再确认"""
+        session_id = payload.get("session_id")
+        
+        # 过载时按策略推迟：消息保持待处理，租约过期后由恢复任务重新投递
+        reason = load_shedder.defer_ai_reason(
+            payload.get("chat_type"), ai_priority_classifier.level(payload.get("priority", 0))
+        )
+        if reason:
+            logger.info(f"AI处理积压，推迟消息({reason}): {payload.get('message_id')}")
+            if entry_id:
+                await ai_task_stream.ack(entry_id)
+            return
+        
+        # 处理通道已满时阻塞消费，积压留在消息流中（进入合并窗口之前等待，窗口中的任务不会无限累积）
+        await self.ai_lanes.wait_for_space()
+        
+        if not settings.CHAT_COALESCE_ENABLED or not session_id:
+            await self._dispatch_ai_job({**payload, "stream_id": entry_id})
+            return
+        
+        # 同一会话的连发消息进入合并窗口；尚未发出的进行中回复被取代，其消息并入新窗口
+        carried = self._supersede_inflight_reply(session_id)
+        await message_coalescer.add(
+            session_id, payload["message_id"], entry_id, carried, payload.get("priority", 0)
+        )
+    
+    def _supersede_inflight_reply(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """取消会话中尚未开始发送的AI回复，返回其包含的消息"""
+        inflight = self._inflight_replies.get(session_id)
+        if not inflight or inflight["sending"] or inflight["task"].done():
+            return None
+        
+        inflight["superseded"] = True
+        inflight["task"].cancel()
+        logger.info(f"会话有新消息，取代进行中的AI回复: {session_id}")
+        
+        return {
+            "message_ids": inflight["message_ids"],
+            "stream_ids": inflight["stream_ids"],
+            "priority": inflight["priority"]
+        }
+    
+    async def _enqueue_ai_task(
+        self,
+        message_id: str,
+        session_id: str,
+        priority: float = 0,
+        chat_type: Optional[ChatType] = None
+    ):
+        """投递AI处理任务，消息流不可用时直接在本进程处理"""
+        task_data = {
+            "message_id": message_id,
+            "session_id": session_id,
+            "type": "ai_process",
+            "priority": priority,
+            "chat_type": chat_type.value if chat_type else None
+        }
+        
+        # 同一会话的任务固定写入一个分片，由同一个worker合并和取代
+        entry_id = await ai_task_stream.publish(task_data, routing_key=session_id or message_id)
+        if not entry_id:
+            await self._handle_ai_task_entry(task_data, None)
+    
     def _parse_gewe_callback(self, callback_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """解析GeWe回调数据"""
         try:
@@ -161,99 +327,6 @@ class ChatProcessor:
         
         return type_mapping.get(gewe_type, MessageType.TEXT)
     
-    async def _get_or_create_contact_session(
-        self,
-        db: AsyncSession,
-        message_data: Dict[str, Any]
-    ) -> Tuple[Contact, ChatSession]:
-        """获取或创建联系人和会话"""
-        
-        # 查找微信账号
-        account_result = await db.execute(
-            select(WeChatAccount)
-            .where(WeChatAccount.gewe_app_id == message_data["app_id"])
-        )
-        account = account_result.scalar_one_or_none()
-        
-        if not account:
-            raise ValueError(f"未找到对应的微信账号: {message_data['app_id']}")
-        
-        # 确定联系人微信ID
-        contact_wxid = message_data["sender_wxid"]
-        if message_data["chat_type"] == ChatType.GROUP:
-            # 群聊时，联系人是群
-            contact_wxid = message_data["receiver_wxid"]
-        
-        # 查找或创建联系人
-        contact_result = await db.execute(
-            select(Contact)
-            .where(
-                Contact.wechat_account_id == account.id,
-                Contact.wxid == contact_wxid
-            )
-        )
-        contact = contact_result.scalar_one_or_none()
-        
-        if not contact:
-            contact = Contact(
-                organization_id=account.organization_id,
-                wechat_account_id=account.id,
-                wxid=contact_wxid,
-                nickname=message_data.get("sender_nickname") if message_data["chat_type"] == ChatType.PRIVATE else None,
-                contact_type="group" if message_data["chat_type"] == ChatType.GROUP else "friend",
-                first_contact_at=datetime.utcnow()
-            )
-            db.add(contact)
-            await db.flush()  # 获取ID但不提交
-        
-        # 查找或创建会话
-        session_result = await db.execute(
-            select(ChatSession)
-            .where(
-                ChatSession.wechat_account_id == account.id,
-                ChatSession.contact_id == contact.id
-            )
-        )
-        session = session_result.scalar_one_or_none()
-        
-        if not session:
-            session = ChatSession(
-                organization_id=account.organization_id,
-                wechat_account_id=account.id,
-                contact_id=contact.id,
-                chat_type=message_data["chat_type"],
-                session_name=contact.display_name
-            )
-            db.add(session)
-            await db.flush()
-        
-        return contact, session
-    
-    async def _create_message_record(
-        self,
-        db: AsyncSession,
-        session: ChatSession,
-        message_data: Dict[str, Any]
-    ) -> ChatMessage:
-        """创建消息记录"""
-        
-        message = ChatMessage(
-            session_id=session.id,
-            message_type=message_data["message_type"],
-            direction=MessageDirection.INCOMING,
-            content=message_data.get("content"),
-            sender_wxid=message_data["sender_wxid"],
-            sender_nickname=message_data.get("sender_nickname"),
-            media_url=message_data.get("media_url"),
-            media_type=message_data.get("media_type"),
-            gewe_message_id=message_data.get("gewe_message_id"),
-            gewe_timestamp=message_data.get("gewe_timestamp"),
-            status=MessageStatus.DELIVERED
-        )
-        
-        db.add(message)
-        return message
-    
     def _should_process_with_ai(self, message: ChatMessage, session: ChatSession) -> bool:
         """判断是否需要AI处理"""
         # 检查基本条件
@@ -292,104 +365,269 @@ class ChatProcessor:
                 }
             }
             
-            await self.ws_manager.broadcast_to_session(session_id, message_data)
+            await self.ws_manager.send_to_session(str(session_id), message_data)
             
         except Exception as e:
             logger.error(f"广播新消息失败: {str(e)}")
     
-    async def _process_message_queue(self):
-        """处理消息队列"""
-        while self.is_running:
-            try:
-                # 从队列获取消息
-                task_data = await asyncio.wait_for(
-                    self.message_queue.get(),
-                    timeout=5.0
-                )
-                
-                if task_data["type"] == "ai_process":
-                    await self._process_ai_message(task_data["message_id"])
-                
-                # 标记任务完成
-                self.message_queue.task_done()
-                
-            except asyncio.TimeoutError:
-                continue
-            except Exception as e:
-                logger.error(f"处理消息队列异常: {str(e)}")
-                await asyncio.sleep(1)
+    async def _dispatch_ai_job(self, task_data: Dict[str, Any]):
+        """按会话分派AI任务到处理通道（无会话ID时按消息ID分片）"""
+        message_ids = task_data.get("message_ids") or [task_data["message_id"]]
+        key = task_data.get("session_id") or message_ids[0]
+        priority = task_data.get("priority", 0)
+        
+        # 任务在通道中排队期间不应被恢复任务当作丢失的消息重新投递
+        await self._refresh_ai_lease(message_ids)
+        await self.ai_lanes.submit(key, task_data, priority, ai_priority_classifier.level(priority))
     
-    async def _process_ai_message(self, message_id: str):
-        """AI处理单条消息"""
+    async def _refresh_ai_lease(self, message_ids: List[str]):
+        """刷新待处理消息的AI处理租约"""
         try:
             async with get_db() as db:
-                # 获取消息和相关信息
-                message_result = await db.execute(
-                    select(ChatMessage)
-                    .options(
-                        selectinload(ChatMessage.session)
-                        .selectinload(ChatSession.contact),
-                        selectinload(ChatMessage.session)
-                        .selectinload(ChatSession.wechat_account)
+                await db.execute(
+                    update(ChatMessage)
+                    .where(
+                        ChatMessage.id.in_(message_ids),
+                        ChatMessage.ai_process_status == AIProcessStatus.PENDING
                     )
-                    .where(ChatMessage.id == message_id)
+                    .values(ai_claimed_at=datetime.utcnow())
+                    .execution_options(synchronize_session=False)
                 )
-                message = message_result.scalar_one_or_none()
-                
-                if not message or message.ai_process_status != AIProcessStatus.PENDING:
-                    return
-                
-                # 标记为处理中
-                message.mark_ai_processing()
                 await db.commit()
-                
-                session = message.session
-                contact = session.contact
-                account = session.wechat_account
-                
-                # 检查账号状态
-                if account.status != DeviceStatus.ONLINE:
-                    logger.warning(f"微信账号离线，跳过AI处理: {account.wxid}")
-                    message.mark_ai_skipped()
+        except Exception as e:
+            # 租约未刷新时最多被重复投递，认领是原子的，不会重复处理
+            logger.warning(f"刷新AI处理租约失败: {message_ids}, {str(e)}")
+    
+    async def _handle_ai_job(self, task_data: Dict[str, Any]):
+        """处理通道中的一个AI任务"""
+        completed = True
+        try:
+            if task_data["type"] == "ai_process":
+                completed = await self._run_ai_job(task_data)
+        except asyncio.CancelledError:
+            # 服务停止时不确认，由其他消费者认领重试
+            completed = False
+            raise
+        finally:
+            # 确认消息流中的任务；被取代的任务其消息流ID已转入新的合并窗口
+            stream_ids = task_data.get("stream_ids") or (
+                [task_data["stream_id"]] if task_data.get("stream_id") else []
+            )
+            if completed and stream_ids:
+                await ai_task_stream.ack(*stream_ids)
+    
+    async def _run_ai_job(self, task_data: Dict[str, Any]) -> bool:
+        """执行AI任务，返回False表示被同一会话的新消息取代"""
+        message_ids = task_data.get("message_ids") or [task_data["message_id"]]
+        session_id = task_data.get("session_id")
+        priority = task_data.get("priority", 0)
+        
+        if not session_id:
+            await self._process_ai_message(message_ids, priority)
+            return True
+        
+        # 通道只保证进程内有序，处理前获取会话租约，分片交接期间其他worker上的同会话任务在此等待
+        lease_token = await session_lease.acquire(session_id)
+        task = asyncio.create_task(self._process_ai_message(message_ids, priority))
+        inflight = {
+            "task": task,
+            "message_ids": message_ids,
+            "stream_ids": task_data.get("stream_ids") or (
+                [task_data["stream_id"]] if task_data.get("stream_id") else []
+            ),
+            "priority": priority,
+            "sending": False,
+            "superseded": False
+        }
+        self._inflight_replies[session_id] = inflight
+        
+        try:
+            await task
+            return True
+        except asyncio.CancelledError:
+            if not inflight["superseded"]:
+                raise
+            return False
+        finally:
+            if self._inflight_replies.get(session_id) is inflight:
+                del self._inflight_replies[session_id]
+            await session_lease.release(session_id, lease_token)
+    
+    def _mark_reply_sending(self, session_id: str):
+        """回复开始发送后不再允许被取代"""
+        inflight = self._inflight_replies.get(session_id)
+        if inflight:
+            inflight["sending"] = True
+    
+    async def _process_ai_message(self, message_ids: List[str], priority: float = 0):
+        """AI处理消息（同一会话合并的连发消息作为一次请求处理，priority 决定上游并发槽位的先后）"""
+        claimed_ids = []
+        try:
+            async with get_db() as db:
+                # 调用AI服务，生成过程中的增量文本实时推送给会话的WebSocket订阅者；
+                # 从认领开始的任何等待点都可能被取代，取消时需把已认领的消息恢复为待处理
+                reply_id = uuid.uuid4()
+                reply_stream = None
+                try:
+                    # 原子认领：只有仍为待处理的消息转为处理中，同一消息被重复投递时只有一个任务处理
+                    claim_result = await db.execute(
+                        update(ChatMessage)
+                        .where(
+                            ChatMessage.id.in_(message_ids),
+                            ChatMessage.ai_process_status == AIProcessStatus.PENDING
+                        )
+                        .values(
+                            ai_process_status=AIProcessStatus.PROCESSING,
+                            ai_claimed_at=datetime.utcnow()
+                        )
+                        .returning(ChatMessage.id)
+                        .execution_options(synchronize_session=False)
+                    )
+                    claimed_ids = [row.id for row in claim_result.all()]
                     await db.commit()
-                    return
-                
-                # 获取聊天历史
-                chat_history = await self._get_chat_history(db, session.id)
-                
-                # 构建AI处理上下文
-                context = {
-                    "contact_wxid": contact.wxid,
-                    "contact_nickname": contact.nickname,
-                    "account_id": str(account.id),
-                    "chat_history": chat_history,
-                    "role": "销售助手"
-                }
-                
-                # 如果有图片，添加图片URL
-                if message.media_url and message.message_type == MessageType.IMAGE:
-                    context["image_url"] = message.media_url
-                
-                # 调用AI服务
-                ai_result = await self.ai_service.process_message(
-                    user_message=message.content,
-                    context=context,
-                    workflow_id=contact.workflow_id or account.workflow_id
-                )
+                    
+                    if not claimed_ids:
+                        return
+                    
+                    # 获取认领到的消息和相关信息
+                    message_result = await db.execute(
+                        select(ChatMessage)
+                        .options(
+                            selectinload(ChatMessage.session)
+                            .selectinload(ChatSession.contact),
+                            selectinload(ChatMessage.session)
+                            .selectinload(ChatSession.wechat_account)
+                        )
+                        .where(ChatMessage.id.in_(claimed_ids))
+                        .order_by(ChatMessage.created_at)
+                    )
+                    messages = list(message_result.scalars().all())
+                    
+                    # 以最后一条消息为主，回复和分析结果记录在它上面
+                    message = messages[-1]
+                    reply_stream = ReplyStreamPublisher(self.ws_manager, message.session_id, reply_id)
+                    
+                    session = message.session
+                    contact = session.contact
+                    account = session.wechat_account
+                    
+                    # 恢复的任务入站时可能未满足AI处理条件，或会话已被人工接管
+                    if not self._should_process_with_ai(message, session):
+                        for msg in messages:
+                            msg.mark_ai_skipped()
+                        await db.commit()
+                        return
+                    
+                    # 检查账号状态
+                    if account.status != DeviceStatus.ONLINE:
+                        logger.warning(f"微信账号离线，跳过AI处理: {account.wxid}")
+                        for msg in messages:
+                            msg.mark_ai_skipped()
+                        await db.commit()
+                        return
+                    
+                    # 获取聊天历史：按token预算从新到旧装入，更早的对话以滚动摘要代替
+                    candidates = await self._get_chat_history(db, session.id, limit=session_history_cache.size)
+                    history = await context_builder.build(
+                        db, session.id, candidates, summarize=self.ai_service.summarize_conversation
+                    )
+                    
+                    # 构建AI处理上下文
+                    context = {
+                        "contact_wxid": contact.wxid,
+                        "contact_nickname": contact.nickname,
+                        "account_id": str(account.id),
+                        "organization_id": str(session.organization_id),
+                        "chat_history": history["chat_history"],
+                        "conversation_summary": history["summary"],
+                        "role": "销售助手"
+                    }
+                    
+                    # 如果有图片，添加图片URL
+                    if message.media_url and message.message_type == MessageType.IMAGE:
+                        context["image_url"] = message.media_url
+                    
+                    # 连发的多条消息合并为一次提问
+                    user_message = "\n".join(msg.content for msg in messages if msg.content)
+                    
+                    # 先检索本组织的FAQ，高置信命中时直接回复，不调用AI
+                    ai_result = None
+                    if "image_url" not in context:
+                        ai_result = await faq_service.answer(session.organization_id, user_message)
+                    if ai_result is None:
+                        ai_result = await self.ai_service.process_message(
+                            user_message=user_message,
+                            context=context,
+                            workflow_id=contact.workflow_id or account.workflow_id,
+                            on_delta=reply_stream.push,
+                            priority=priority
+                        )
+                except asyncio.CancelledError:
+                    if reply_stream:
+                        await reply_stream.abort("superseded")
+                    # 被同一会话的新消息取代，恢复为待处理，随新消息一起重新处理
+                    # （取消可能发生在当前会话的查询中途，使用新的数据库会话；
+                    # 认领提交中途被取消时结果未知，由恢复任务按处理租约回收）
+                    if not claimed_ids:
+                        raise
+                    async with get_db() as reset_db:
+                        await reset_db.execute(
+                            update(ChatMessage)
+                            .where(
+                                ChatMessage.id.in_(claimed_ids),
+                                ChatMessage.ai_process_status == AIProcessStatus.PROCESSING
+                            )
+                            .values(
+                                ai_process_status=AIProcessStatus.PENDING,
+                                ai_claimed_at=datetime.utcnow()
+                            )
+                        )
+                        await reset_db.commit()
+                    raise
+                except Exception:
+                    if reply_stream:
+                        await reply_stream.abort("failed")
+                    raise
                 
                 if ai_result["success"]:
-                    # 发送AI回复
+                    # 发送AI回复（开始发送后不再被新消息取代）
+                    self._mark_reply_sending(str(session.id))
                     response_message = await self._send_ai_response(
-                        db, session, account, contact, ai_result["response"]
+                        db, session, account, contact, ai_result["response"], message_id=reply_id
                     )
+                    await reply_stream.finish(ai_result["response"], response_message.id)
                     
                     # 更新消息处理状态
+                    for msg in messages[:-1]:
+                        msg.mark_ai_completed(response_message_id=str(response_message.id))
                     message.mark_ai_completed(
                         response_message_id=str(response_message.id),
                         processing_time=ai_result["processing_time"],
                         cost=str(ai_result["cost"])
                     )
                     
+                    if ai_result.get("first_token_time") is not None:
+                        message.extra_data = {
+                            **(message.extra_data or {}),
+                            "ai_first_token_time": ai_result["first_token_time"]
+                        }
+                    if ai_result.get("cached"):
+                        message.extra_data = {**(message.extra_data or {}), "ai_reply_cached": True}
+                    if ai_result.get("faq_id"):
+                        message.extra_data = {
+                            **(message.extra_data or {}),
+                            "ai_faq_id": ai_result["faq_id"],
+                            "ai_faq_score": ai_result["faq_score"]
+                        }
+                        await db.execute(
+                            update(FAQEntry)
+                            .where(FAQEntry.id == ai_result["faq_id"])
+                            .values(
+                                hit_count=FAQEntry.hit_count + 1,
+                                last_hit_at=datetime.utcnow()
+                            )
+                        )
+                    
                     # 更新分析结果
                     message.intent_classification = ai_result.get("intent")
                     message.sentiment_score = ai_result.get("sentiment")
@@ -401,27 +639,43 @@ class ChatProcessor:
                     logger.info(f"AI处理成功: {message.id} -> {response_message.id}")
                     
                 else:
-                    message.mark_ai_failed()
+                    response_message = None
+                    await reply_stream.abort("failed")
+                    for msg in messages:
+                        msg.mark_ai_failed()
                     logger.error(f"AI处理失败: {message.id}")
                 
+                # 提交前记录缓存条目，提交后再同步到会话消息缓存
+                updated_entries = [history_entry(msg) for msg in messages]
+                response_entry = history_entry(response_message) if response_message else None
+                
                 await db.commit()
                 
+                for entry in updated_entries:
+                    await session_history_cache.update(session.id, entry["id"], entry)
+                if response_entry:
+                    await session_history_cache.append(session.id, response_entry)
+                
         except AIServiceError as e:
-            logger.error(f"AI服务错误: {message_id}, {str(e)}")
+            logger.error(f"AI服务错误: {message_ids}, {str(e)}")
+            if not claimed_ids:
+                return
             async with get_db() as db:
                 await db.execute(
                     update(ChatMessage)
-                    .where(ChatMessage.id == message_id)
+                    .where(ChatMessage.id.in_(claimed_ids))
                     .values(ai_process_status=AIProcessStatus.FAILED)
                 )
                 await db.commit()
                 
         except Exception as e:
-            logger.error(f"AI消息处理异常: {message_id}, {str(e)}")
+            logger.error(f"AI消息处理异常: {message_ids}, {str(e)}")
+            if not claimed_ids:
+                return
             async with get_db() as db:
                 await db.execute(
                     update(ChatMessage)
-                    .where(ChatMessage.id == message_id)
+                    .where(ChatMessage.id.in_(claimed_ids))
                     .values(ai_process_status=AIProcessStatus.FAILED)
                 )
                 await db.commit()
@@ -432,26 +686,30 @@ class ChatProcessor:
         session_id: str,
         limit: int = 10
     ) -> List[Dict[str, Any]]:
-        """获取聊天历史"""
+        """获取聊天历史（优先读取会话消息缓存，未命中时查询数据库并回填）"""
         try:
-            result = await db.execute(
-                select(ChatMessage)
-                .where(ChatMessage.session_id == session_id)
-                .order_by(ChatMessage.created_at.desc())
-                .limit(limit)
-            )
-            messages = result.scalars().all()
+            entries = await session_history_cache.get_recent(session_id, limit)
             
-            history = []
-            for msg in reversed(messages):  # 按时间正序
-                history.append({
-                    "direction": msg.direction.value,
-                    "content": msg.content,
-                    "message_type": msg.message_type.value,
-                    "created_at": msg.created_at.isoformat()
-                })
+            if entries is None:
+                result = await db.execute(
+                    select(ChatMessage)
+                    .where(ChatMessage.session_id == session_id)
+                    .order_by(ChatMessage.created_at.desc())
+                    .limit(max(limit, session_history_cache.size))
+                )
+                entries = [history_entry(msg) for msg in reversed(result.scalars().all())]  # 按时间正序
+                await session_history_cache.seed(session_id, entries)
+                entries = entries[-limit:]
             
-            return history
+            return [
+                {
+                    "direction": entry["direction"],
+                    "content": entry["content"],
+                    "message_type": entry["message_type"],
+                    "created_at": entry["created_at"]
+                }
+                for entry in entries
+            ]
             
         except Exception as e:
             logger.error(f"获取聊天历史失败: {str(e)}")
@@ -463,19 +721,22 @@ class ChatProcessor:
         session: ChatSession,
         account: WeChatAccount,
         contact: Contact,
-        response_text: str
+        response_text: str,
+        message_id: Optional[uuid.UUID] = None
     ) -> ChatMessage:
-        """发送AI回复消息"""
+        """发送AI回复消息（message_id 与流式推送的回复ID一致）"""
         
         # 创建回复消息记录
         response_message = ChatMessage(
+            id=message_id or uuid.uuid4(),
             session_id=session.id,
             message_type=MessageType.TEXT,
             direction=MessageDirection.OUTGOING,
             content=response_text,
             sender_wxid=account.wxid,
             sender_nickname=account.nickname,
-            status=MessageStatus.PENDING
+            status=MessageStatus.PENDING,
+            created_at=datetime.utcnow()
         )
         
         db.add(response_message)
@@ -507,57 +768,119 @@ class ChatProcessor:
         
         return response_message
     
-    async def _process_pending_messages(self):
-        """处理待处理的消息（定期任务）"""
+    async def _recover_pending_messages(self):
+        """恢复丢失的待处理消息（定期任务，多worker并发认领互不重复）"""
         while self.is_running:
             try:
-                await asyncio.sleep(60)  # 1分钟检查一次
+                # AI处理积压时不再认领，避免把推迟的消息立即投回
+                if load_shedder.ai_overloaded():
+                    load_shedder.record_recovery_paused()
+                    await asyncio.sleep(settings.CHAT_RECOVERY_INTERVAL)
+                    continue
                 
-                async with get_db() as db:
-                    # 查询待处理的消息
-                    result = await db.execute(
-                        select(ChatMessage)
-                        .where(
-                            ChatMessage.ai_process_status == AIProcessStatus.PENDING,
-                            ChatMessage.direction == MessageDirection.INCOMING,
-                            ChatMessage.message_type == MessageType.TEXT,
-                            ChatMessage.created_at > datetime.utcnow() - timedelta(hours=1)  # 只处理1小时内的消息
-                        )
-                        .limit(50)
-                    )
-                    pending_messages = result.scalars().all()
-                    
-                    for message in pending_messages:
-                        await self.message_queue.put({
-                            "message_id": str(message.id),
-                            "type": "ai_process"
-                        })
+                claimed = await self._claim_stale_pending_messages()
+                
+                # 按入站时相同的规则重新计算优先级，群聊推迟策略同样适用
+                for message_id, session_id, content, chat_type, tags in claimed:
+                    priority = ai_priority_classifier.score(content, chat_type, tags)
+                    await self._enqueue_ai_task(str(message_id), str(session_id), priority, chat_type)
+                
+                if claimed:
+                    self.recovery_stats["recovered"] += len(claimed)
+                    self.recovery_stats["last_recovered_time"] = datetime.utcnow()
+                    logger.info(f"恢复待处理消息: {len(claimed)} 条")
                 
+                # 认领满一批说明还有积压，立即继续
+                if len(claimed) >= settings.CHAT_RECOVERY_BATCH_SIZE:
+                    continue
+                
+            except asyncio.CancelledError:
+                break
             except Exception as e:
-                logger.error(f"处理待处理消息异常: {str(e)}")
+                self.recovery_stats["errors"] += 1
+                logger.error(f"恢复待处理消息异常: {str(e)}")
+            
+            await asyncio.sleep(settings.CHAT_RECOVERY_INTERVAL)
     
-    async def _cleanup_old_messages(self):
-        """清理旧消息（定期任务）"""
+    async def _claim_stale_pending_messages(self) -> List[Tuple[Any, Any, Optional[str], Optional[ChatType], Optional[List[str]]]]:
+        """
+        认领租约过期的待处理消息，返回 [(消息ID, 会话ID, 内容, 聊天类型, 联系人标签)]
+        FOR UPDATE SKIP LOCKED 保证每条消息只被一个worker认领，认领后刷新租约；
+        处理中超过处理租约的消息（worker崩溃或认领提交中途被取消）恢复为待处理一并认领
+        """
+        now = datetime.utcnow()
+        stale = (
+            select(ChatMessage.id)
+            .where(
+                ChatMessage.direction == MessageDirection.INCOMING,
+                ChatMessage.message_type == MessageType.TEXT,
+                # 过载时推迟的消息在积压消退前不会被恢复，时间窗需覆盖推迟时长
+                ChatMessage.created_at > now - timedelta(seconds=settings.CHAT_RECOVERY_MAX_AGE),
+                or_(
+                    and_(
+                        ChatMessage.ai_process_status == AIProcessStatus.PENDING,
+                        or_(
+                            ChatMessage.ai_claimed_at.is_(None),
+                            ChatMessage.ai_claimed_at < now - timedelta(seconds=settings.CHAT_RECOVERY_LEASE)
+                        )
+                    ),
+                    and_(
+                        ChatMessage.ai_process_status == AIProcessStatus.PROCESSING,
+                        ChatMessage.ai_claimed_at < now - timedelta(seconds=settings.CHAT_PROCESSING_LEASE)
+                    )
+                )
+            )
+            .order_by(ChatMessage.created_at)
+            .limit(settings.CHAT_RECOVERY_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        
+        async with get_db() as db:
+            result = await db.execute(
+                update(ChatMessage)
+                .where(ChatMessage.id.in_(stale.scalar_subquery()))
+                .values(ai_process_status=AIProcessStatus.PENDING, ai_claimed_at=now)
+                .returning(ChatMessage.id, ChatMessage.session_id)
+                .execution_options(synchronize_session=False)
+            )
+            claimed_ids = [row.id for row in result.all()]
+            await db.commit()
+            
+            rows = []
+            if claimed_ids:
+                # 计算优先级所需的消息内容、聊天类型和联系人标签
+                detail = await db.execute(
+                    select(
+                        ChatMessage.id,
+                        ChatMessage.session_id,
+                        ChatMessage.content,
+                        ChatSession.chat_type,
+                        Contact.tags
+                    )
+                    .join(ChatSession, ChatMessage.session_id == ChatSession.id)
+                    .outerjoin(Contact, ChatSession.contact_id == Contact.id)
+                    .where(ChatMessage.id.in_(claimed_ids))
+                    .order_by(ChatMessage.created_at)
+                )
+                rows = [tuple(row) for row in detail.all()]
+        
+        self.recovery_stats["scans"] += 1
+        return rows
+    
+    async def _maintain_message_partitions(self):
+        """维护消息分区并归档过期分区（定期任务）"""
         while self.is_running:
             try:
-                # 每天清理一次
-                await asyncio.sleep(24 * 60 * 60)
-                
-                async with get_db() as db:
-                    # 删除30天前的消息（可配置）
-                    cutoff_date = datetime.utcnow() - timedelta(days=30)
-                    
-                    await db.execute(
-                        update(ChatMessage)
-                        .where(ChatMessage.created_at < cutoff_date)
-                        .values(is_archived=True)  # 软删除，标记为归档
-                    )
-                    
-                    await db.commit()
-                    logger.info("旧消息清理完成")
+                # 过期分区整体分离导出后删除，不再逐行更新在线表
+                await message_archiver.run_maintenance()
+                logger.info("消息分区维护完成")
                 
+            except asyncio.CancelledError:
+                break
             except Exception as e:
-                logger.error(f"清理旧消息异常: {str(e)}")
+                logger.error(f"消息分区维护异常: {str(e)}")
+            
+            await asyncio.sleep(settings.CHAT_ARCHIVE_INTERVAL)
     
     async def manual_takeover(self, session_id: str, user_id: str) -> bool:
         """人工接管会话"""
@@ -575,6 +898,9 @@ class ChatProcessor:
                 )
                 await db.commit()
                 
+                # 会话的自动回复开关已变化
+                await resolution_cache.invalidate_session(session_id)
+                
                 # 发送通知
                 await self.notification_service.send_takeover_notification(
                     session_id=session_id,
@@ -602,6 +928,7 @@ class ChatProcessor:
                     )
                 )
                 await db.commit()
+                await resolution_cache.invalidate_session(session_id)
                 
                 logger.info(f"恢复AI模式: {session_id} by user {user_id}")
                 return True
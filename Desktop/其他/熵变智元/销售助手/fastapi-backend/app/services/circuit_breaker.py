@@ -0,0 +1,276 @@
+"""
+熔断器
+按 上游 + 接口 统计最近一段时间的错误率和慢调用比例，超过阈值时熔断（OPEN），
+熔断期间请求立即失败，不再等待完整的超时；冷却后进入半开状态（HALF_OPEN）放行少量探测请求，
+探测全部成功才恢复（CLOSED），否则重新熔断
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from enum import Enum
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitState(str, Enum):
+    """熔断状态"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+# 计为失败的异常（上游不可达或超时）
+FAILURE_EXCEPTIONS = (httpx.TimeoutException, httpx.NetworkError, asyncio.TimeoutError)
+
+
+class CircuitOpenError(Exception):
+    """熔断中，请求被拒绝"""
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"{name} 熔断中，{retry_after:.0f}秒后重试")
+
+
+class BreakerCall:
+    """一次受熔断器保护的调用，退出时按结果更新熔断器"""
+    
+    def __init__(self, breaker: "CircuitBreaker"):
+        self.breaker = breaker
+        self.status_code: Optional[int] = None
+        self.failed: Optional[bool] = None
+        self._probe = False
+        self._started_at = 0.0
+    
+    def record(self, status_code: int, failed: Optional[bool] = None) -> None:
+        """记录响应状态码，failed 为空时 5xx 和 429 计为失败"""
+        self.status_code = status_code
+        self.failed = failed
+    
+    async def __aenter__(self) -> "BreakerCall":
+        self._probe = self.breaker.acquire()
+        self._started_at = time.monotonic()
+        return self
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        latency = time.monotonic() - self._started_at
+        
+        if isinstance(exc_val, FAILURE_EXCEPTIONS):
+            failed = True
+        elif exc_val is None or (self.status_code is not None and not isinstance(exc_val, asyncio.CancelledError)):
+            # 已收到响应时按状态码判断（调用方可能在记录后抛出业务异常）
+            failed = self.failed
+            if failed is None:
+                failed = self.status_code is not None and (self.status_code >= 500 or self.status_code == 429)
+        else:
+            # 取消（如对冲请求落败）和本地异常不反映上游健康状况
+            self.breaker.release_probe(self._probe)
+            return False
+        
+        self.breaker.record(latency, failed, self._probe)
+        return False
+
+
+class CircuitBreaker:
+    """单个上游接口的熔断器"""
+    
+    def __init__(self, upstream: str, endpoint: str):
+        self.upstream = upstream
+        self.endpoint = endpoint
+        self.name = f"{upstream}:{endpoint}"
+        self.enabled = settings.CIRCUIT_BREAKER_ENABLED
+        self.window = settings.CIRCUIT_BREAKER_WINDOW
+        self.min_requests = settings.CIRCUIT_BREAKER_MIN_REQUESTS
+        self.failure_rate = settings.CIRCUIT_BREAKER_FAILURE_RATE
+        self.slow_rate = settings.CIRCUIT_BREAKER_SLOW_RATE
+        self.slow_call_seconds = settings.CIRCUIT_BREAKER_SLOW_CALL_SECONDS.get(
+            upstream, settings.CIRCUIT_BREAKER_SLOW_CALL_SECONDS.get("default", 30.0)
+        )
+        self.open_seconds = settings.CIRCUIT_BREAKER_OPEN_SECONDS
+        self.half_open_probes = settings.CIRCUIT_BREAKER_HALF_OPEN_PROBES
+        
+        self.state = CircuitState.CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        
+        # 窗口内的调用结果 (完成时间, 是否失败, 是否慢调用)，失败和慢调用数增量维护
+        self._outcomes: deque = deque()
+        self._failures = 0
+        self._slow_calls = 0
+        
+        # 统计信息
+        self.stats = {
+            "requests": 0,
+            "failures": 0,
+            "slow_calls": 0,
+            "rejected": 0,
+            "opened": 0,
+            "recovered": 0,
+            "last_opened_time": None,
+            "last_open_reason": None
+        }
+    
+    def guard(self) -> BreakerCall:
+        """受保护的调用（async with 使用），熔断中时抛出 CircuitOpenError"""
+        return BreakerCall(self)
+    
+    def retry_after(self) -> float:
+        """距离允许探测还有多少秒"""
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+    
+    def check(self):
+        """快速检查，熔断冷却期内直接拒绝（排队等待并发槽位之前调用）"""
+        if self.enabled and self.state == CircuitState.OPEN and self.retry_after() > 0:
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(self.name, self.retry_after())
+    
+    def acquire(self) -> bool:
+        """放行一次调用，返回是否为半开探测"""
+        if not self.enabled:
+            return False
+        
+        if self.state == CircuitState.OPEN:
+            self.check()
+            self._transition(CircuitState.HALF_OPEN)
+        
+        if self.state == CircuitState.HALF_OPEN:
+            if self._probes_in_flight >= self.half_open_probes:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(self.name, 0.0)
+            self._probes_in_flight += 1
+            return True
+        
+        return False
+    
+    def release_probe(self, probe: bool):
+        """探测请求未得出结果（被取消等）"""
+        if probe and self.state == CircuitState.HALF_OPEN:
+            self._probes_in_flight -= 1
+    
+    def record(self, latency: float, failed: bool, probe: bool = False):
+        """记录调用结果并判断是否熔断"""
+        if not self.enabled:
+            return
+        
+        slow = latency >= self.slow_call_seconds
+        self.stats["requests"] += 1
+        if failed:
+            self.stats["failures"] += 1
+        if slow:
+            self.stats["slow_calls"] += 1
+        
+        if self.state == CircuitState.HALF_OPEN:
+            # 熔断前发出的请求在半开期间返回，不作为探测结果
+            if not probe:
+                return
+            self._probes_in_flight -= 1
+            if failed or slow:
+                self._open("半开探测失败")
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_probes:
+                self._transition(CircuitState.CLOSED)
+                self.stats["recovered"] += 1
+            return
+        
+        if self.state == CircuitState.OPEN:
+            return
+        
+        now = time.monotonic()
+        self._outcomes.append((now, failed, slow))
+        self._failures += failed
+        self._slow_calls += slow
+        
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            _, old_failed, old_slow = self._outcomes.popleft()
+            self._failures -= old_failed
+            self._slow_calls -= old_slow
+        
+        total = len(self._outcomes)
+        if total < self.min_requests:
+            return
+        
+        if self._failures / total >= self.failure_rate:
+            self._open(f"错误率 {self._failures}/{total}")
+        elif self._slow_calls / total >= self.slow_rate:
+            self._open(f"慢调用 {self._slow_calls}/{total}")
+    
+    def _open(self, reason: str):
+        """熔断"""
+        self._transition(CircuitState.OPEN)
+        self._opened_at = time.monotonic()
+        self.stats["opened"] += 1
+        self.stats["last_opened_time"] = datetime.utcnow()
+        self.stats["last_open_reason"] = reason
+        logger.warning(f"熔断器打开: {self.name}, {reason}, {self.open_seconds}秒后探测")
+    
+    def _transition(self, state: CircuitState):
+        """切换状态并重置对应的计数"""
+        if state == self.state:
+            return
+        
+        if state == CircuitState.HALF_OPEN:
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+        elif state == CircuitState.CLOSED:
+            self._outcomes.clear()
+            self._failures = 0
+            self._slow_calls = 0
+            logger.info(f"熔断器恢复: {self.name}")
+        
+        self.state = state
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        total = len(self._outcomes)
+        return {
+            **self.stats,
+            "state": self.state.value,
+            "window_requests": total,
+            "window_failure_rate": round(self._failures / total, 4) if total else 0,
+            "window_slow_rate": round(self._slow_calls / total, 4) if total else 0,
+            "retry_after": round(self.retry_after(), 1) if self.state == CircuitState.OPEN else None
+        }
+
+
+class CircuitBreakerRegistry:
+    """按 上游 + 接口 管理熔断器"""
+    
+    def __init__(self):
+        self.breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+    
+    def get(self, upstream: str, endpoint: str) -> CircuitBreaker:
+        """获取接口的熔断器（不含查询参数）"""
+        key = (upstream, endpoint.split("?", 1)[0])
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers[key] = CircuitBreaker(*key)
+        return breaker
+    
+    def open_circuits(self, upstream: Optional[str] = None) -> List[str]:
+        """处于熔断或半开状态的接口"""
+        return [
+            breaker.endpoint if upstream else breaker.name
+            for (name, _), breaker in self.breakers.items()
+            if (upstream is None or name == upstream) and breaker.state != CircuitState.CLOSED
+        ]
+    
+    def get_stats(self, upstream: Optional[str] = None) -> Dict[str, Any]:
+        """获取统计信息（按上游分组）"""
+        upstreams: Dict[str, Dict[str, Any]] = {}
+        for (name, endpoint), breaker in self.breakers.items():
+            if upstream is None or name == upstream:
+                upstreams.setdefault(name, {})[endpoint] = breaker.get_stats()
+        return upstreams.get(upstream, {}) if upstream else upstreams
+
+
+# 全局熔断器实例
+circuit_breakers = CircuitBreakerRegistry()
@@ -0,0 +1,255 @@
+"""
+AI上下文构建
+聊天历史从新到旧按token预算装入，而不是固定取最近N条：短消息多装、长消息少装，每次请求的输入token可预期；
+窗口之外更早的对话由会话的滚动摘要（ConversationSummary）代替，
+窗口外未摘要的消息积累到一定数量时在后台把它们增量合并进摘要
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.database import get_db
+from app.models.chat import ChatMessage, ConversationSummary
+from app.services.history_cache import history_entry
+from app.services.token_estimator import token_estimator
+
+logger = logging.getLogger(__name__)
+
+
+# 摘要在聊天历史文本中的前缀
+SUMMARY_PREFIX = "历史摘要: "
+
+# 摘要生成函数：(已有摘要, 新的聊天记录行) -> 新摘要
+Summarizer = Callable[[Optional[str], List[str]], Awaitable[str]]
+
+
+def format_history_line(message: Dict[str, Any]) -> Optional[str]:
+    """聊天记录格式化为一行文本（无文本内容的消息返回None）"""
+    content = message.get("content")
+    if not content:
+        return None
+    role = "用户" if message.get("direction") == "incoming" else "我"
+    return f"{role}({message.get('created_at', '')}): {content}"
+
+
+def fit_history(text: str, max_tokens: int) -> str:
+    """裁剪聊天历史文本，从最新一行往前保留不超过 max_tokens 的部分"""
+    kept: List[str] = []
+    used = 0
+    for line in reversed(text.split("\n")):
+        tokens = token_estimator.estimate(line) + 1
+        if used + tokens > max_tokens:
+            break
+        kept.append(line)
+        used += tokens
+    return "\n".join(reversed(kept))
+
+
+def _timestamp(value: Any) -> Optional[datetime]:
+    """统一为不带时区的UTC时间，便于比较缓存条目和数据库中的时间"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class ConversationContextBuilder:
+    """按token预算构建聊天上下文"""
+    
+    def __init__(self):
+        self.history_tokens = settings.AI_CONTEXT_HISTORY_TOKENS
+        self.summary_enabled = settings.AI_CONTEXT_SUMMARY_ENABLED
+        self.summary_tokens = settings.AI_CONTEXT_SUMMARY_TOKENS
+        self.summary_every = settings.AI_CONTEXT_SUMMARY_EVERY
+        self.summary_max_messages = settings.AI_CONTEXT_SUMMARY_MAX_MESSAGES
+        
+        # 正在后台更新摘要的会话
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        
+        # 统计信息
+        self.stats = {
+            "builds": 0,
+            "packed_messages": 0,
+            "dropped_messages": 0,
+            "total_history_tokens": 0,
+            "summary_used": 0,
+            "summary_refreshes": 0,
+            "summarized_messages": 0,
+            "errors": 0,
+            "last_refresh_time": None
+        }
+    
+    async def build(
+        self,
+        db: AsyncSession,
+        session_id: Any,
+        entries: List[Dict[str, Any]],
+        summarize: Optional[Summarizer] = None
+    ) -> Dict[str, Any]:
+        """
+        从候选消息（按时间正序）中装入聊天历史
+        返回 chat_history（按时间正序）、summary（滚动摘要文本）和 history_tokens（历史部分的估算token数）
+        传入 summarize 时，窗口外未摘要的消息足够多则在后台更新摘要
+        """
+        summary = await self._load_summary(db, session_id) if self.summary_enabled else None
+        summary_text = None
+        summarized_until = None
+        budget = self.history_tokens
+        
+        if summary is not None:
+            summary_text = self._clip(summary.summary_content)
+            summarized_until = _timestamp(summary.summary_date)
+            budget -= token_estimator.estimate(SUMMARY_PREFIX + summary_text) + 1
+            self.stats["summary_used"] += 1
+        
+        # 从最新的消息往前装入，已被摘要覆盖的消息不再重复发送
+        packed: List[Dict[str, Any]] = []
+        used = 0
+        index = len(entries)
+        while index > 0:
+            entry = entries[index - 1]
+            created_at = _timestamp(entry.get("created_at"))
+            if summarized_until and created_at and created_at <= summarized_until:
+                break
+            
+            line = format_history_line(entry)
+            if line:
+                tokens = token_estimator.estimate(line) + 1
+                if used + tokens > budget:
+                    break
+                used += tokens
+                packed.append(entry)
+            index -= 1
+        packed.reverse()
+        
+        # 候选中被挤出窗口且未被摘要覆盖的消息
+        dropped = [
+            entry for entry in entries[:index]
+            if not summarized_until
+            or (_timestamp(entry.get("created_at")) or datetime.min) > summarized_until
+        ]
+        
+        self.stats["builds"] += 1
+        self.stats["packed_messages"] += len(packed)
+        self.stats["dropped_messages"] += len(dropped)
+        self.stats["total_history_tokens"] += used
+        
+        if summarize and self.summary_enabled and len(dropped) >= self.summary_every:
+            oldest_packed = _timestamp(packed[0].get("created_at")) if packed else None
+            self._schedule_refresh(str(session_id), oldest_packed, summarize)
+        
+        return {
+            "chat_history": packed,
+            "summary": summary_text,
+            "history_tokens": used + (self.history_tokens - budget)
+        }
+    
+    def _clip(self, text: str) -> str:
+        """摘要超过预算时截断"""
+        tokens = token_estimator.estimate(text)
+        if tokens <= self.summary_tokens:
+            return text
+        return text[:max(1, len(text) * self.summary_tokens // tokens)]
+    
+    async def _load_summary(self, db: AsyncSession, session_id: Any) -> Optional[ConversationSummary]:
+        """
+        会话最新的滚动摘要
+        在SAVEPOINT中读取：查询失败时只回滚到保存点，调用方事务中后续的写入和提交不受影响
+        """
+        try:
+            async with db.begin_nested():
+                result = await db.execute(
+                    select(ConversationSummary)
+                    .where(ConversationSummary.session_id == session_id)
+                    .order_by(ConversationSummary.summary_date.desc())
+                    .limit(1)
+                )
+                return result.scalar_one_or_none()
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"读取会话摘要失败: {session_id}, {str(e)}")
+            return None
+    
+    def _schedule_refresh(self, session_id: str, until: Optional[datetime], summarize: Summarizer):
+        """在后台更新会话摘要（同一会话同时只有一个更新任务）"""
+        if session_id in self._refreshing:
+            return
+        
+        task = asyncio.create_task(self._refresh_summary(session_id, until, summarize))
+        self._refreshing[session_id] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(session_id, None))
+    
+    async def _refresh_summary(self, session_id: str, until: Optional[datetime], summarize: Summarizer):
+        """把摘要之后、窗口之前的消息合并进摘要"""
+        try:
+            async with get_db() as db:
+                summary = await self._load_summary(db, session_id)
+                summarized_until = _timestamp(summary.summary_date) if summary else None
+                
+                query = select(ChatMessage).where(ChatMessage.session_id == session_id)
+                if summarized_until:
+                    query = query.where(ChatMessage.created_at > summarized_until)
+                if until:
+                    query = query.where(ChatMessage.created_at < until)
+                result = await db.execute(
+                    query.order_by(ChatMessage.created_at).limit(self.summary_max_messages)
+                )
+                messages = result.scalars().all()
+                
+                lines = [line for line in (format_history_line(history_entry(msg)) for msg in messages) if line]
+                if not lines:
+                    return
+                
+                content = await summarize(summary.summary_content if summary else None, lines)
+                if not content:
+                    return
+                
+                last_message_at = messages[-1].created_at
+                if summary is not None:
+                    summary.summary_content = content
+                    summary.summary_date = last_message_at
+                    summary.message_count = (summary.message_count or 0) + len(messages)
+                else:
+                    db.add(ConversationSummary(
+                        session_id=session_id,
+                        summary_date=last_message_at,
+                        message_count=len(messages),
+                        summary_content=content
+                    ))
+                await db.commit()
+            
+            self.stats["summary_refreshes"] += 1
+            self.stats["summarized_messages"] += len(messages)
+            self.stats["last_refresh_time"] = datetime.utcnow()
+            logger.info(f"会话摘要已更新: {session_id}, 新增 {len(messages)} 条消息")
+        
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"更新会话摘要失败: {session_id}, {str(e)}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        builds = self.stats["builds"]
+        return {
+            **self.stats,
+            "history_token_budget": self.history_tokens,
+            "avg_history_tokens": round(self.stats["total_history_tokens"] / builds, 2) if builds else 0,
+            "avg_packed_messages": round(self.stats["packed_messages"] / builds, 2) if builds else 0,
+            "refreshing": len(self._refreshing)
+        }
+
+
+# 全局上下文构建实例
+context_builder = ConversationContextBuilder()
@@ -0,0 +1,292 @@
+"""
+本地FAQ检索
+按组织把常见问题语料构建为字符n-gram TF-IDF索引（倒排表 + NumPy累加打分，不依赖外部服务），
+AI处理前先检索：最佳匹配的余弦相似度超过阈值且与次优答案拉开差距时直接回复，否则交给AI工作流
+"""
+
+import asyncio
+import logging
+import math
+import re
+import time
+import unicodedata
+from collections import Counter
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from app.core.config import settings
+from app.core.database import get_db
+from app.core.redis import redis_client
+from app.models.chat import FAQEntry
+from app.services.ai_priority import detect_intent
+
+logger = logging.getLogger(__name__)
+
+
+# 标点、空白和符号不参与匹配
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def char_ngrams(text: str, min_n: int, max_n: int) -> List[str]:
+    """归一化后切分为字符n-gram（中文无需分词）"""
+    text = _NON_WORD.sub("", unicodedata.normalize("NFKC", text or "").lower())
+    grams = []
+    for n in range(min_n, max_n + 1):
+        grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+class FAQIndex:
+    """一个组织的FAQ TF-IDF索引"""
+    
+    def __init__(self, entries: List[Dict[str, Any]], min_n: int = 1, max_n: int = 3):
+        self.entries = entries
+        self.min_n = min_n
+        self.max_n = max_n
+        
+        # 每个问法是一篇文档，doc_entry 记录文档所属的FAQ条目
+        doc_terms: List[Counter] = []
+        doc_entry: List[int] = []
+        for entry_index, entry in enumerate(entries):
+            for question in entry["questions"]:
+                terms = Counter(char_ngrams(question, min_n, max_n))
+                if terms:
+                    doc_terms.append(terms)
+                    doc_entry.append(entry_index)
+        
+        self.doc_count = len(doc_terms)
+        self.doc_entry = np.array(doc_entry, dtype=np.int32)
+        
+        document_frequency: Counter = Counter()
+        for terms in doc_terms:
+            document_frequency.update(terms.keys())
+        
+        self.idf = {
+            term: math.log((1 + self.doc_count) / (1 + df)) + 1.0
+            for term, df in document_frequency.items()
+        }
+        # 语料中没有的n-gram按最稀有处理，计入查询向量的模长
+        self.unseen_idf = math.log(1 + self.doc_count) + 1.0
+        
+        # 倒排表：term -> (文档下标, 归一化后的权重)
+        postings: Dict[str, Tuple[List[int], List[float]]] = {}
+        for doc_index, terms in enumerate(doc_terms):
+            weights = {term: (1 + math.log(tf)) * self.idf[term] for term, tf in terms.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values()))
+            for term, weight in weights.items():
+                docs, values = postings.setdefault(term, ([], []))
+                docs.append(doc_index)
+                values.append(weight / norm)
+        
+        self.postings = {
+            term: (np.array(docs, dtype=np.int32), np.array(values, dtype=np.float32))
+            for term, (docs, values) in postings.items()
+        }
+    
+    def search(self, text: str) -> Optional[Tuple[int, float, float]]:
+        """检索最相似的条目，返回 (条目下标, 相似度, 次优条目的相似度)"""
+        if not self.doc_count:
+            return None
+        
+        terms = Counter(char_ngrams(text, self.min_n, self.max_n))
+        if not terms:
+            return None
+        
+        weights = {
+            term: (1 + math.log(tf)) * self.idf.get(term, self.unseen_idf)
+            for term, tf in terms.items()
+        }
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        for term, weight in weights.items():
+            posting = self.postings.get(term)
+            if posting is not None:
+                scores[posting[0]] += posting[1] * (weight / norm)
+        
+        # 同一条目的多个问法取最高分
+        entry_scores = np.zeros(len(self.entries), dtype=np.float32)
+        np.maximum.at(entry_scores, self.doc_entry, scores)
+        
+        best = int(np.argmax(entry_scores))
+        best_score = float(entry_scores[best])
+        entry_scores[best] = 0.0
+        second_score = float(entry_scores.max()) if len(entry_scores) > 1 else 0.0
+        return best, best_score, second_score
+
+
+class FAQService:
+    """本地FAQ检索服务"""
+    
+    def __init__(self):
+        self.enabled = settings.FAQ_ENABLED
+        self.threshold = settings.FAQ_MATCH_THRESHOLD
+        self.margin = settings.FAQ_MATCH_MARGIN
+        self.max_input_chars = settings.FAQ_MAX_INPUT_CHARS
+        self.check_interval = settings.FAQ_INDEX_CHECK_INTERVAL
+        self.version_prefix = settings.FAQ_INDEX_VERSION_PREFIX
+        
+        # organization_id -> {"index", "version", "checked_at"}
+        self._indices: Dict[str, Dict[str, Any]] = {}
+        self._build_locks: Dict[str, asyncio.Lock] = {}
+        
+        # 统计信息
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "ambiguous": 0,
+            "builds": 0,
+            "errors": 0,
+            "total_match_time": 0.0,
+            "last_build_time": None
+        }
+    
+    async def answer(self, organization_id: Any, user_message: str) -> Optional[Dict[str, Any]]:
+        """
+        检索FAQ，置信度足够时返回与AI处理结果结构相同的回复，否则返回None
+        """
+        if not self.enabled or not organization_id or not user_message:
+            return None
+        if len(user_message) > self.max_input_chars:
+            return None
+        
+        started = time.monotonic()
+        try:
+            index = await self._get_index(str(organization_id))
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"加载FAQ索引失败: {organization_id}, {str(e)}")
+            return None
+        
+        if index is None:
+            return None
+        
+        self.stats["lookups"] += 1
+        result = index.search(user_message)
+        elapsed = time.monotonic() - started
+        self.stats["total_match_time"] += elapsed
+        
+        if result is None or result[1] < self.threshold:
+            self.stats["misses"] += 1
+            return None
+        
+        entry_index, score, second_score = result
+        if score - second_score < self.margin:
+            # 两个答案都很像，交给AI判断
+            self.stats["ambiguous"] += 1
+            return None
+        
+        self.stats["hits"] += 1
+        entry = index.entries[entry_index]
+        processing_time = int(elapsed * 1000)
+        logger.info(f"FAQ命中: {entry['id']}, 相似度 {score:.3f}, 耗时 {processing_time}ms")
+        
+        return {
+            "success": True,
+            "response": entry["answer"],
+            "processing_time": processing_time,
+            "first_token_time": processing_time,
+            "tokens": {"input": 0, "output": 0, "total": 0},
+            "cost": 0.0,
+            "model": "faq",
+            "workflow_id": None,
+            "intent": detect_intent(user_message, organization_id),
+            "sentiment": None,
+            "keywords": [],
+            "faq_id": entry["id"],
+            "faq_score": round(score, 4)
+        }
+    
+    async def invalidate(self, organization_id: Any):
+        """组织的FAQ语料变更，所有进程在下次检查时重建索引"""
+        organization_id = str(organization_id)
+        self._indices.pop(organization_id, None)
+        try:
+            await redis_client.incr(f"{self.version_prefix}:{organization_id}")
+        except Exception as e:
+            # 其他进程最迟在重启后重建
+            self.stats["errors"] += 1
+            logger.error(f"发布FAQ索引版本失败: {organization_id}, {str(e)}")
+    
+    async def _get_index(self, organization_id: str) -> Optional[FAQIndex]:
+        """获取组织的索引，版本变化或未加载时重建"""
+        cached = self._indices.get(organization_id)
+        now = time.monotonic()
+        if cached and now - cached["checked_at"] < self.check_interval:
+            return cached["index"]
+        
+        version = await self._current_version(organization_id)
+        if cached and cached["version"] == version:
+            cached["checked_at"] = now
+            return cached["index"]
+        
+        lock = self._build_locks.setdefault(organization_id, asyncio.Lock())
+        async with lock:
+            cached = self._indices.get(organization_id)
+            if cached and cached["version"] == version:
+                return cached["index"]
+            
+            entries = await self._load_entries(organization_id)
+            index = await asyncio.to_thread(
+                FAQIndex, entries, settings.FAQ_NGRAM_MIN, settings.FAQ_NGRAM_MAX
+            ) if entries else None
+            
+            self._indices[organization_id] = {
+                "index": index,
+                "version": version,
+                "checked_at": time.monotonic()
+            }
+            self.stats["builds"] += 1
+            self.stats["last_build_time"] = time.time()
+            logger.info(f"FAQ索引已构建: {organization_id}, {len(entries)} 条")
+            return index
+    
+    async def _current_version(self, organization_id: str) -> Optional[str]:
+        """读取组织的FAQ语料版本"""
+        try:
+            version = await redis_client.get(f"{self.version_prefix}:{organization_id}")
+        except Exception:
+            # Redis不可用时沿用已加载的索引
+            cached = self._indices.get(organization_id)
+            return cached["version"] if cached else None
+        
+        if isinstance(version, bytes):
+            version = version.decode()
+        return version
+    
+    async def _load_entries(self, organization_id: str) -> List[Dict[str, Any]]:
+        """读取组织启用的FAQ条目"""
+        async with get_db() as db:
+            result = await db.execute(
+                select(FAQEntry).where(
+                    FAQEntry.organization_id == organization_id,
+                    FAQEntry.is_active == True
+                )
+            )
+            return [
+                {"id": str(entry.id), "answer": entry.answer, "questions": entry.questions}
+                for entry in result.scalars().all()
+            ]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        lookups = self.stats["lookups"]
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "margin": self.margin,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0,
+            "avg_match_ms": round(self.stats["total_match_time"] / lookups * 1000, 3) if lookups else 0,
+            "indexed_organizations": len(self._indices),
+            "indexed_entries": sum(
+                len(item["index"].entries) for item in self._indices.values() if item["index"]
+            )
+        }
+
+
+# 全局FAQ检索实例
+faq_service = FAQService()
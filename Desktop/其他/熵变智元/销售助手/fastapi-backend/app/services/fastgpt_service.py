@@ -8,7 +8,7 @@ import json
 import logging
 import time
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Union
+from typing import Dict, Any, List, Optional, Union, Tuple
 from dataclasses import dataclass
 from enum import Enum
 import httpx
@@ -20,9 +20,23 @@ from app.core.redis import redis_client
 from app.services.cost_calculator import cost_calculator, CostCalculationRequest
 from app.services.websocket_manager import websocket_manager
 from app.services.notification_service import notification_service
+from app.services.adaptive_limiter import fastgpt_limiter, OVERLOAD_STATUS_CODES
+from app.services.request_hedger import fastgpt_hedger, fastgpt_stream_hedger
+from app.services.circuit_breaker import circuit_breakers, CircuitOpenError
+from app.services.singleflight import singleflight
+from app.services.request_dispatcher import RequestDispatcher
+from app.services.ai_stream import DeltaCallback, read_completion_stream
+from app.services.load_shedder import load_shedder
+from app.services.token_estimator import token_estimator
+from app.services.http_clients import http_clients
+from app.services.reply_cache import ai_reply_cache
 
 logger = logging.getLogger(__name__)
 
+# 调度通道：交互式对话、批量/分析任务
+LANE_INTERACTIVE = "interactive"
+LANE_BATCH = "batch"
+
 
 class FastGPTModelType(str, Enum):
     """FastGPT模型类型"""
@@ -56,6 +70,7 @@ class FastGPTResponse:
     request_id: Optional[str] = None
     tokens_used: int = 0
     cost: float = 0.0
+    queue_time: float = 0.0  # 在调度队列中的等待时间（秒），不含在 response_time 中
 
 
 @dataclass
@@ -69,6 +84,8 @@ class WorkflowConfig:
     model_config: Dict[str, Any]
     variables: Dict[str, Any] = None
     is_active: bool = True
+    reply_cache: bool = False  # 是否缓存重复问题的回复
+    reply_cache_context_free: bool = False  # 回复与会话上下文无关（FAQ类工作流）
 
 
 @dataclass
@@ -95,10 +112,27 @@ class FastGPTService:
         self.workflow_configs: Dict[str, WorkflowConfig] = {}
         self.config_cache_ttl = 300  # 5分钟缓存
         
-        # 请求队列管理
-        self.request_queue = asyncio.Queue()
-        self.max_concurrent_requests = 10
-        self.processing_requests = 0
+        # 请求调度（按通道排队，上游并发上限由AIMD限制器根据延迟和错误自适应调整）
+        self.lane_priorities = {
+            lane: config.get("priority", 0) for lane, config in settings.FASTGPT_DISPATCH_LANES.items()
+        }
+        self.dispatcher = RequestDispatcher(
+            "fastgpt",
+            self._process_request,
+            settings.FASTGPT_DISPATCH_LANES,
+            settings.FASTGPT_QUEUE_SIZE,
+            default_lane=LANE_INTERACTIVE
+        )
+        self.limiter = fastgpt_limiter
+        load_shedder.register(
+            "fastgpt",
+            self.dispatcher.queue_size,
+            settings.FASTGPT_QUEUE_SIZE * len(settings.FASTGPT_DISPATCH_LANES)
+        )
+        
+        # 慢请求对冲
+        self.hedger = fastgpt_hedger
+        self.stream_hedger = fastgpt_stream_hedger
         
         # 重试配置
         self.max_retries = 3
@@ -115,16 +149,26 @@ class FastGPTService:
             "total_requests": 0,
             "successful_requests": 0,
             "failed_requests": 0,
+            "rejected_requests": 0,
             "timeout_requests": 0,
+            "circuit_rejected_requests": 0,
             "total_tokens": 0,
             "total_cost": 0.0,
             "average_response_time": 0.0,
             "average_tokens_per_request": 0.0,
+            "streamed_requests": 0,
+            "total_first_token_time": 0,
+            "last_first_token_time": None,
             "last_request_time": None
         }
-        
-        # 启动请求处理器
-        asyncio.create_task(self._start_request_processor())
+    
+    async def start(self):
+        """启动请求调度（应用生命周期中调用）"""
+        await self.dispatcher.start()
+    
+    async def stop(self):
+        """停止请求调度，等待处理中的请求完成"""
+        await self.dispatcher.stop()
     
     async def _make_request(
         self,
@@ -132,9 +176,11 @@ class FastGPTService:
         data: Dict[str, Any],
         api_key: Optional[str] = None,
         timeout: Optional[float] = None,
+        on_delta: Optional[DeltaCallback] = None,
+        priority: float = 0,
         **kwargs
     ) -> FastGPTResponse:
-        """发送HTTP请求到FastGPT API"""
+        """发送HTTP请求到FastGPT API（传入 on_delta 时以流式方式请求，priority 越高越先获得并发槽位）"""
         try:
             url = urljoin(self.base_url, endpoint)
             headers = {
@@ -150,13 +196,46 @@ class FastGPTService:
             self.stats["total_requests"] += 1
             self.stats["last_request_time"] = datetime.utcnow()
             
-            # 发送请求
-            async with httpx.AsyncClient(timeout=timeout or self.timeout) as client:
-                response = await client.post(
-                    url=url,
-                    headers=headers,
-                    json=data,
-                    **kwargs
+            # 熔断中直接失败，不排队等待并发槽位
+            breaker = circuit_breakers.get("fastgpt", endpoint)
+            breaker.check()
+            
+            # 发送请求（占用自适应并发槽位，共享连接池复用长连接）
+            streamed_data = None
+            client = http_clients.get("fastgpt", timeout=self.timeout)
+            if on_delta and settings.AI_STREAM_ENABLED:
+                async def send_stream(push: DeltaCallback) -> Tuple[httpx.Response, Optional[Dict[str, Any]]]:
+                    async with self.limiter.slot(priority) as slot, breaker.guard() as call:
+                        result = await self._post_stream(
+                            client, url, headers, data, push, timeout=timeout or self.timeout, **kwargs
+                        )
+                        slot.record(result[0].status_code)
+                        call.record(result[0].status_code)
+                    return result
+                
+                # 首token超过阈值仍未到达时对冲，只转发先收到增量的请求
+                response, streamed_data = await self.stream_hedger.run_stream(
+                    send_stream,
+                    on_delta,
+                    accept=lambda result: result[0].status_code not in OVERLOAD_STATUS_CODES
+                )
+            else:
+                async def send() -> httpx.Response:
+                    async with self.limiter.slot(priority) as slot, breaker.guard() as call:
+                        response = await client.post(
+                            url=url,
+                            headers=headers,
+                            json=data,
+                            timeout=timeout or self.timeout,
+                            **kwargs
+                        )
+                        slot.record(response.status_code)
+                        call.record(response.status_code)
+                    return response
+                
+                # 慢请求对冲，上游过载的响应不会胜出
+                response = await self.hedger.run(
+                    send, accept=lambda response: response.status_code not in OVERLOAD_STATUS_CODES
                 )
             
             response_time = time.time() - start_time
@@ -164,7 +243,7 @@ class FastGPTService:
             # 处理响应
             if response.status_code == 200:
                 try:
-                    response_data = response.json()
+                    response_data = streamed_data if streamed_data is not None else response.json()
                     
                     # 提取token和成本信息
                     tokens_used = self._extract_tokens(response_data)
@@ -208,6 +287,15 @@ class FastGPTService:
                     request_id=request_id
                 )
         
+        except CircuitOpenError as e:
+            self.stats["failed_requests"] += 1
+            self.stats["circuit_rejected_requests"] += 1
+            return FastGPTResponse(
+                success=False,
+                error=f"FastGPT接口熔断中: {str(e)}",
+                status_code=503,
+                request_id=request_id
+            )
         except httpx.TimeoutException:
             self.stats["failed_requests"] += 1
             self.stats["timeout_requests"] += 1
@@ -235,6 +323,31 @@ class FastGPTService:
                 request_id=request_id
             )
     
+    async def _post_stream(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        headers: Dict[str, str],
+        data: Dict[str, Any],
+        on_delta: DeltaCallback,
+        **kwargs
+    ) -> Tuple[httpx.Response, Optional[Dict[str, Any]]]:
+        """流式请求（SSE），返回 (响应, 拼接后的完整结果)；非200时结果为None，响应体已读取"""
+        started = time.monotonic()
+        async with client.stream("POST", url, headers=headers, json={**data, "stream": True}, **kwargs) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return response, None
+            
+            result = await read_completion_stream(response, on_delta, started)
+        
+        self.stats["streamed_requests"] += 1
+        if result["first_token_time"] is not None:
+            self.stats["total_first_token_time"] += result["first_token_time"]
+            self.stats["last_first_token_time"] = result["first_token_time"]
+        
+        return response, result
+    
     def _extract_tokens(self, response_data: Dict[str, Any]) -> int:
         """从响应中提取token使用量"""
         try:
@@ -251,8 +364,7 @@ class FastGPTService:
             # 从响应文本长度估算
             response_text = response_data.get("data", {}).get("text", "")
             if response_text:
-                # 粗略估算：中文1字符≈1.5token，英文1单词≈1.3token
-                return int(len(response_text) * 1.5)
+                return token_estimator.estimate(response_text)
             
             return 0
             
@@ -297,45 +409,45 @@ class FastGPTService:
         if self.stats["successful_requests"] > 0:
             self.stats["average_tokens_per_request"] = self.stats["total_tokens"] / self.stats["successful_requests"]
     
-    async def _start_request_processor(self):
-        """启动请求处理器"""
-        while True:
-            try:
-                if self.processing_requests >= self.max_concurrent_requests:
-                    await asyncio.sleep(0.1)
-                    continue
-                
-                # 等待队列中的请求
-                request_item = await asyncio.wait_for(self.request_queue.get(), timeout=1.0)
-                
-                # 并发处理请求
-                asyncio.create_task(self._process_request(request_item))
-                
-            except asyncio.TimeoutError:
-                continue
-            except Exception as e:
-                logger.error(f"请求处理器异常: {str(e)}")
-                await asyncio.sleep(1.0)
-    
-    async def _process_request(self, request_item: Dict[str, Any]):
-        """处理单个请求"""
-        self.processing_requests += 1
+    async def _enqueue(self, lane: str, request_args: Dict[str, Any]) -> Optional[asyncio.Future]:
+        """提交请求到调度通道，队列已满时返回None"""
+        # 未经应用生命周期启动时（如脚本中直接调用）按需启动
+        if not self.dispatcher.is_running:
+            await self.dispatcher.start()
+        
+        lane = self.dispatcher.lane(lane).name
         try:
-            # 执行实际请求
-            response = await self._make_request(**request_item["request_args"])
-            
-            # 设置结果
-            request_item["future"].set_result(response)
-            
-        except Exception as e:
-            request_item["future"].set_exception(e)
-        finally:
-            self.processing_requests -= 1
+            return self.dispatcher.submit(lane, {**request_args, "priority": self.lane_priorities.get(lane, 0)})
+        except asyncio.QueueFull:
+            # 排队请求已达上限，立即失败而不是让所有请求的延迟一起上升
+            self.stats["rejected_requests"] += 1
+            load_shedder.record_drop("fastgpt")
+            return None
+    
+    async def _dispatch(self, lane: str, request_args: Dict[str, Any]) -> FastGPTResponse:
+        """经调度通道发送请求"""
+        future = await self._enqueue(lane, request_args)
+        if future is None:
+            return FastGPTResponse(success=False, error="FastGPT请求队列已满", status_code=503)
+        return await future
+    
+    async def _process_request(self, request_args: Dict[str, Any], queue_time: float) -> FastGPTResponse:
+        """处理调度出的单个请求"""
+        response = await self._make_request(**request_args)
+        response.queue_time = queue_time
+        return response
     
     # ==================== 工作流管理 ====================
     
     async def get_workflow_config(self, workflow_id: str) -> Optional[WorkflowConfig]:
-        """获取工作流配置"""
+        """获取工作流配置（同时发起的相同请求共享一次加载）"""
+        return await singleflight.do(
+            ("fastgpt.get_workflow_config", workflow_id),
+            lambda: self._load_workflow_config(workflow_id)
+        )
+    
+    async def _load_workflow_config(self, workflow_id: str) -> Optional[WorkflowConfig]:
+        """加载工作流配置"""
         try:
             # 先从缓存获取
             if workflow_id in self.workflow_configs:
@@ -385,6 +497,12 @@ class FastGPTService:
             # 保存到缓存
             self.workflow_configs[config.workflow_id] = config
             
+            # 工作流变更后，之前缓存的回复不再可信
+            ai_reply_cache.configure_workflow(
+                config.workflow_id, config.reply_cache, config.reply_cache_context_free
+            )
+            await ai_reply_cache.purge(config.workflow_id)
+            
             # 保存到数据库
             # 这里应该保存到数据库
             
@@ -423,9 +541,16 @@ class FastGPTService:
         workflow_id: str,
         context: ChatContext,
         user_input: str,
+        on_delta: Optional[DeltaCallback] = None,
+        lane: str = LANE_INTERACTIVE,
         **kwargs
     ) -> FastGPTResponse:
-        """处理聊天消息"""
+        """
+        处理聊天消息
+        只有调用方传入 on_delta（如会话回复的增量推送）时才以流式方式请求，
+        批量和分析请求不向会话推送增量；
+        lane 为调度通道，批量任务使用 LANE_BATCH，不与交互式对话争抢并发
+        """
         try:
             # 获取工作流配置
             workflow_config = await self.get_workflow_config(workflow_id)
@@ -466,17 +591,15 @@ class FastGPTService:
                 )
             
             # 发送AI请求
-            future = asyncio.Future()
-            request_item = {
-                "request_args": {
-                    "endpoint": workflow_config.api_endpoint,
-                    "data": request_data,
-                    "api_key": workflow_config.api_key
-                },
-                "future": future
-            }
+            future = await self._enqueue(lane, {
+                "endpoint": workflow_config.api_endpoint,
+                "data": request_data,
+                "api_key": workflow_config.api_key,
+                "on_delta": on_delta
+            })
+            if future is None:
+                return FastGPTResponse(success=False, error="FastGPT请求队列已满", status_code=503)
             
-            await self.request_queue.put(request_item)
             response = await future
             
             # 如果成功，记录实际成本
@@ -492,6 +615,7 @@ class FastGPTService:
                         "workflow_id": workflow_id,
                         "session_id": context.session_id,
                         "response_time": response.response_time,
+                        "queue_time": response.queue_time,
                         "request_id": response.request_id
                     }
                 )
@@ -569,17 +693,16 @@ class FastGPTService:
     async def _estimate_tokens(self, request_data: Dict[str, Any]) -> Dict[str, int]:
         """估算token使用量"""
         try:
-            # 简单的token估算
             user_input = request_data.get("userChatInput", "")
-            variables = request_data.get("variables", {})
-            histories = variables.get("histories", [])
-            
-            # 输入token估算
-            input_text = user_input
-            for history in histories[-5:]:  # 只考虑最近5条历史
-                input_text += history.get("content", "")
-            
-            input_tokens = int(len(input_text) * 1.5)  # 粗略估算
+            variables = dict(request_data.get("variables", {}))
+            histories = variables.pop("histories", None) or []
+            
+            # 输入token估算（历史记录全部随请求发送，逐条命中估算缓存）
+            input_tokens = (
+                token_estimator.estimate(user_input)
+                + token_estimator.estimate_messages(histories)
+                + token_estimator.estimate_value(variables)
+            )
             
             # 输出token估算（根据模型配置）
             chat_config = request_data.get("chatConfig", {})
@@ -619,7 +742,7 @@ class FastGPTService:
                     user_input = message_data["user_input"]
                     
                     task = asyncio.create_task(
-                        self.process_chat_message(workflow_id, context, user_input)
+                        self.process_chat_message(workflow_id, context, user_input, lane=LANE_BATCH)
                     )
                     tasks.append(task)
                 
@@ -668,10 +791,10 @@ class FastGPTService:
                 }
             }
             
-            return await self._make_request(
-                endpoint="/api/v1/intent/analyze",
-                data=request_data
-            )
+            return await self._dispatch(LANE_BATCH, {
+                "endpoint": "/api/v1/intent/analyze",
+                "data": request_data
+            })
             
         except Exception as e:
             logger.error(f"意图分析失败: {str(e)}")
@@ -701,10 +824,10 @@ class FastGPTService:
                 }
             }
             
-            return await self._make_request(
-                endpoint="/api/v1/sentiment/analyze",
-                data=request_data
-            )
+            return await self._dispatch(LANE_BATCH, {
+                "endpoint": "/api/v1/sentiment/analyze",
+                "data": request_data
+            })
             
         except Exception as e:
             logger.error(f"情感分析失败: {str(e)}")
@@ -735,8 +858,8 @@ class FastGPTService:
                 "healthy": response.success,
                 "response_time": response_time,
                 "last_check": self.last_health_check.isoformat(),
-                "queue_size": self.request_queue.qsize(),
-                "processing_requests": self.processing_requests,
+                "queue_size": self.dispatcher.queue_size(),
+                "processing_requests": self.dispatcher.in_flight(),
                 "stats": self.get_stats()
             }
             
@@ -761,8 +884,18 @@ class FastGPTService:
             "is_healthy": self.is_healthy,
             "last_health_check": self.last_health_check.isoformat() if self.last_health_check else None,
             "workflow_count": len(self.workflow_configs),
-            "queue_size": self.request_queue.qsize(),
-            "processing_requests": self.processing_requests
+            "queue_size": self.dispatcher.queue_size(),
+            "processing_requests": self.dispatcher.in_flight(),
+            "dispatcher": self.dispatcher.get_stats(),
+            "avg_first_token_time": (
+                round(self.stats["total_first_token_time"] / self.stats["streamed_requests"], 2)
+                if self.stats["streamed_requests"] else None
+            ),
+            "concurrency": self.limiter.get_stats(),
+            "hedging": self.hedger.get_stats(),
+            "stream_hedging": self.stream_hedger.get_stats(),
+            "circuit_breakers": circuit_breakers.get_stats("fastgpt"),
+            "connections": http_clients.get_stats()["upstreams"].get("fastgpt")
         }
     
     async def clear_cache(self):
@@ -773,6 +906,7 @@ class FastGPTService:
     async def reload_workflows(self):
         """重新加载工作流配置"""
         await self.clear_cache()
+        await ai_reply_cache.purge()
         # 这里应该从数据库重新加载所有工作流配置
         logger.info("工作流配置已重新加载")
 
@@ -6,6 +6,7 @@ GeWe微信自动化服务
 import asyncio
 import json
 import logging
+import re
 import time
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Union
@@ -16,6 +17,9 @@ import uuid
 from urllib.parse import urljoin
 
 from app.core.config import settings
+from app.services.http_clients import http_clients
+from app.services.circuit_breaker import circuit_breakers, CircuitOpenError
+from app.services.singleflight import singleflight
 from app.core.redis import redis_client
 from app.services.cost_calculator import cost_calculator, CostCalculationRequest
 from app.services.websocket_manager import websocket_manager
@@ -23,6 +27,9 @@ from app.services.notification_service import notification_service
 
 logger = logging.getLogger(__name__)
 
+# 接口路径中的账号、联系人、群和朋友圈ID（熔断器按接口统计，不按ID）
+_PATH_IDS = re.compile(r"(?<=/account/)[^/]+(?=/)|(?<=/contact/)(?!add$)[^/]+|(?<=/group/)[^/]+|(?<=/moments/)[^/]+")
+
 
 class GeWeMessageType(str, Enum):
     """GeWe消息类型"""
@@ -95,6 +102,7 @@ class GeWeService:
             "successful_requests": 0,
             "failed_requests": 0,
             "rate_limited_requests": 0,
+            "circuit_rejected_requests": 0,
             "average_response_time": 0.0,
             "last_request_time": None
         }
@@ -109,7 +117,11 @@ class GeWeService:
         **kwargs
     ) -> GeWeResponse:
         """发送HTTP请求到GeWe API"""
+        breaker = circuit_breakers.get("gewe", _PATH_IDS.sub("{id}", endpoint))
         try:
+            # 熔断中直接失败，不占用限流配额
+            breaker.check()
+            
             # 检查限流
             await self._check_rate_limit(token_id)
             
@@ -128,8 +140,9 @@ class GeWeService:
             self.stats["total_requests"] += 1
             self.stats["last_request_time"] = datetime.utcnow()
             
-            # 发送请求
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
+            # 发送请求（共享连接池，复用长连接）
+            client = http_clients.get("gewe", timeout=self.timeout)
+            async with breaker.guard() as call:
                 if files:
                     # 文件上传请求
                     headers.pop("Content-Type", None)  # 让httpx自动设置
@@ -150,6 +163,8 @@ class GeWeService:
                         json=data,
                         **kwargs
                     )
+                # 429 是按token限流，不代表接口故障
+                call.record(response.status_code, failed=response.status_code >= 500)
             
             response_time = time.time() - start_time
             
@@ -205,6 +220,14 @@ class GeWeService:
                     request_id=request_id
                 )
         
+        except CircuitOpenError as e:
+            self.stats["failed_requests"] += 1
+            self.stats["circuit_rejected_requests"] += 1
+            return GeWeResponse(
+                success=False,
+                error=f"GeWe接口熔断中: {str(e)}",
+                status_code=503
+            )
         except httpx.TimeoutException:
             self.stats["failed_requests"] += 1
             return GeWeResponse(
@@ -456,19 +479,25 @@ class GeWeService:
     # ==================== 联系人管理 ====================
     
     async def get_contact_list(self, token_id: str, account_id: str) -> GeWeResponse:
-        """获取联系人列表"""
-        return await self._make_request(
-            method="GET",
-            endpoint=f"/api/account/{account_id}/contacts",
-            token_id=token_id
+        """获取联系人列表（同时发起的相同请求共享一次调用）"""
+        return await singleflight.do(
+            ("gewe.get_contact_list", token_id, account_id),
+            lambda: self._make_request(
+                method="GET",
+                endpoint=f"/api/account/{account_id}/contacts",
+                token_id=token_id
+            )
         )
     
     async def get_contact_info(self, token_id: str, account_id: str, wxid: str) -> GeWeResponse:
-        """获取联系人信息"""
-        return await self._make_request(
-            method="GET",
-            endpoint=f"/api/account/{account_id}/contact/{wxid}",
-            token_id=token_id
+        """获取联系人信息（同时发起的相同请求共享一次调用）"""
+        return await singleflight.do(
+            ("gewe.get_contact_info", token_id, account_id, wxid),
+            lambda: self._make_request(
+                method="GET",
+                endpoint=f"/api/account/{account_id}/contact/{wxid}",
+                token_id=token_id
+            )
         )
     
     async def add_contact(
@@ -746,7 +775,9 @@ class GeWeService:
             "success_rate": round(success_rate, 2),
             "is_healthy": self.is_healthy,
             "last_health_check": self.last_health_check.isoformat() if self.last_health_check else None,
-            "active_rate_limits": len(self.rate_limits)
+            "active_rate_limits": len(self.rate_limits),
+            "connections": http_clients.get_stats()["upstreams"].get("gewe"),
+            "circuit_breakers": circuit_breakers.get_stats("gewe")
         }
     
     async def setup_webhook(self, token_id: str, webhook_url: str) -> GeWeResponse:
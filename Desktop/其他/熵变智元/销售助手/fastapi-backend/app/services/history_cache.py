@@ -0,0 +1,236 @@
+"""
+会话最近消息缓存
+每个会话在Redis中维护一个定长列表（按时间正序），保存最近N条消息的精简数据，
+AI上下文构建和消息列表首页优先读取，未命中时回源数据库并回填
+"""
+
+import json
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Iterable, Tuple
+
+from app.core.config import settings
+from app.core.redis import redis_client
+from app.models.chat import ChatMessage, AIProcessStatus
+
+logger = logging.getLogger(__name__)
+
+
+# 回填：与回填期间已追加的消息合并（这些消息比数据库查询结果更新），再截断并标记为完整
+_SEED_SCRIPT = """
+local seen = {}
+for i = 1, #ARGV - 2 do
+    seen[cjson.decode(ARGV[i]).id] = true
+end
+local pending = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+for i = 1, #ARGV - 2 do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+for _, item in ipairs(pending) do
+    if not seen[cjson.decode(item).id] then
+        redis.call('RPUSH', KEYS[1], item)
+    end
+end
+local size = tonumber(ARGV[#ARGV - 1])
+local ttl = tonumber(ARGV[#ARGV])
+redis.call('LTRIM', KEYS[1], -size, -1)
+redis.call('EXPIRE', KEYS[1], ttl)
+redis.call('SET', KEYS[2], '1', 'EX', ttl)
+return redis.call('LLEN', KEYS[1])
+"""
+
+# 更新：位置上的条目未被并发修改时才覆盖
+_REPLACE_SCRIPT = """
+if redis.call('LINDEX', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('LSET', KEYS[1], ARGV[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+def history_entry(message: ChatMessage) -> Dict[str, Any]:
+    """消息转换为缓存条目（字段与消息列表接口的响应一致）"""
+    return {
+        "id": str(message.id),
+        "message_type": message.message_type.value,
+        "direction": message.direction.value,
+        "content": message.content,
+        "sender_wxid": message.sender_wxid,
+        "sender_nickname": message.sender_nickname,
+        "media_url": message.media_url,
+        "media_type": message.media_type,
+        "thumbnail_url": message.thumbnail_url,
+        "status": message.status.value,
+        "is_recalled": bool(message.is_recalled),
+        "ai_process_status": (message.ai_process_status or AIProcessStatus.PENDING).value,
+        "ai_response_message_id": str(message.ai_response_message_id) if message.ai_response_message_id else None,
+        "ai_processing_time": message.ai_processing_time,
+        "intent_classification": message.intent_classification,
+        "sentiment_score": message.sentiment_score,
+        "keywords": message.keywords or [],
+        "created_at": (message.created_at or datetime.utcnow()).isoformat()
+    }
+
+
+class SessionHistoryCache:
+    """会话最近消息缓存"""
+    
+    def __init__(self):
+        self.enabled = settings.CHAT_HISTORY_CACHE_ENABLED
+        self.prefix = settings.CHAT_HISTORY_CACHE_PREFIX
+        self.size = settings.CHAT_HISTORY_CACHE_SIZE
+        self.ttl = settings.CHAT_HISTORY_CACHE_TTL
+        
+        self._seed_script = redis_client.register_script(_SEED_SCRIPT)
+        self._replace_script = redis_client.register_script(_REPLACE_SCRIPT)
+        
+        # 统计信息
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "appends": 0,
+            "seeds": 0,
+            "updates": 0,
+            "update_conflicts": 0,
+            "errors": 0
+        }
+    
+    def _keys(self, session_id: Any) -> Tuple[str, str]:
+        """列表key和完整性标记key"""
+        key = f"{self.prefix}:{session_id}"
+        return key, f"{key}:ready"
+    
+    async def get_recent(self, session_id: Any, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        获取最近limit条消息（按时间正序）
+        未回填过的会话返回None，由调用方回源数据库
+        """
+        if not self.enabled or limit > self.size:
+            return None
+        
+        key, ready_key = self._keys(session_id)
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.exists(ready_key)
+            pipe.lrange(key, -limit, -1)
+            ready, items = await pipe.execute()
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"读取会话消息缓存失败: {session_id}, {str(e)}")
+            return None
+        
+        if not ready:
+            self.stats["misses"] += 1
+            return None
+        
+        self.stats["hits"] += 1
+        return [json.loads(item) for item in items]
+    
+    async def seed(self, session_id: Any, entries: List[Dict[str, Any]]):
+        """用数据库中最近的消息（按时间正序）回填"""
+        if not self.enabled:
+            return
+        
+        key, ready_key = self._keys(session_id)
+        try:
+            values = [json.dumps(entry, ensure_ascii=False, default=str) for entry in entries[-self.size:]]
+            await self._seed_script(keys=[key, ready_key], args=values + [self.size, self.ttl])
+            self.stats["seeds"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"回填会话消息缓存失败: {session_id}, {str(e)}")
+    
+    async def append(self, session_id: Any, entry: Dict[str, Any]):
+        """追加一条新消息"""
+        await self.append_many([(session_id, entry)])
+    
+    async def append_many(self, items: Iterable[Tuple[Any, Dict[str, Any]]]):
+        """批量追加新消息（一次往返），列表截断到固定长度"""
+        if not self.enabled:
+            return
+        
+        items = list(items)
+        if not items:
+            return
+        
+        try:
+            pipe = redis_client.pipeline(transaction=True)
+            for session_id, entry in items:
+                key, ready_key = self._keys(session_id)
+                pipe.rpush(key, json.dumps(entry, ensure_ascii=False, default=str))
+                pipe.ltrim(key, -self.size, -1)
+                pipe.expire(key, self.ttl)
+                pipe.expire(ready_key, self.ttl)
+            await pipe.execute()
+            self.stats["appends"] += len(items)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"追加会话消息缓存失败: {str(e)}")
+            # 缓存与数据库可能不一致，下次读取时重新回填
+            await self.invalidate(*{session_id for session_id, _ in items})
+    
+    async def update(self, session_id: Any, message_id: Any, fields: Dict[str, Any]):
+        """更新缓存中某条消息的字段（不在缓存窗口内则忽略）"""
+        if not self.enabled:
+            return
+        
+        key, _ = self._keys(session_id)
+        message_id = str(message_id)
+        
+        try:
+            for _ in range(3):
+                items = await redis_client.lrange(key, 0, -1)
+                for index, item in enumerate(items):
+                    entry = json.loads(item)
+                    if entry.get("id") == message_id:
+                        break
+                else:
+                    return
+                
+                entry.update(fields)
+                replaced = await self._replace_script(
+                    keys=[key],
+                    args=[index, item, json.dumps(entry, ensure_ascii=False, default=str)]
+                )
+                if replaced:
+                    self.stats["updates"] += 1
+                    return
+                
+                # 期间有新消息写入导致位置变化，重新定位
+                self.stats["update_conflicts"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"更新会话消息缓存失败: {session_id}, {message_id}, {str(e)}")
+        
+        await self.invalidate(session_id)
+    
+    async def invalidate(self, *session_ids: Any):
+        """失效会话缓存，下次读取时从数据库回填"""
+        if not self.enabled or not session_ids:
+            return
+        
+        keys = []
+        for session_id in session_ids:
+            keys.extend(self._keys(session_id))
+        try:
+            await redis_client.delete(*keys)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"失效会话消息缓存失败: {str(e)}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "size": self.size,
+            "ttl": self.ttl,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0
+        }
+
+
+# 全局会话消息缓存实例
+session_history_cache = SessionHistoryCache()
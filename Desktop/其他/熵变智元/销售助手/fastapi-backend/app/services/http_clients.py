@@ -0,0 +1,136 @@
+"""
+共享HTTP客户端
+按上游维护长连接池（keep-alive，支持时启用HTTP/2），避免每次请求重新进行DNS解析、TCP和TLS握手；
+通过httpcore的trace扩展统计新建连接数，得出连接复用率
+"""
+
+import logging
+from collections import defaultdict
+from typing import Dict, Any, Optional
+
+import httpx
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class HTTPClientRegistry:
+    """按上游名称共享的HTTP客户端"""
+    
+    def __init__(self):
+        self.http2 = settings.HTTP_CLIENT_HTTP2 and HTTP2_AVAILABLE
+        self.limits = httpx.Limits(
+            max_connections=settings.HTTP_CLIENT_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_CLIENT_MAX_KEEPALIVE,
+            keepalive_expiry=settings.HTTP_CLIENT_KEEPALIVE_EXPIRY
+        )
+        
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        
+        # 每个上游的统计信息
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {
+            "requests": 0,
+            "new_connections": 0,
+            "tls_handshakes": 0,
+            "http2_requests": 0,
+            "errors": 0
+        })
+        
+        if settings.HTTP_CLIENT_HTTP2 and not HTTP2_AVAILABLE:
+            logger.warning("未安装h2，出站请求使用HTTP/1.1")
+    
+    def get(
+        self,
+        name: str,
+        base_url: str = "",
+        timeout: Optional[float] = None,
+        headers: Optional[Dict[str, str]] = None
+    ) -> httpx.AsyncClient:
+        """获取上游的共享客户端（首次调用时创建，后续调用忽略参数）"""
+        client = self.clients.get(name)
+        if client is not None and not client.is_closed:
+            return client
+        
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            headers=headers,
+            http2=self.http2,
+            limits=self.limits,
+            event_hooks={
+                "request": [self._request_hook(name)],
+                "response": [self._response_hook(name)]
+            }
+        )
+        self.clients[name] = client
+        logger.info(f"创建共享HTTP客户端: {name} (http2={self.http2})")
+        return client
+    
+    def _request_hook(self, name: str):
+        """请求发出前挂上连接跟踪"""
+        stats = self.stats[name]
+        
+        async def trace(event_name: str, info: Dict[str, Any]):
+            if event_name == "connection.connect_tcp.complete":
+                stats["new_connections"] += 1
+            elif event_name == "connection.start_tls.complete":
+                stats["tls_handshakes"] += 1
+        
+        async def hook(request: httpx.Request):
+            stats["requests"] += 1
+            request.extensions.setdefault("trace", trace)
+        
+        return hook
+    
+    def _response_hook(self, name: str):
+        """记录响应的协议版本和错误"""
+        stats = self.stats[name]
+        
+        async def hook(response: httpx.Response):
+            if response.http_version == "HTTP/2":
+                stats["http2_requests"] += 1
+            if response.status_code >= 500:
+                stats["errors"] += 1
+        
+        return hook
+    
+    async def close(self):
+        """关闭所有客户端（应用关闭时调用）"""
+        for name, client in list(self.clients.items()):
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.error(f"关闭HTTP客户端失败: {name}, {str(e)}")
+        self.clients.clear()
+        logger.info("共享HTTP客户端已关闭")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息（含每个上游的连接复用率）"""
+        upstreams = {}
+        for name, stats in self.stats.items():
+            requests = stats["requests"]
+            upstreams[name] = {
+                **stats,
+                "reuse_rate": round(1 - stats["new_connections"] / requests, 4) if requests else None,
+                "is_open": name in self.clients and not self.clients[name].is_closed
+            }
+        
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            "upstreams": upstreams
+        }
+
+
+# 全局共享HTTP客户端实例
+http_clients = HTTPClientRegistry()
@@ -15,6 +15,8 @@ import statistics
 from app.core.redis import redis_client
 from app.services.gewe_service import gewe_service
 from app.services.fastgpt_service import fastgpt_service
+from app.services.adaptive_limiter import fastgpt_limiter, ai_service_limiter
+from app.services.circuit_breaker import circuit_breakers
 from app.services.websocket_manager import websocket_manager
 from app.services.notification_service import notification_service
 
@@ -186,6 +188,11 @@ class IntegrationMonitor:
             else:
                 status = ServiceStatus.DOWN
             
+            # 有接口熔断时服务至少为降级
+            open_circuits = circuit_breakers.open_circuits("gewe")
+            if open_circuits and status == ServiceStatus.HEALTHY:
+                status = ServiceStatus.DEGRADED
+            
             # 计算错误率
             error_rate = 100 - stats["success_rate"]
             
@@ -200,7 +207,10 @@ class IntegrationMonitor:
                 custom_metrics={
                     "rate_limited_requests": stats.get("rate_limited_requests", 0),
                     "active_rate_limits": stats.get("active_rate_limits", 0),
-                    "average_response_time": stats.get("average_response_time", 0.0)
+                    "average_response_time": stats.get("average_response_time", 0.0),
+                    "circuit_rejected_requests": stats.get("circuit_rejected_requests", 0),
+                    "open_circuits": open_circuits,
+                    "circuit_breakers": stats.get("circuit_breakers", {})
                 }
             )
         
@@ -234,6 +244,11 @@ class IntegrationMonitor:
             else:
                 status = ServiceStatus.DOWN
             
+            # 有接口熔断时服务至少为降级
+            open_circuits = circuit_breakers.open_circuits("fastgpt")
+            if open_circuits and status == ServiceStatus.HEALTHY:
+                status = ServiceStatus.DEGRADED
+            
             # 计算错误率
             error_rate = 100 - stats["success_rate"]
             
@@ -251,7 +266,20 @@ class IntegrationMonitor:
                     "average_tokens_per_request": stats.get("average_tokens_per_request", 0.0),
                     "timeout_requests": stats.get("timeout_requests", 0),
                     "queue_size": health_data.get("queue_size", 0),
-                    "processing_requests": health_data.get("processing_requests", 0)
+                    "processing_requests": health_data.get("processing_requests", 0),
+                    "streamed_requests": stats.get("streamed_requests", 0),
+                    "avg_first_token_time": stats.get("avg_first_token_time"),
+                    "concurrency_limit": fastgpt_limiter.limit,
+                    "concurrency_in_flight": fastgpt_limiter.in_flight,
+                    "ai_service_concurrency_limit": ai_service_limiter.limit,
+                    "ai_service_concurrency_in_flight": ai_service_limiter.in_flight,
+                    "circuit_rejected_requests": stats.get("circuit_rejected_requests", 0),
+                    "open_circuits": open_circuits,
+                    "ai_service_open_circuits": circuit_breakers.open_circuits("ai_service"),
+                    "circuit_breakers": {
+                        "fastgpt": stats.get("circuit_breakers", {}),
+                        "ai_service": circuit_breakers.get_stats("ai_service")
+                    }
                 }
             )
         
@@ -367,6 +395,21 @@ class IntegrationMonitor:
                     metadata={"success_rate": metrics.success_rate}
                 ))
             
+            # 检查熔断的接口
+            custom_metrics = metrics.custom_metrics or {}
+            open_circuits = custom_metrics.get("open_circuits", []) + custom_metrics.get("ai_service_open_circuits", [])
+            if open_circuits:
+                alerts.append(ServiceAlert(
+                    alert_id=f"{metrics.service_name}_circuit_open_{int(metrics.timestamp.timestamp())}",
+                    service_name=metrics.service_name,
+                    alert_type="circuit_open",
+                    severity=AlertSeverity.HIGH,
+                    title=f"{metrics.service_name}接口熔断",
+                    message=f"{metrics.service_name}有{len(open_circuits)}个接口处于熔断状态: {', '.join(open_circuits)}",
+                    timestamp=metrics.timestamp,
+                    metadata={"open_circuits": open_circuits}
+                ))
+            
             # 处理新告警
             for alert in alerts:
                 await self._process_alert(alert)
@@ -675,7 +718,8 @@ class IntegrationMonitor:
                     "status": metrics.status,
                     "last_check": metrics.timestamp.isoformat(),
                     "response_time": metrics.response_time,
-                    "success_rate": metrics.success_rate
+                    "success_rate": metrics.success_rate,
+                    "open_circuits": (metrics.custom_metrics or {}).get("open_circuits", [])
                 }
                 
                 if metrics.status == ServiceStatus.HEALTHY:
@@ -0,0 +1,341 @@
+"""
+关键词匹配引擎
+意图、情感、话题关键词和内容安全词典编译为一个 Aho-Corasick 自动机，一次线性扫描返回全部命中，
+耗时与词典规模无关；组织可在默认词典之上扩展自己的词条，词典版本变化时在后台重建并原子替换
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Iterable, Iterator, Tuple
+
+from sqlalchemy import select, update
+
+from app.core.config import settings
+from app.core.database import get_db
+from app.core.redis import redis_client
+from app.models.user import Organization
+
+logger = logging.getLogger(__name__)
+
+
+# 词典分类
+CATEGORY_INTENT = "intent"
+CATEGORY_SENTIMENT = "sentiment"
+CATEGORY_TOPIC = "keywords"
+CATEGORY_SAFETY = "safety"
+
+# 意图关键词（按顺序匹配，先命中的优先）
+INTENT_KEYWORDS = [
+    ("inquiry_price", ["价格", "多少钱", "费用", "收费"]),
+    ("purchase_intent", ["购买", "要买", "下单"]),
+    ("inquiry_product", ["咨询", "了解", "介绍"]),
+    ("complaint", ["投诉", "问题", "故障"])
+]
+
+SENTIMENT_KEYWORDS = [
+    ("positive", ["好", "不错", "满意", "喜欢", "感谢"]),
+    ("negative", ["差", "不好", "失望", "生气", "烂"])
+]
+
+TOPIC_KEYWORDS = [(word, [word]) for word in ["产品", "服务", "价格", "质量", "售后"]]
+
+SAFETY_KEYWORDS = [
+    ("unsafe_content", ["政治", "暴力", "色情", "赌博", "诈骗"])
+]
+
+DEFAULT_DICTIONARY = {
+    CATEGORY_INTENT: INTENT_KEYWORDS,
+    CATEGORY_SENTIMENT: SENTIMENT_KEYWORDS,
+    CATEGORY_TOPIC: TOPIC_KEYWORDS,
+    CATEGORY_SAFETY: SAFETY_KEYWORDS
+}
+
+# 组织配置（Organization.settings）中自定义词典的键
+ORGANIZATION_SETTINGS_KEY = "keyword_dictionaries"
+
+
+class AhoCorasick:
+    """多模式串匹配自动机（忽略大小写）"""
+    
+    def __init__(self, patterns: Iterable[Tuple[str, Any]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # 每个状态的输出：(模式串长度, 附带数据)，构建时沿失败链合并
+        self._output: List[Tuple[Tuple[int, Any], ...]] = [()]
+        self.pattern_count = 0
+        
+        for word, payload in patterns:
+            word = word.lower()
+            if not word:
+                continue
+            
+            state = 0
+            for char in word:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                state = next_state
+            
+            self._output[state] += ((len(word), payload),)
+            self.pattern_count += 1
+        
+        # 按深度广度优先计算失败指针
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                
+                self._fail[next_state] = fail
+                self._output[next_state] += self._output[fail]
+    
+    @property
+    def state_count(self) -> int:
+        """状态数"""
+        return len(self._goto)
+    
+    def iter(self, text: str) -> Iterator[Tuple[int, Any]]:
+        """一次扫描文本，依次产出 (命中起始位置, 附带数据)"""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        
+        state = 0
+        for position, char in enumerate(text.lower()):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            
+            for length, payload in output[state]:
+                yield position - length + 1, payload
+
+
+@dataclass
+class KeywordMatches:
+    """一次扫描的命中结果"""
+    # 分类 -> 命中的标签（按词典中的顺序，不重复）
+    labels: Dict[str, List[str]] = field(default_factory=dict)
+    # (起始位置, 分类, 标签, 关键词)
+    matches: List[Tuple[int, str, str, str]] = field(default_factory=list)
+    
+    def first(self, category: str, default: Optional[str] = None) -> Optional[str]:
+        """分类中优先级最高的命中标签"""
+        labels = self.labels.get(category)
+        return labels[0] if labels else default
+    
+    def words(self, category: str) -> List[str]:
+        """分类中命中的关键词（按出现顺序，不重复）"""
+        return list(dict.fromkeys(word for _, cat, _, word in self.matches if cat == category))
+
+
+class KeywordMatcher:
+    """编译后的一套词典"""
+    
+    def __init__(self, dictionary: Dict[str, List[Tuple[str, List[str]]]], version: Optional[str] = None):
+        self.version = version
+        
+        # (分类, 标签) -> 在词典中的顺序，用于命中多个标签时排序
+        self._rank: Dict[Tuple[str, str], int] = {}
+        patterns = []
+        for category, groups in dictionary.items():
+            for label, words in groups:
+                self._rank.setdefault((category, label), len(self._rank))
+                patterns.extend((word, (category, label, word)) for word in words)
+        
+        self.automaton = AhoCorasick(patterns)
+    
+    def scan(self, text: Optional[str]) -> KeywordMatches:
+        """扫描文本"""
+        result = KeywordMatches()
+        if not text:
+            return result
+        
+        for position, (category, label, word) in self.automaton.iter(text):
+            result.matches.append((position, category, label, word))
+            labels = result.labels.setdefault(category, [])
+            if label not in labels:
+                labels.append(label)
+        
+        for category, labels in result.labels.items():
+            labels.sort(key=lambda label: self._rank[(category, label)])
+        return result
+
+
+def merge_dictionary(custom: Optional[Dict[str, Dict[str, List[str]]]]) -> Dict[str, List[Tuple[str, List[str]]]]:
+    """在默认词典上合并组织的自定义词条（已有标签追加关键词，新标签排在默认标签之后）"""
+    merged = {
+        category: [(label, list(words)) for label, words in groups]
+        for category, groups in DEFAULT_DICTIONARY.items()
+    }
+    
+    for category, groups in (custom or {}).items():
+        target = merged.setdefault(category, [])
+        index = {label: words for label, words in target}
+        for label, words in groups.items():
+            if label in index:
+                index[label].extend(words)
+            else:
+                index[label] = list(words)
+                target.append((label, index[label]))
+    
+    return merged
+
+
+class KeywordEngine:
+    """关键词匹配服务"""
+    
+    def __init__(self):
+        self.check_interval = settings.KEYWORD_DICT_CHECK_INTERVAL
+        self.version_prefix = settings.KEYWORD_DICT_VERSION_PREFIX
+        
+        self.default = KeywordMatcher(DEFAULT_DICTIONARY)
+        
+        # organization_id -> {"matcher", "version", "checked_at"}
+        self._matchers: Dict[str, Dict[str, Any]] = {}
+        self._build_locks: Dict[str, asyncio.Lock] = {}
+        
+        # 统计信息
+        self.stats = {
+            "scans": 0,
+            "scanned_chars": 0,
+            "total_scan_time": 0.0,
+            "builds": 0,
+            "errors": 0,
+            "last_build_time": None
+        }
+    
+    def scan(self, text: Optional[str], organization_id: Any = None) -> KeywordMatches:
+        """用已加载的词典扫描文本（组织词典未加载时使用默认词典）"""
+        matcher = self.default
+        if organization_id:
+            cached = self._matchers.get(str(organization_id))
+            if cached:
+                matcher = cached["matcher"]
+        
+        started = time.monotonic()
+        result = matcher.scan(text)
+        self.stats["scans"] += 1
+        self.stats["scanned_chars"] += len(text or "")
+        self.stats["total_scan_time"] += time.monotonic() - started
+        return result
+    
+    async def analyze(self, text: Optional[str], organization_id: Any = None) -> KeywordMatches:
+        """检查组织词典版本后扫描文本"""
+        if organization_id:
+            try:
+                await self._refresh(str(organization_id))
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"加载关键词词典失败: {organization_id}, {str(e)}")
+        
+        return self.scan(text, organization_id)
+    
+    async def get_dictionary(self, organization_id: Any) -> Dict[str, Dict[str, List[str]]]:
+        """读取组织的自定义词条"""
+        async with get_db() as db:
+            result = await db.execute(
+                select(Organization.settings).where(Organization.id == organization_id)
+            )
+            org_settings = result.scalar_one_or_none() or {}
+            return org_settings.get(ORGANIZATION_SETTINGS_KEY) or {}
+    
+    async def save_dictionary(self, organization_id: Any, dictionary: Dict[str, Dict[str, List[str]]]):
+        """保存组织的自定义词条并通知所有进程重建"""
+        async with get_db() as db:
+            result = await db.execute(
+                select(Organization.settings).where(Organization.id == organization_id)
+            )
+            org_settings = dict(result.scalar_one_or_none() or {})
+            org_settings[ORGANIZATION_SETTINGS_KEY] = dictionary
+            
+            await db.execute(
+                update(Organization)
+                .where(Organization.id == organization_id)
+                .values(settings=org_settings)
+            )
+            await db.commit()
+        
+        await self.invalidate(organization_id)
+    
+    async def invalidate(self, organization_id: Any):
+        """组织词典变更，所有进程在下次检查时重建"""
+        organization_id = str(organization_id)
+        try:
+            await redis_client.incr(f"{self.version_prefix}:{organization_id}")
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"发布关键词词典版本失败: {organization_id}, {str(e)}")
+            # 至少让本进程重建
+            self._matchers.pop(organization_id, None)
+    
+    async def _refresh(self, organization_id: str):
+        """版本变化时重建组织的自动机，构建期间继续使用旧版本"""
+        cached = self._matchers.get(organization_id)
+        now = time.monotonic()
+        if cached and now - cached["checked_at"] < self.check_interval:
+            return
+        
+        version = await redis_client.get(f"{self.version_prefix}:{organization_id}")
+        if isinstance(version, bytes):
+            version = version.decode()
+        
+        if cached and cached["version"] == version:
+            cached["checked_at"] = now
+            return
+        
+        lock = self._build_locks.setdefault(organization_id, asyncio.Lock())
+        async with lock:
+            cached = self._matchers.get(organization_id)
+            if cached and cached["version"] == version:
+                return
+            
+            custom = await self.get_dictionary(organization_id)
+            if custom:
+                matcher = await asyncio.to_thread(KeywordMatcher, merge_dictionary(custom), version)
+            else:
+                matcher = self.default
+            
+            self._matchers[organization_id] = {
+                "matcher": matcher,
+                "version": version,
+                "checked_at": time.monotonic()
+            }
+            self.stats["builds"] += 1
+            self.stats["last_build_time"] = time.time()
+            logger.info(
+                f"关键词词典已构建: {organization_id}, "
+                f"{matcher.automaton.pattern_count} 个关键词"
+            )
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        scans = self.stats["scans"]
+        return {
+            **self.stats,
+            "avg_scan_ms": round(self.stats["total_scan_time"] / scans * 1000, 4) if scans else 0,
+            "default_patterns": self.default.automaton.pattern_count,
+            "organizations": {
+                organization_id: {
+                    "version": item["version"],
+                    "patterns": item["matcher"].automaton.pattern_count,
+                    "states": item["matcher"].automaton.state_count
+                }
+                for organization_id, item in self._matchers.items()
+            }
+        }
+
+
+# 全局关键词匹配实例
+keyword_engine = KeywordEngine()
@@ -0,0 +1,152 @@
+"""
+过载保护服务
+汇总各处理队列的深度，超过水位线时按策略降级：
+AI积压时先推迟群聊消息，严重积压时只处理高优先级消息（被推迟的消息由待处理恢复任务在租约过期后重新投递）；
+回调消息流积压时Webhook拒收并返回 Retry-After，由GeWe稍后重试
+"""
+
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Any, Optional, Callable
+
+from app.core.config import settings
+from app.models.chat import ChatType
+from app.services.message_stream import webhook_stream
+from app.services.ai_priority import PRIORITY_HIGH
+
+logger = logging.getLogger(__name__)
+
+
+# 推迟原因
+DEFER_GROUP = "group_chat"
+DEFER_LOW_PRIORITY = "low_priority"
+
+
+class LoadShedder:
+    """过载保护与降级决策"""
+    
+    def __init__(self):
+        self.enabled = settings.BACKPRESSURE_ENABLED
+        self.sample_interval = settings.BACKPRESSURE_SAMPLE_INTERVAL
+        self.webhook_high_water = settings.WEBHOOK_BACKLOG_HIGH_WATER
+        self.retry_after = settings.WEBHOOK_RETRY_AFTER
+        self.ai_high_water = settings.AI_BACKLOG_HIGH_WATER
+        self.ai_critical = settings.AI_BACKLOG_CRITICAL
+        
+        # 队列名 -> (深度函数, 容量)
+        self._queues: Dict[str, tuple] = {}
+        
+        # 回调消息流积压（跨进程，按采样间隔刷新，避免每个请求一次Redis往返）
+        self._webhook_backlog = 0
+        self._sampled_at = 0.0
+        self._sampling = False
+        
+        # 统计信息
+        self.stats = {
+            "webhook_rejected": 0,
+            "ai_deferred": defaultdict(int),
+            "recovery_paused": 0,
+            "dropped": defaultdict(int),
+            "last_shed_time": None
+        }
+    
+    def register(self, name: str, depth: Callable[[], int], capacity: Optional[int] = None):
+        """登记一个处理队列（capacity 为队列上限，无上限为None）"""
+        self._queues[name] = (depth, capacity)
+    
+    def depth(self, name: str) -> int:
+        """队列当前深度"""
+        queue = self._queues.get(name)
+        if not queue:
+            return 0
+        try:
+            return queue[0]()
+        except Exception:
+            return 0
+    
+    def record_drop(self, name: str, count: int = 1):
+        """记录有界队列已满时丢弃的条目"""
+        self.stats["dropped"][name] += count
+        self.stats["last_shed_time"] = datetime.utcnow()
+    
+    async def webhook_retry_after(self) -> Optional[int]:
+        """回调消息流积压超过水位线时返回建议的重试秒数，否则返回None"""
+        if not self.enabled:
+            return None
+        
+        now = time.monotonic()
+        if now - self._sampled_at >= self.sample_interval and not self._sampling:
+            self._sampling = True
+            try:
+                metrics = await webhook_stream.get_lag_metrics()
+                # lag 需要 Redis 7+，更早的版本只能看待确认数
+                self._webhook_backlog = (metrics.get("lag") or 0) + (metrics.get("pending") or 0)
+                self._sampled_at = now
+            finally:
+                self._sampling = False
+        
+        if self._webhook_backlog < self.webhook_high_water:
+            return None
+        
+        self.stats["webhook_rejected"] += 1
+        self.stats["last_shed_time"] = datetime.utcnow()
+        return self.retry_after
+    
+    def ai_backlog(self) -> int:
+        """等待AI处理的任务数"""
+        return self.depth("ai_lanes")
+    
+    def ai_overloaded(self) -> bool:
+        """AI处理是否已积压到需要降级"""
+        return self.enabled and self.ai_backlog() >= self.ai_high_water
+    
+    def defer_ai_reason(self, chat_type: Optional[str], priority_level: Optional[str]) -> Optional[str]:
+        """判断一条消息的AI处理是否推迟，返回推迟原因"""
+        if not self.enabled:
+            return None
+        
+        backlog = self.ai_backlog()
+        reason = None
+        if backlog >= self.ai_critical and priority_level != PRIORITY_HIGH:
+            reason = DEFER_LOW_PRIORITY
+        elif backlog >= self.ai_high_water and chat_type == ChatType.GROUP.value:
+            reason = DEFER_GROUP
+        
+        if reason:
+            self.stats["ai_deferred"][reason] += 1
+            self.stats["last_shed_time"] = datetime.utcnow()
+        return reason
+    
+    def record_recovery_paused(self):
+        """记录因过载跳过的一轮待处理消息恢复"""
+        self.stats["recovery_paused"] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息（含各队列深度和水位线）"""
+        queues = {}
+        for name, (_, capacity) in self._queues.items():
+            depth = self.depth(name)
+            queues[name] = {
+                "depth": depth,
+                "capacity": capacity,
+                "utilization": round(depth / capacity, 4) if capacity else None
+            }
+        
+        return {
+            **self.stats,
+            "ai_deferred": dict(self.stats["ai_deferred"]),
+            "dropped": dict(self.stats["dropped"]),
+            "enabled": self.enabled,
+            "queues": queues,
+            "webhook_backlog": self._webhook_backlog,
+            "webhook_high_water": self.webhook_high_water,
+            "ai_backlog": self.ai_backlog(),
+            "ai_high_water": self.ai_high_water,
+            "ai_critical": self.ai_critical
+        }
+
+
+# 全局过载保护实例
+load_shedder = LoadShedder()
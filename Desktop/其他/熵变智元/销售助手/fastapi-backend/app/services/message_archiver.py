@@ -0,0 +1,359 @@
+"""
+消息分区与冷数据归档服务
+chat_messages 按月范围分区：提前创建未来月份的分区；整月都已过保留期的分区分离后，
+按会话导出为gzip压缩的JSONL文件并写入清单，随后删除分区表。归档的会话可按需流式读回
+"""
+
+import asyncio
+import enum
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Any, List, Optional, AsyncIterator, Tuple
+
+from sqlalchemy import text, column
+
+from app.core.config import settings
+from app.core.database import get_db
+from app.core.redis import redis_client
+from app.models.chat import ChatMessage, ChatMessageKey
+
+logger = logging.getLogger(__name__)
+
+
+PARENT_TABLE = ChatMessage.__tablename__
+PARTITION_PATTERN = re.compile(rf"^{PARENT_TABLE}_p(\d{{4}})(\d{{2}})$")
+
+
+def _month_start(value: datetime, offset: int = 0) -> datetime:
+    """value所在月份偏移offset个月后的月初"""
+    month_index = value.year * 12 + value.month - 1 + offset
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def _json_default(value: Any) -> Any:
+    """导出时序列化数据库值"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return str(value)
+
+
+class MessageArchiver:
+    """消息分区维护与归档"""
+    
+    def __init__(self):
+        self.enabled = settings.CHAT_ARCHIVE_ENABLED
+        self.archive_path = Path(settings.CHAT_ARCHIVE_PATH)
+        self.retention = timedelta(days=settings.CHAT_ARCHIVE_RETENTION_DAYS)
+        self.premake_months = settings.CHAT_PARTITION_PREMAKE_MONTHS
+        
+        # 已加载的归档清单（分区名 -> 清单）
+        self._manifests: Dict[str, Dict[str, Any]] = {}
+        
+        # 导出时带类型的列，枚举和JSONB按模型类型解码
+        self._columns = [column(col.name, col.type) for col in ChatMessage.__table__.columns]
+        
+        # 统计信息
+        self.stats = {
+            "partitions_created": 0,
+            "partitions_archived": 0,
+            "rows_archived": 0,
+            "bytes_written": 0,
+            "keys_pruned": 0,
+            "archived_reads": 0,
+            "errors": 0,
+            "last_maintenance_time": None,
+            "last_archive_time": None
+        }
+    
+    def partition_name(self, month_start: datetime) -> str:
+        """月份对应的分区表名"""
+        return f"{PARENT_TABLE}_p{month_start.year:04d}{month_start.month:02d}"
+    
+    async def run_maintenance(self):
+        """创建未来分区并归档过期分区（多worker时只有取得锁的执行）"""
+        token = uuid.uuid4().hex
+        try:
+            locked = await redis_client.set(
+                settings.CHAT_ARCHIVE_LOCK_KEY, token, nx=True, ex=settings.CHAT_ARCHIVE_INTERVAL
+            )
+        except Exception as e:
+            logger.warning(f"获取归档锁失败，仅创建分区: {str(e)}")
+            locked = False
+        
+        try:
+            await self.ensure_partitions()
+            if locked and self.enabled:
+                await self.archive_expired_partitions()
+            self.stats["last_maintenance_time"] = datetime.utcnow()
+        finally:
+            if locked:
+                try:
+                    if await redis_client.get(settings.CHAT_ARCHIVE_LOCK_KEY) in (token, token.encode()):
+                        await redis_client.delete(settings.CHAT_ARCHIVE_LOCK_KEY)
+                except Exception:
+                    pass
+    
+    async def ensure_partitions(self):
+        """确保当月及未来若干个月的分区存在"""
+        now = datetime.utcnow()
+        async with get_db() as db:
+            for offset in range(self.premake_months + 1):
+                start = _month_start(now, offset)
+                end = _month_start(now, offset + 1)
+                name = self.partition_name(start)
+                
+                exists = await db.scalar(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name})
+                if exists:
+                    continue
+                
+                await db.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT_TABLE} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                ))
+                self.stats["partitions_created"] += 1
+                logger.info(f"创建消息分区: {name}")
+            
+            await db.commit()
+    
+    async def archive_expired_partitions(self):
+        """归档整月都早于保留期的分区"""
+        cutoff = datetime.utcnow() - self.retention
+        
+        for name, month_start, attached in await self._list_partitions():
+            if _month_start(month_start, 1) > cutoff:
+                continue
+            
+            try:
+                if attached:
+                    # 先分离，之后的导出和删除不再影响在线表
+                    async with get_db() as db:
+                        await db.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}"))
+                        await db.commit()
+                    logger.info(f"分离过期消息分区: {name}")
+                
+                # 清单已存在说明上次导出完成但删除前中断，直接删除
+                if not self._manifest_file(name).exists():
+                    await self._export_partition(name, month_start)
+                
+                async with get_db() as db:
+                    await db.execute(text(f"DROP TABLE IF EXISTS {name}"))
+                    await db.commit()
+                
+                self.stats["partitions_archived"] += 1
+                self.stats["last_archive_time"] = datetime.utcnow()
+                logger.info(f"消息分区归档完成: {name}")
+            
+            except Exception as e:
+                # 分离后导出失败的分区保留为独立表，下次继续导出
+                self.stats["errors"] += 1
+                logger.error(f"消息分区归档失败: {name}, {str(e)}")
+        
+        await self._prune_message_keys(_month_start(cutoff))
+    
+    async def _list_partitions(self) -> List[Tuple[str, datetime, bool]]:
+        """列出分区表（包括已分离、尚未删除的），返回 [(表名, 月初, 是否挂载)]，按月份排序"""
+        async with get_db() as db:
+            result = await db.execute(
+                text(
+                    "SELECT relname, relispartition FROM pg_class "
+                    "WHERE relkind = 'r' AND relname LIKE :pattern"
+                ),
+                {"pattern": f"{PARENT_TABLE}_p%"}
+            )
+            rows = result.all()
+        
+        partitions = []
+        for name, attached in rows:
+            match = PARTITION_PATTERN.match(name)
+            if match:
+                partitions.append((name, datetime(int(match.group(1)), int(match.group(2)), 1), attached))
+        
+        return sorted(partitions, key=lambda item: item[1])
+    
+    async def _export_partition(self, name: str, month_start: datetime):
+        """
+        导出分区为gzip JSONL：每个会话单独一个gzip成员（拼接后仍是合法gzip文件），
+        清单记录每个会话成员的偏移和长度，读回时只解压目标会话
+        """
+        await asyncio.to_thread(self.archive_path.mkdir, parents=True, exist_ok=True)
+        data_file = self.archive_path / f"{name}.jsonl.gz"
+        temp_file = data_file.with_suffix(".gz.tmp")
+        
+        sessions: Dict[str, List[int]] = {}
+        digest = hashlib.sha256()
+        row_count = 0
+        offset = 0
+        
+        column_names = ", ".join(col.name for col in self._columns)
+        query = (
+            text(f"SELECT {column_names} FROM {name} ORDER BY session_id, created_at")
+            .columns(*self._columns)
+        )
+        
+        # 压缩、写盘、fsync和替换都在线程池中执行，导出大分区时不阻塞事件循环
+        fh = await asyncio.to_thread(open, temp_file, "wb")
+        try:
+            current_session: Optional[str] = None
+            lines: List[str] = []
+            
+            async def flush_member():
+                nonlocal offset
+                if not lines:
+                    return
+                length = await asyncio.to_thread(self._write_member, fh, digest, "".join(lines))
+                sessions[current_session] = [offset, length, len(lines)]
+                offset += length
+                lines.clear()
+            
+            async with get_db() as db:
+                result = await db.stream(query)
+                async for row in result.mappings():
+                    session_id = str(row["session_id"])
+                    if session_id != current_session:
+                        await flush_member()
+                        current_session = session_id
+                    
+                    lines.append(json.dumps(dict(row), ensure_ascii=False, default=_json_default) + "\n")
+                    row_count += 1
+                
+                await flush_member()
+            
+            await asyncio.to_thread(self._sync_file, fh)
+        finally:
+            await asyncio.to_thread(fh.close)
+        
+        await asyncio.to_thread(os.replace, temp_file, data_file)
+        
+        manifest = {
+            "partition": name,
+            "range_start": month_start.isoformat(),
+            "range_end": _month_start(month_start, 1).isoformat(),
+            "file": data_file.name,
+            "format": "jsonl.gz",
+            "rows": row_count,
+            "bytes": offset,
+            "sha256": digest.hexdigest(),
+            "archived_at": datetime.utcnow().isoformat(),
+            "sessions": sessions
+        }
+        await asyncio.to_thread(self._write_manifest, name, manifest)
+        self._manifests[name] = manifest
+        
+        self.stats["rows_archived"] += row_count
+        self.stats["bytes_written"] += offset
+        logger.info(f"导出消息分区: {name}, {row_count} 条, {len(sessions)} 个会话, {offset} 字节")
+    
+    @staticmethod
+    def _write_member(fh, digest, content: str) -> int:
+        """压缩一个会话的消息为gzip成员并追加写入，返回成员长度（在线程池中执行）"""
+        member = gzip.compress(content.encode("utf-8"))
+        fh.write(member)
+        digest.update(member)
+        return len(member)
+    
+    @staticmethod
+    def _sync_file(fh):
+        """刷新并落盘（在线程池中执行）"""
+        fh.flush()
+        os.fsync(fh.fileno())
+    
+    async def _prune_message_keys(self, cutoff: datetime):
+        """删除已归档月份的GeWe消息ID去重记录"""
+        async with get_db() as db:
+            result = await db.execute(
+                ChatMessageKey.__table__.delete().where(ChatMessageKey.created_at < cutoff)
+            )
+            await db.commit()
+        self.stats["keys_pruned"] += result.rowcount or 0
+    
+    def _manifest_file(self, name: str) -> Path:
+        """分区清单路径"""
+        return self.archive_path / f"{name}.manifest.json"
+    
+    def _write_manifest(self, name: str, manifest: Dict[str, Any]):
+        """原子写入清单"""
+        path = self._manifest_file(name)
+        temp_path = path.with_suffix(".json.tmp")
+        with open(temp_path, "w", encoding="utf-8") as fh:
+            json.dump(manifest, fh, ensure_ascii=False)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp_path, path)
+    
+    def _load_manifests(self) -> List[Dict[str, Any]]:
+        """加载归档目录下的全部清单（按月份排序）"""
+        if self.archive_path.exists():
+            for path in self.archive_path.glob("*.manifest.json"):
+                name = path.name[:-len(".manifest.json")]
+                if name in self._manifests:
+                    continue
+                try:
+                    with open(path, encoding="utf-8") as fh:
+                        self._manifests[name] = json.load(fh)
+                except Exception as e:
+                    logger.error(f"读取归档清单失败: {path}, {str(e)}")
+        
+        return sorted(self._manifests.values(), key=lambda item: item["range_start"])
+    
+    def _read_member(self, manifest: Dict[str, Any], session_id: str) -> List[str]:
+        """读取并解压某个会话的gzip成员"""
+        offset, length, _ = manifest["sessions"][session_id]
+        with open(self.archive_path / manifest["file"], "rb") as fh:
+            fh.seek(offset)
+            member = fh.read(length)
+        return gzip.decompress(member).decode("utf-8").splitlines()
+    
+    async def iter_archived_messages(
+        self,
+        session_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> AsyncIterator[str]:
+        """按时间正序流式读取会话的归档消息（每条为一行JSON）"""
+        session_id = str(session_id)
+        manifests = await asyncio.to_thread(self._load_manifests)
+        
+        for manifest in manifests:
+            if session_id not in manifest["sessions"]:
+                continue
+            if start and datetime.fromisoformat(manifest["range_end"]) <= start.replace(tzinfo=None):
+                continue
+            if end and datetime.fromisoformat(manifest["range_start"]) >= end.replace(tzinfo=None):
+                continue
+            
+            self.stats["archived_reads"] += 1
+            lines = await asyncio.to_thread(self._read_member, manifest, session_id)
+            
+            for line in lines:
+                if start or end:
+                    created_at = datetime.fromisoformat(json.loads(line)["created_at"]).replace(tzinfo=None)
+                    if start and created_at < start.replace(tzinfo=None):
+                        continue
+                    if end and created_at >= end.replace(tzinfo=None):
+                        continue
+                yield line
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "archive_path": str(self.archive_path),
+            "retention_days": self.retention.days,
+            "archived_partitions": len(self._manifests)
+        }
+
+
+# 全局消息归档实例
+message_archiver = MessageArchiver()
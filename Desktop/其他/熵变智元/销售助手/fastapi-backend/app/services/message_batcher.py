@@ -0,0 +1,578 @@
+"""
+入站消息批量写入服务
+短时间窗口内攒批，批量解析联系人和会话，多行INSERT写入消息，并合并会话/联系人计数更新
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Set, Tuple, Union
+
+from sqlalchemy import select, update, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.database import get_db
+from app.models.device import WeChatAccount
+from app.models.chat import (
+    Contact, ChatSession, ChatMessage, ChatMessageKey,
+    ChatType, MessageDirection, MessageStatus
+)
+from app.services.resolution_cache import resolution_cache
+from app.services.history_cache import session_history_cache, history_entry
+from app.services.load_shedder import load_shedder
+
+logger = logging.getLogger(__name__)
+
+
+# 单条消息的写入结果：成功为 (会话, 消息)，被唯一索引跳过为 None，单条失败为异常
+BatchResult = Union[Tuple[ChatSession, ChatMessage], None, Exception]
+
+
+class MessageBatcher:
+    """入站消息批量写入器"""
+    
+    def __init__(self):
+        self.max_size = settings.CHAT_BATCH_MAX_SIZE
+        self.max_wait = settings.CHAT_BATCH_MAX_WAIT_MS / 1000
+        self.worker_count = settings.CHAT_BATCH_WORKERS
+        
+        # 有界队列：写入跟不上时阻塞消息流消费，积压留在Redis而不是进程内存
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.CHAT_BATCH_QUEUE_SIZE)
+        self.is_running = False
+        self.worker_tasks: List[asyncio.Task] = []
+        load_shedder.register("batcher", self.queue.qsize, settings.CHAT_BATCH_QUEUE_SIZE)
+        
+        # 最近的批大小、写入耗时和单条端到端延迟，用于计算分位数
+        self._batch_sizes = deque(maxlen=1000)
+        self._flush_times = deque(maxlen=1000)
+        self._latencies = deque(maxlen=5000)
+        
+        # 统计信息
+        self.stats = {
+            "submitted": 0,
+            "persisted": 0,
+            "skipped_duplicates": 0,
+            "item_errors": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "split_retries": 0,
+            "max_batch_size": 0,
+            "last_flush_time": None
+        }
+    
+    async def start(self):
+        """启动批量写入任务"""
+        if self.is_running:
+            return
+        
+        self.is_running = True
+        self.worker_tasks = [
+            asyncio.create_task(self._batch_loop())
+            for _ in range(max(1, self.worker_count))
+        ]
+        logger.info(
+            f"消息批量写入已启动: max_size={self.max_size}, "
+            f"max_wait={int(self.max_wait * 1000)}ms, workers={len(self.worker_tasks)}"
+        )
+    
+    async def stop(self):
+        """停止批量写入任务，未写入的消息以失败返回，由消息流重试"""
+        self.is_running = False
+        
+        for task in self.worker_tasks:
+            task.cancel()
+        
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks.clear()
+        
+        while not self.queue.empty():
+            _, future, _ = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("消息批量写入已停止"))
+        
+        logger.info("消息批量写入已停止")
+    
+    async def submit(self, message_data: Dict[str, Any]) -> Optional[Tuple[ChatSession, ChatMessage]]:
+        """
+        提交一条已解析的消息并等待所在批次写入完成
+        返回 (会话, 消息)；消息已存在（唯一索引冲突）时返回 None
+        """
+        if not self.is_running:
+            await self.start()
+        
+        # 入队时间作为消息创建时间，同一批次内仍保持到达顺序
+        message_data = {**message_data, "received_at": datetime.utcnow()}
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((message_data, future, time.monotonic()))
+        self.stats["submitted"] += 1
+        
+        return await future
+    
+    async def persist(self, message_data: Dict[str, Any]) -> Optional[Tuple[ChatSession, ChatMessage]]:
+        """不经攒批立即写入单条消息（关闭批量写入时使用）"""
+        message_data = {**message_data, "received_at": datetime.utcnow()}
+        
+        try:
+            async with get_db() as db:
+                results, new_entries = await self._persist_batch(db, [message_data])
+                await db.commit()
+        except Exception:
+            resolution_cache.discard_app(message_data["app_id"])
+            raise
+        
+        for key, entry in new_entries.items():
+            resolution_cache.set_contact(key[0], key[1], entry)
+        
+        await session_history_cache.append_many(
+            (session.id, history_entry(message))
+            for session, message in (
+                result for result in results
+                if result is not None and not isinstance(result, Exception)
+            )
+        )
+        
+        if isinstance(results[0], Exception):
+            raise results[0]
+        return results[0]
+    
+    async def _batch_loop(self):
+        """攒批循环：凑满 max_size 或等待超过 max_wait 即写入"""
+        loop = asyncio.get_running_loop()
+        
+        while self.is_running:
+            try:
+                batch = [await self.queue.get()]
+                deadline = loop.time() + self.max_wait
+                
+                while len(batch) < self.max_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                
+                await self._flush(batch)
+            
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"消息批量写入循环异常: {str(e)}")
+                await asyncio.sleep(0.1)
+    
+    async def _flush(self, batch: List[Tuple[Dict[str, Any], asyncio.Future, float]]):
+        """写入一个批次"""
+        started = time.monotonic()
+        
+        try:
+            async with get_db() as db:
+                results, new_entries = await self._persist_batch(db, [item[0] for item in batch])
+                await db.commit()
+        
+        except Exception as e:
+            self.stats["failed_batches"] += 1
+            
+            if len(batch) > 1:
+                # 单条脏数据不应拖累整批，逐条重试以隔离失败的消息
+                logger.warning(f"批量写入失败，拆分为单条重试: {len(batch)} 条, {str(e)}")
+                self.stats["split_retries"] += 1
+                for item in batch:
+                    await self._flush([item])
+                return
+            
+            logger.error(f"消息写入失败: {str(e)}")
+            self.stats["item_errors"] += 1
+            message_data, future, _ = batch[0]
+            # 缓存的ID可能已失效（如联系人被删除），丢弃后由重试重新解析
+            resolution_cache.discard_app(message_data["app_id"])
+            if not future.done():
+                future.set_exception(e)
+            return
+        
+        for key, entry in new_entries.items():
+            resolution_cache.set_contact(key[0], key[1], entry)
+        
+        finished = time.monotonic()
+        self.stats["batches"] += 1
+        self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+        self.stats["last_flush_time"] = datetime.utcnow()
+        self._batch_sizes.append(len(batch))
+        self._flush_times.append(finished - started)
+        
+        for (_, future, enqueued_at), result in zip(batch, results):
+            self._latencies.append(finished - enqueued_at)
+            
+            if isinstance(result, Exception):
+                self.stats["item_errors"] += 1
+            elif result is None:
+                self.stats["skipped_duplicates"] += 1
+            else:
+                self.stats["persisted"] += 1
+            
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    
+    async def _persist_batch(
+        self,
+        db: AsyncSession,
+        items: List[Dict[str, Any]]
+    ) -> Tuple[List[BatchResult], Dict[Tuple[Any, str], Dict[str, Any]]]:
+        """
+        在一个事务内写入整批消息
+        返回每条消息的写入结果，以及本批新解析出的联系人/会话映射（提交成功后再写入缓存）
+        """
+        results: List[BatchResult] = [None] * len(items)
+        
+        # 1. 解析微信账号：先查缓存，未命中的一次批量查询
+        accounts = await self._resolve_accounts(db, {item["app_id"] for item in items})
+        
+        contact_keys: Dict[int, Tuple[Any, str]] = {}
+        for index, item in enumerate(items):
+            account = accounts.get(item["app_id"])
+            if not account:
+                results[index] = ValueError(f"未找到对应的微信账号: {item['app_id']}")
+                continue
+            contact_keys[index] = (account["id"], self._contact_wxid(item))
+        
+        if not contact_keys:
+            return results, {}
+        
+        # 2. 解析联系人和会话：先查缓存，未命中的以 upsert 一次性获取或创建
+        resolved: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+        for key in set(contact_keys.values()):
+            cached = resolution_cache.get_contact(*key)
+            if cached:
+                resolved[key] = cached
+        
+        missing_keys = {
+            index: key for index, key in contact_keys.items() if key not in resolved
+        }
+        new_entries: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+        if missing_keys:
+            contacts = await self._resolve_contacts(db, items, accounts, missing_keys)
+            new_entries = await self._resolve_sessions(db, items, missing_keys, contacts)
+            resolved.update(new_entries)
+        
+        # 3. 先登记GeWe消息ID，已存在的直接跳过，再多行INSERT写入消息
+        rows = [
+            self._message_row(resolved[key]["session_id"], items[index])
+            for index, key in contact_keys.items()
+        ]
+        
+        inserted_ids = await self._claim_message_keys(db, rows)
+        message_rows = [row for row in rows if row["id"] in inserted_ids]
+        if message_rows:
+            await db.execute(pg_insert(ChatMessage.__table__).values(message_rows))
+        
+        # 4. 按会话和联系人合并计数，一次批量更新
+        session_updates: Dict[Any, Dict[str, Any]] = {}
+        contact_updates: Dict[Any, Dict[str, Any]] = {}
+        
+        for (index, key), row in zip(contact_keys.items(), rows):
+            if row["id"] not in inserted_ids:
+                continue
+            
+            entry = resolved[key]
+            message = ChatMessage(**row)
+            # 会话只读视图，仅供调用方判断是否需要AI处理、计算优先级和推送，不加入数据库会话
+            session = ChatSession(
+                id=entry["session_id"],
+                chat_type=entry["chat_type"],
+                ai_enabled=entry["ai_enabled"],
+                auto_reply_enabled=entry["auto_reply_enabled"],
+                contact=Contact(id=entry["contact_id"], tags=entry["contact_tags"] or [])
+            )
+            results[index] = (session, message)
+            
+            session_update = session_updates.setdefault(entry["session_id"], {
+                "b_id": entry["session_id"],
+                "b_count": 0
+            })
+            session_update["b_count"] += 1
+            session_update["b_last_message_id"] = message.id
+            session_update["b_last_message_preview"] = (
+                message.content[:100] if message.content else f"[{message.message_type.value}]"
+            )
+            session_update["b_last_message_at"] = message.created_at
+            
+            contact_update = contact_updates.setdefault(entry["contact_id"], {
+                "b_id": entry["contact_id"],
+                "b_count": 0
+            })
+            contact_update["b_count"] += 1
+            contact_update["b_last_message_at"] = message.created_at
+        
+        if session_updates:
+            session_table = ChatSession.__table__
+            await db.execute(
+                update(session_table)
+                .where(session_table.c.id == bindparam("b_id"))
+                .values(
+                    total_messages=session_table.c.total_messages + bindparam("b_count"),
+                    unread_count=session_table.c.unread_count + bindparam("b_count"),
+                    last_message_id=bindparam("b_last_message_id"),
+                    last_message_preview=bindparam("b_last_message_preview"),
+                    last_message_at=bindparam("b_last_message_at"),
+                    last_activity_at=bindparam("b_last_message_at")
+                ),
+                [session_updates[key] for key in sorted(session_updates, key=str)]
+            )
+        
+        if contact_updates:
+            contact_table = Contact.__table__
+            await db.execute(
+                update(contact_table)
+                .where(contact_table.c.id == bindparam("b_id"))
+                .values(
+                    total_messages_received=contact_table.c.total_messages_received + bindparam("b_count"),
+                    last_message_at=bindparam("b_last_message_at")
+                ),
+                [contact_updates[key] for key in sorted(contact_updates, key=str)]
+            )
+        
+        return results, new_entries
+    
+    async def _resolve_accounts(
+        self,
+        db: AsyncSession,
+        app_ids: Set[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        """批量解析微信账号"""
+        accounts: Dict[str, Dict[str, Any]] = {}
+        missing = set()
+        for app_id in app_ids:
+            cached = resolution_cache.get_account(app_id)
+            if cached:
+                accounts[app_id] = cached
+            else:
+                missing.add(app_id)
+        
+        if missing:
+            account_result = await db.execute(
+                select(
+                    WeChatAccount.id,
+                    WeChatAccount.organization_id,
+                    WeChatAccount.gewe_app_id
+                ).where(WeChatAccount.gewe_app_id.in_(missing))
+            )
+            for row in account_result.all():
+                accounts[row.gewe_app_id] = {"id": row.id, "organization_id": row.organization_id}
+                resolution_cache.set_account(row.gewe_app_id, row.id, row.organization_id)
+        
+        return accounts
+    
+    async def _resolve_contacts(
+        self,
+        db: AsyncSession,
+        items: List[Dict[str, Any]],
+        accounts: Dict[str, Dict[str, Any]],
+        contact_keys: Dict[int, Tuple[Any, str]]
+    ) -> Dict[Tuple[Any, str], Dict[str, Any]]:
+        """
+        批量获取或创建联系人
+        单条 INSERT ... ON CONFLICT DO UPDATE ... RETURNING，新老联系人一次往返全部返回，并发回调不会产生重复联系人
+        """
+        rows: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+        now = datetime.utcnow()
+        for index, key in contact_keys.items():
+            if key in rows:
+                continue
+            
+            item = items[index]
+            account = accounts[item["app_id"]]
+            is_group = item["chat_type"] == ChatType.GROUP
+            rows[key] = {
+                "id": uuid.uuid4(),
+                "organization_id": account["organization_id"],
+                "wechat_account_id": account["id"],
+                "wxid": key[1],
+                "nickname": None if is_group else item.get("sender_nickname"),
+                "contact_type": "group" if is_group else "friend",
+                "total_messages_received": 0,
+                "total_messages_sent": 0,
+                "first_contact_at": now,
+                "last_message_at": now
+            }
+        
+        # 按键排序写入，并发批次以相同顺序加行锁，避免死锁
+        contact_table = Contact.__table__
+        statement = pg_insert(contact_table).values([rows[key] for key in sorted(rows, key=str)])
+        contact_result = await db.execute(
+            statement
+            .on_conflict_do_update(
+                index_elements=[contact_table.c.wechat_account_id, contact_table.c.wxid],
+                # 已存在时只刷新最后消息时间，保证 RETURNING 能返回已有行
+                set_={"last_message_at": statement.excluded.last_message_at}
+            )
+            .returning(
+                contact_table.c.id,
+                contact_table.c.organization_id,
+                contact_table.c.wechat_account_id,
+                contact_table.c.wxid,
+                contact_table.c.remark,
+                contact_table.c.nickname,
+                contact_table.c.tags
+            )
+        )
+        
+        return {
+            (row.wechat_account_id, row.wxid): {
+                "id": row.id,
+                "organization_id": row.organization_id,
+                "display_name": row.remark or row.nickname or row.wxid,
+                "tags": row.tags
+            }
+            for row in contact_result.all()
+        }
+    
+    async def _resolve_sessions(
+        self,
+        db: AsyncSession,
+        items: List[Dict[str, Any]],
+        contact_keys: Dict[int, Tuple[Any, str]],
+        contacts: Dict[Tuple[Any, str], Dict[str, Any]]
+    ) -> Dict[Tuple[Any, str], Dict[str, Any]]:
+        """批量获取或创建会话（按联系人键返回），同样一次 ON CONFLICT 往返"""
+        rows: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+        now = datetime.utcnow()
+        for index, key in contact_keys.items():
+            if key in rows:
+                continue
+            
+            contact = contacts[key]
+            rows[key] = {
+                "id": uuid.uuid4(),
+                "organization_id": contact["organization_id"],
+                "wechat_account_id": key[0],
+                "contact_id": contact["id"],
+                "chat_type": items[index]["chat_type"],
+                "session_name": contact["display_name"],
+                "total_messages": 0,
+                "unread_count": 0,
+                "last_activity_at": now
+            }
+        
+        session_table = ChatSession.__table__
+        statement = pg_insert(session_table).values([rows[key] for key in sorted(rows, key=str)])
+        session_result = await db.execute(
+            statement
+            .on_conflict_do_update(
+                index_elements=[session_table.c.wechat_account_id, session_table.c.contact_id],
+                set_={"last_activity_at": statement.excluded.last_activity_at}
+            )
+            .returning(
+                session_table.c.id,
+                session_table.c.contact_id,
+                session_table.c.chat_type,
+                session_table.c.ai_enabled,
+                session_table.c.auto_reply_enabled
+            )
+        )
+        by_contact = {row.contact_id: row for row in session_result.all()}
+        
+        sessions: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+        for key, contact in contacts.items():
+            row = by_contact[contact["id"]]
+            sessions[key] = {
+                "contact_id": contact["id"],
+                "session_id": row.id,
+                "chat_type": row.chat_type,
+                "contact_tags": contact["tags"],
+                "ai_enabled": row.ai_enabled,
+                "auto_reply_enabled": row.auto_reply_enabled
+            }
+        
+        return sessions
+    
+    def _contact_wxid(self, message_data: Dict[str, Any]) -> str:
+        """确定联系人微信ID（群聊时联系人是群）"""
+        if message_data["chat_type"] == ChatType.GROUP:
+            return message_data["receiver_wxid"]
+        return message_data["sender_wxid"]
+    
+    async def _claim_message_keys(self, db: AsyncSession, rows: List[Dict[str, Any]]) -> Set[Any]:
+        """登记GeWe消息ID，返回可以写入的消息ID（同批内重复的只保留第一条）"""
+        keyed = [row for row in rows if row["gewe_message_id"]]
+        claimed = {row["id"] for row in rows if not row["gewe_message_id"]}
+        if not keyed:
+            return claimed
+        
+        key_table = ChatMessageKey.__table__
+        result = await db.execute(
+            pg_insert(key_table)
+            .values([
+                {
+                    "gewe_message_id": row["gewe_message_id"],
+                    "message_id": row["id"],
+                    "created_at": row["created_at"]
+                }
+                for row in keyed
+            ])
+            .on_conflict_do_nothing(index_elements=[key_table.c.gewe_message_id])
+            .returning(key_table.c.message_id)
+        )
+        claimed.update(row[0] for row in result.all())
+        return claimed
+    
+    def _message_row(self, session_id: Any, message_data: Dict[str, Any]) -> Dict[str, Any]:
+        """构建消息行数据"""
+        return {
+            "id": uuid.uuid4(),
+            "session_id": session_id,
+            "message_type": message_data["message_type"],
+            "direction": MessageDirection.INCOMING,
+            "content": message_data.get("content"),
+            "sender_wxid": message_data["sender_wxid"],
+            "sender_nickname": message_data.get("sender_nickname"),
+            "media_url": message_data.get("media_url"),
+            "media_type": message_data.get("media_type"),
+            "gewe_message_id": message_data.get("gewe_message_id"),
+            "gewe_timestamp": message_data.get("gewe_timestamp"),
+            "status": MessageStatus.DELIVERED,
+            # 写入即投递AI任务，租约从收到时开始计算，恢复扫描不会重复认领
+            "ai_claimed_at": message_data["received_at"],
+            "created_at": message_data["received_at"]
+        }
+    
+    def _percentile(self, values: deque, percent: float) -> Optional[float]:
+        """计算分位数"""
+        if not values:
+            return None
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, int(len(ordered) * percent))
+        return ordered[index]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        avg_batch_size = (
+            sum(self._batch_sizes) / len(self._batch_sizes) if self._batch_sizes else 0
+        )
+        p50_latency = self._percentile(self._latencies, 0.5)
+        p99_latency = self._percentile(self._latencies, 0.99)
+        p99_flush = self._percentile(self._flush_times, 0.99)
+        
+        return {
+            **self.stats,
+            "queue_size": self.queue.qsize(),
+            "avg_batch_size": round(avg_batch_size, 2),
+            "latency_p50_ms": round(p50_latency * 1000, 2) if p50_latency is not None else None,
+            "latency_p99_ms": round(p99_latency * 1000, 2) if p99_latency is not None else None,
+            "flush_p99_ms": round(p99_flush * 1000, 2) if p99_flush is not None else None,
+            "max_size": self.max_size,
+            "max_wait_ms": int(self.max_wait * 1000),
+            "is_running": self.is_running
+        }
+
+
+# 全局消息批量写入实例
+message_batcher = MessageBatcher()
@@ -0,0 +1,137 @@
+"""
+连发消息合并服务
+客户经常连续发送多条短消息，按会话设置防抖窗口，把窗口内的消息合并为一次AI请求
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+CoalescedJobHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class MessageCoalescer:
+    """按会话合并连发消息"""
+    
+    def __init__(self):
+        self.debounce = settings.CHAT_COALESCE_DEBOUNCE_MS / 1000
+        self.max_wait = settings.CHAT_COALESCE_MAX_WAIT_MS / 1000
+        
+        self.handler: Optional[CoalescedJobHandler] = None
+        # session_id -> 合并窗口
+        self._windows: Dict[str, Dict[str, Any]] = {}
+        
+        # 统计信息
+        self.stats = {
+            "messages": 0,
+            "jobs_emitted": 0,
+            "superseded_replies": 0,
+            "max_messages_per_job": 0,
+            "last_emit_time": None
+        }
+    
+    def start(self, handler: CoalescedJobHandler):
+        """设置窗口关闭后的任务处理函数"""
+        self.handler = handler
+    
+    async def stop(self):
+        """取消所有未关闭的窗口，其消息流ID未确认，会被重新投递"""
+        for window in self._windows.values():
+            window["timer"].cancel()
+        self._windows.clear()
+    
+    async def add(
+        self,
+        session_id: str,
+        message_id: str,
+        stream_id: Optional[str] = None,
+        carried: Optional[Dict[str, Any]] = None,
+        priority: float = 0
+    ):
+        """
+        加入一条消息
+        carried 为被取代的进行中回复所包含的消息，排在本条消息之前一起重新处理；
+        合并任务的优先级取窗口内消息的最高值
+        """
+        window = self._windows.get(session_id)
+        if window is None:
+            window = {
+                "message_ids": [],
+                "stream_ids": [],
+                "priority": priority,
+                "opened_at": time.monotonic(),
+                "timer": None
+            }
+            self._windows[session_id] = window
+        
+        if carried:
+            self.stats["superseded_replies"] += 1
+            window["message_ids"] = carried.get("message_ids", []) + window["message_ids"]
+            window["stream_ids"] = carried.get("stream_ids", []) + window["stream_ids"]
+            window["priority"] = max(window["priority"], carried.get("priority", 0))
+        
+        window["priority"] = max(window["priority"], priority)
+        
+        window["message_ids"].append(message_id)
+        if stream_id:
+            window["stream_ids"].append(stream_id)
+        self.stats["messages"] += 1
+        
+        # 重置防抖计时，但不超过从窗口打开起的最长等待
+        if window["timer"]:
+            window["timer"].cancel()
+        remaining = self.max_wait - (time.monotonic() - window["opened_at"])
+        delay = max(0.0, min(self.debounce, remaining))
+        window["timer"] = asyncio.create_task(self._close_after(session_id, window, delay))
+    
+    async def _close_after(self, session_id: str, window: Dict[str, Any], delay: float):
+        """等待静默期结束后关闭窗口并提交合并任务"""
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            return
+        
+        if self._windows.get(session_id) is not window:
+            return
+        del self._windows[session_id]
+        
+        job = {
+            "type": "ai_process",
+            "session_id": session_id,
+            "message_ids": window["message_ids"],
+            "stream_ids": window["stream_ids"],
+            "priority": window["priority"]
+        }
+        
+        self.stats["jobs_emitted"] += 1
+        self.stats["max_messages_per_job"] = max(
+            self.stats["max_messages_per_job"], len(window["message_ids"])
+        )
+        self.stats["last_emit_time"] = datetime.utcnow()
+        
+        try:
+            await self.handler(job)
+        except Exception as e:
+            logger.error(f"提交合并任务失败: {session_id}, {str(e)}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        jobs = self.stats["jobs_emitted"]
+        return {
+            **self.stats,
+            "open_windows": len(self._windows),
+            "avg_messages_per_job": round(self.stats["messages"] / jobs, 2) if jobs else 0,
+            "debounce_ms": int(self.debounce * 1000),
+            "max_wait_ms": int(self.max_wait * 1000)
+        }
+
+
+# 全局连发消息合并实例
+message_coalescer = MessageCoalescer()
@@ -0,0 +1,171 @@
+"""
+消息去重服务
+在任何数据库操作之前过滤GeWe重试的回调，避免重复入库和重复的AI回复
+"""
+
+import hashlib
+import logging
+import math
+import time
+from typing import Dict, Any, Optional
+
+from app.core.config import settings
+from app.core.redis import redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """进程内布隆过滤器（按TTL轮换两代，保证内存有界）"""
+    
+    def __init__(self, capacity: int, error_rate: float, rotate_seconds: int):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rotate_seconds = rotate_seconds
+        
+        # 按容量和误判率计算位数组大小和哈希函数个数
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        
+        self._current = bytearray((self.size + 7) // 8)
+        self._previous = bytearray((self.size + 7) // 8)
+        self._rotated_at = time.monotonic()
+        self.count = 0
+    
+    def _positions(self, key: str):
+        """双重哈希生成位位置"""
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+    
+    def _maybe_rotate(self):
+        """超过TTL或容量时轮换，上一代继续参与查询"""
+        if time.monotonic() - self._rotated_at < self.rotate_seconds and self.count < self.capacity:
+            return
+        self._previous = self._current
+        self._current = bytearray((self.size + 7) // 8)
+        self._rotated_at = time.monotonic()
+        self.count = 0
+    
+    def add(self, key: str) -> None:
+        """添加元素"""
+        self._maybe_rotate()
+        for pos in self._positions(key):
+            self._current[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+    
+    def __contains__(self, key: str) -> bool:
+        positions = list(self._positions(key))
+        for bits in (self._current, self._previous):
+            if all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+                return True
+        return False
+
+
+class MessageDeduplicator:
+    """GeWe消息去重器"""
+    
+    def __init__(self):
+        self.key_prefix = settings.DEDUP_KEY_PREFIX
+        self.ttl = settings.DEDUP_TTL_SECONDS
+        self.processing_ttl = settings.DEDUP_PROCESSING_TTL_SECONDS
+        
+        # 可选的进程内布隆过滤器：命中即视为重复，不再访问Redis。
+        # 误判会丢弃一条新消息，因此默认关闭，开启时应使用极低的误判率
+        self.bloom: Optional[BloomFilter] = None
+        if settings.DEDUP_BLOOM_ENABLED:
+            self.bloom = BloomFilter(
+                capacity=settings.DEDUP_BLOOM_CAPACITY,
+                error_rate=settings.DEDUP_BLOOM_ERROR_RATE,
+                rotate_seconds=self.ttl
+            )
+        
+        # 统计信息
+        self.stats = {
+            "checked": 0,
+            "duplicates": 0,
+            "bloom_hits": 0,
+            "redis_hits": 0,
+            "db_conflicts": 0,
+            "redis_errors": 0
+        }
+    
+    def _make_key(self, gewe_message_id: str, app_id: Optional[str] = None) -> str:
+        return f"{self.key_prefix}:{app_id or '-'}:{gewe_message_id}"
+    
+    async def claim(self, gewe_message_id: Optional[str], app_id: Optional[str] = None) -> bool:
+        """
+        占用消息ID
+        返回True表示首次出现，应继续处理；返回False表示重复回调
+        占用只保留较短的处理时长，处理成功后由 confirm 延长：进程崩溃或被取消时占用自动过期，
+        消息流重新投递时不会被误判为重复
+        """
+        if not gewe_message_id:
+            return True
+        
+        self.stats["checked"] += 1
+        key = self._make_key(gewe_message_id, app_id)
+        
+        if self.bloom is not None and key in self.bloom:
+            self.stats["bloom_hits"] += 1
+            self.stats["duplicates"] += 1
+            return False
+        
+        try:
+            claimed = await redis_client.set(key, "processing", nx=True, ex=self.processing_ttl)
+        except Exception as e:
+            # Redis不可用时放行，由数据库唯一索引兜底
+            self.stats["redis_errors"] += 1
+            logger.warning(f"消息去重检查失败，交由数据库唯一索引兜底: {str(e)}")
+            return True
+        
+        if not claimed:
+            self.stats["redis_hits"] += 1
+            self.stats["duplicates"] += 1
+            return False
+        
+        return True
+    
+    async def confirm(self, gewe_message_id: Optional[str], app_id: Optional[str] = None) -> None:
+        """消息已入库，占用延长为完整的去重时长，并记入布隆过滤器"""
+        if not gewe_message_id:
+            return
+        
+        key = self._make_key(gewe_message_id, app_id)
+        if self.bloom is not None:
+            self.bloom.add(key)
+        
+        try:
+            await redis_client.set(key, "1", ex=self.ttl)
+        except Exception as e:
+            # 占用过期后由数据库唯一索引兜底
+            self.stats["redis_errors"] += 1
+            logger.warning(f"延长消息去重标记失败: {gewe_message_id}, {str(e)}")
+    
+    async def release(self, gewe_message_id: Optional[str], app_id: Optional[str] = None) -> None:
+        """处理失败时释放占用，允许GeWe或消息流重试"""
+        if not gewe_message_id:
+            return
+        
+        try:
+            await redis_client.delete(self._make_key(gewe_message_id, app_id))
+        except Exception as e:
+            logger.warning(f"释放消息去重标记失败: {gewe_message_id}, {str(e)}")
+    
+    def record_db_conflict(self) -> None:
+        """记录被数据库唯一索引拦截的重复消息"""
+        self.stats["db_conflicts"] += 1
+        self.stats["duplicates"] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            **self.stats,
+            "bloom_enabled": self.bloom is not None
+        }
+
+
+# 全局消息去重实例
+message_deduplicator = MessageDeduplicator()
@@ -0,0 +1,635 @@
+"""
+Redis Streams消息流服务
+为GeWe回调和AI任务提供跨进程、可持久化的队列，支持消费组、确认、待确认消息认领和积压指标；
+AI任务流按会话分片，每个分片同一时刻只由一个worker消费
+"""
+
+import asyncio
+import json
+import logging
+import math
+import os
+import socket
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Tuple
+
+from app.core.config import settings
+from app.core.redis import redis_client
+
+logger = logging.getLogger(__name__)
+
+
+StreamHandler = Callable[[Dict[str, Any], str], Awaitable[Any]]
+
+
+# 续约：租约仍属于自己时才延长
+LEASE_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# 释放：租约仍属于自己时才删除
+LEASE_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _to_str(value: Any) -> str:
+    """兼容decode_responses开关的字符串转换"""
+    if isinstance(value, bytes):
+        return value.decode()
+    return str(value)
+
+
+class MessageStream:
+    """基于Redis Streams的持久化消息流"""
+    
+    def __init__(
+        self,
+        stream_key: str,
+        group_name: str = None,
+        auto_ack: bool = True
+    ):
+        self.stream_key = stream_key
+        self.group_name = group_name or settings.STREAM_CONSUMER_GROUP
+        self.dead_letter_key = f"{stream_key}:dead"
+        # 每个worker进程使用独立的消费者名，崩溃后其待确认消息由其他消费者认领
+        self.consumer_name = f"{socket.gethostname()}-{os.getpid()}"
+        # auto_ack=False 时由处理函数在真正完成后调用 ack()
+        self.auto_ack = auto_ack
+        
+        # 读取和认领配置
+        self.max_len = settings.STREAM_MAX_LEN
+        self.read_count = settings.STREAM_READ_COUNT
+        self.block_ms = settings.STREAM_BLOCK_MS
+        self.reclaim_idle_ms = settings.STREAM_RECLAIM_IDLE_MS
+        self.reclaim_interval = settings.STREAM_RECLAIM_INTERVAL
+        self.max_deliveries = settings.STREAM_MAX_DELIVERIES
+        # 心跳间隔取认领阈值的三分之一，处理中的消息不会被判定为空闲
+        self.heartbeat_interval = self.reclaim_idle_ms / 1000 / 3
+        
+        self.handler: Optional[StreamHandler] = None
+        self.is_running = False
+        self.consumer_tasks: List[asyncio.Task] = []
+        self._group_ready = False
+        
+        # 处理函数在独立任务中执行，读取、认领和心跳循环不会被慢处理阻塞；任务数有上限
+        self.max_handlers = settings.STREAM_MAX_HANDLERS
+        self._handler_slots = asyncio.Semaphore(self.max_handlers)
+        self._handler_tasks: set = set()
+        
+        # 本进程已读取、尚未确认的消息ID；认领时跳过，并定期刷新其空闲时间，避免被其他消费者认领
+        self._in_flight: set = set()
+        
+        # 统计信息（本进程）
+        self.stats = {
+            "published": 0,
+            "publish_failures": 0,
+            "delivered": 0,
+            "acked": 0,
+            "reclaimed": 0,
+            "heartbeats": 0,
+            "dead_lettered": 0,
+            "handler_errors": 0,
+            "last_publish_time": None,
+            "last_delivery_time": None
+        }
+    
+    async def start(self, handler: StreamHandler):
+        """启动消费者（读取循环 + 心跳循环 + 待确认消息认领循环）"""
+        if self.is_running:
+            logger.warning(f"消息流消费者已在运行: {self.stream_key}")
+            return
+        
+        self.handler = handler
+        self.is_running = True
+        await self._ensure_group()
+        
+        self.consumer_tasks = [
+            asyncio.create_task(self._consume_loop()),
+            asyncio.create_task(self._heartbeat_loop()),
+            asyncio.create_task(self._reclaim_loop())
+        ]
+        logger.info(f"消息流消费者已启动: {self.stream_key} ({self.group_name}/{self.consumer_name})")
+    
+    async def stop(self):
+        """停止消费者，未确认的消息留在PEL中等待认领"""
+        self.is_running = False
+        
+        for task in self.consumer_tasks:
+            task.cancel()
+        
+        await asyncio.gather(*self.consumer_tasks, return_exceptions=True)
+        self.consumer_tasks.clear()
+        
+        # 取消执行中的处理函数，其消息未确认，等待认领
+        handler_tasks = list(self._handler_tasks)
+        for task in handler_tasks:
+            task.cancel()
+        await asyncio.gather(*handler_tasks, return_exceptions=True)
+        self._in_flight.clear()
+        logger.info(f"消息流消费者已停止: {self.stream_key}")
+    
+    async def publish(self, payload: Dict[str, Any]) -> Optional[str]:
+        """追加消息到流，返回消息ID"""
+        try:
+            entry_id = await redis_client.xadd(
+                self.stream_key,
+                {
+                    "data": json.dumps(payload, ensure_ascii=False, default=str),
+                    "enqueued_at": str(time.time())
+                },
+                maxlen=self.max_len,
+                approximate=True
+            )
+            
+            self.stats["published"] += 1
+            self.stats["last_publish_time"] = datetime.utcnow()
+            return _to_str(entry_id)
+        
+        except Exception as e:
+            self.stats["publish_failures"] += 1
+            logger.error(f"写入消息流失败: {self.stream_key}, {str(e)}")
+            return None
+    
+    async def ack(self, *entry_ids: str) -> int:
+        """确认消息已处理完成"""
+        if not entry_ids:
+            return 0
+        
+        self._in_flight.difference_update(entry_ids)
+        try:
+            acked = await redis_client.xack(self.stream_key, self.group_name, *entry_ids)
+            self.stats["acked"] += acked
+            return acked
+        except Exception as e:
+            logger.error(f"确认消息失败: {self.stream_key}, {str(e)}")
+            return 0
+    
+    async def _ensure_group(self):
+        """创建消费组（已存在时忽略）"""
+        if self._group_ready:
+            return
+        
+        try:
+            await redis_client.xgroup_create(
+                self.stream_key,
+                self.group_name,
+                id="0",
+                mkstream=True
+            )
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        
+        self._group_ready = True
+    
+    async def _consume_loop(self):
+        """读取新消息"""
+        while self.is_running:
+            try:
+                response = await redis_client.xreadgroup(
+                    groupname=self.group_name,
+                    consumername=self.consumer_name,
+                    streams={self.stream_key: ">"},
+                    count=self.read_count,
+                    block=self.block_ms
+                )
+                
+                # 同一次读取的消息并发处理（下游批量写入才能攒成批次），处理函数数量达到上限时暂停读取
+                for _, entries in response or []:
+                    for entry_id, fields in entries:
+                        await self._spawn(_to_str(entry_id), fields)
+            
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                if "NOGROUP" in str(e):
+                    # 流被删除后重建消费组
+                    self._group_ready = False
+                    await self._ensure_group()
+                    continue
+                logger.error(f"消息流读取异常: {self.stream_key}, {str(e)}")
+                await asyncio.sleep(1)
+    
+    async def _heartbeat_loop(self):
+        """定期刷新本进程处理中消息的空闲时间（独立于认领循环，不受处理耗时影响）"""
+        while self.is_running:
+            try:
+                await asyncio.sleep(self.heartbeat_interval)
+                await self._heartbeat_in_flight()
+            
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"刷新处理中消息失败: {self.stream_key}, {str(e)}")
+    
+    async def _reclaim_loop(self):
+        """认领崩溃消费者遗留的待确认消息"""
+        while self.is_running:
+            try:
+                await asyncio.sleep(self.reclaim_interval)
+                await self._reclaim_pending()
+            
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"认领待确认消息异常: {self.stream_key}, {str(e)}")
+    
+    async def _heartbeat_in_flight(self):
+        """
+        重新认领本进程处理中的消息（JUSTID 不增加投递次数），刷新其空闲时间
+        AI任务在合并窗口、处理通道和AI调用期间一直处于待确认状态，可能远超认领阈值
+        """
+        entry_ids = list(self._in_flight)
+        for start in range(0, len(entry_ids), 500):
+            await redis_client.xclaim(
+                self.stream_key,
+                self.group_name,
+                self.consumer_name,
+                min_idle_time=0,
+                message_ids=entry_ids[start:start + 500],
+                justid=True
+            )
+        if entry_ids:
+            self.stats["heartbeats"] += 1
+    
+    async def _reclaim_pending(self) -> int:
+        """认领空闲时间超过阈值的待确认消息，超过最大投递次数的转入死信流"""
+        pending = await redis_client.xpending_range(
+            self.stream_key,
+            self.group_name,
+            min="-",
+            max="+",
+            count=self.read_count,
+            idle=self.reclaim_idle_ms
+        )
+        if not pending:
+            return 0
+        
+        retry_ids = []
+        for item in pending:
+            entry_id = _to_str(item["message_id"])
+            if entry_id in self._in_flight:
+                # 本进程仍在处理
+                continue
+            if item["times_delivered"] >= self.max_deliveries:
+                await self._move_to_dead_letter(entry_id, item["times_delivered"])
+            else:
+                retry_ids.append(entry_id)
+        
+        if not retry_ids:
+            return 0
+        
+        claimed = await redis_client.xclaim(
+            self.stream_key,
+            self.group_name,
+            self.consumer_name,
+            min_idle_time=self.reclaim_idle_ms,
+            message_ids=retry_ids
+        )
+        
+        for entry_id, fields in claimed:
+            if fields is None:
+                # 消息已被裁剪，直接确认
+                await self.ack(_to_str(entry_id))
+                continue
+            self.stats["reclaimed"] += 1
+            await self._spawn(_to_str(entry_id), fields)
+        
+        if claimed:
+            logger.info(f"认领待确认消息: {self.stream_key}, {len(claimed)} 条")
+        return len(claimed)
+    
+    async def _move_to_dead_letter(self, entry_id: str, times_delivered: int):
+        """转入死信流并确认原消息"""
+        try:
+            entries = await redis_client.xrange(self.stream_key, min=entry_id, max=entry_id)
+            if entries:
+                _, fields = entries[0]
+                await redis_client.xadd(
+                    self.dead_letter_key,
+                    {
+                        **{_to_str(k): _to_str(v) for k, v in fields.items()},
+                        "source_id": entry_id,
+                        "times_delivered": str(times_delivered)
+                    },
+                    maxlen=self.max_len,
+                    approximate=True
+                )
+            
+            await self.ack(entry_id)
+            self.stats["dead_lettered"] += 1
+            logger.warning(f"消息超过最大投递次数，转入死信流: {self.stream_key} {entry_id}")
+        
+        except Exception as e:
+            logger.error(f"转入死信流失败: {entry_id}, {str(e)}")
+    
+    async def _spawn(self, entry_id: str, fields: Dict[Any, Any]):
+        """在独立任务中处理消息，执行中的处理函数达到上限时等待"""
+        self._in_flight.add(entry_id)
+        await self._handler_slots.acquire()
+        task = asyncio.create_task(self._dispatch(entry_id, fields))
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._handler_done)
+    
+    def _handler_done(self, task: asyncio.Task):
+        """处理函数结束，释放名额"""
+        self._handler_tasks.discard(task)
+        self._handler_slots.release()
+    
+    async def _dispatch(self, entry_id: str, fields: Dict[Any, Any]):
+        """解析消息并调用处理函数"""
+        self._in_flight.add(entry_id)
+        self.stats["delivered"] += 1
+        self.stats["last_delivery_time"] = datetime.utcnow()
+        
+        try:
+            payload = self._decode_fields(fields)
+        except Exception as e:
+            logger.error(f"消息解析失败，直接确认: {entry_id}, {str(e)}")
+            await self.ack(entry_id)
+            return
+        
+        try:
+            await self.handler(payload, entry_id)
+            if self.auto_ack:
+                await self.ack(entry_id)
+        except asyncio.CancelledError:
+            self._in_flight.discard(entry_id)
+            raise
+        except Exception as e:
+            # 处理失败不确认，不再刷新空闲时间，等待认领重试
+            self._in_flight.discard(entry_id)
+            self.stats["handler_errors"] += 1
+            logger.error(f"消息处理失败，等待重试: {entry_id}, {str(e)}")
+    
+    def _decode_fields(self, fields: Dict[Any, Any]) -> Dict[str, Any]:
+        """解析流消息字段"""
+        decoded = {_to_str(k): _to_str(v) for k, v in fields.items()}
+        payload = json.loads(decoded["data"])
+        
+        enqueued_at = decoded.get("enqueued_at")
+        if enqueued_at and isinstance(payload, dict):
+            payload.setdefault("_enqueued_at", float(enqueued_at))
+        return payload
+    
+    async def get_lag_metrics(self) -> Dict[str, Any]:
+        """获取流积压指标（流长度、消费组待确认数和滞后量）"""
+        try:
+            length = await redis_client.xlen(self.stream_key)
+            groups = await redis_client.xinfo_groups(self.stream_key)
+            
+            group_info = {}
+            for group in groups:
+                name = _to_str(group.get("name"))
+                if name == self.group_name:
+                    group_info = {
+                        "consumers": group.get("consumers", 0),
+                        "pending": group.get("pending", 0),
+                        # lag 字段需要 Redis 7+
+                        "lag": group.get("lag"),
+                        "last_delivered_id": _to_str(group.get("last-delivered-id", ""))
+                    }
+                    break
+            
+            dead_letters = await redis_client.xlen(self.dead_letter_key)
+            
+            return {
+                "stream": self.stream_key,
+                "group": self.group_name,
+                "length": length,
+                "dead_letters": dead_letters,
+                **group_info
+            }
+        
+        except Exception as e:
+            logger.error(f"获取消息流指标失败: {self.stream_key}, {str(e)}")
+            return {"stream": self.stream_key, "error": str(e)}
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取本进程统计信息"""
+        return {
+            **self.stats,
+            "stream": self.stream_key,
+            "consumer": self.consumer_name,
+            "in_flight": len(self._in_flight),
+            "running_handlers": len(self._handler_tasks),
+            "is_running": self.is_running
+        }
+
+
+class ShardedMessageStream:
+    """
+    按路由键分片的消息流
+    同一路由键（会话ID）的消息固定写入一个分片，分片所有权通过Redis租约分配，
+    每个分片同一时刻只由一个worker消费，会话的合并窗口和取代逻辑因此只在一个进程内发生；
+    worker按存活数量均分分片，加入或失联后重新平衡
+    """
+    
+    def __init__(
+        self,
+        stream_key: str,
+        shards: int,
+        group_name: str = None,
+        auto_ack: bool = True
+    ):
+        self.stream_key = stream_key
+        self.shard_count = max(1, shards)
+        self.shards = [
+            MessageStream(f"{stream_key}:{index}", group_name, auto_ack)
+            for index in range(self.shard_count)
+        ]
+        self.worker_id = self.shards[0].consumer_name
+        self.workers_key = f"{stream_key}:workers"
+        self.lease_ms = settings.STREAM_SHARD_LEASE_MS
+        # 续约间隔取租约的三分之一
+        self.rebalance_interval = self.lease_ms / 1000 / 3
+        
+        self.handler: Optional[StreamHandler] = None
+        self.is_running = False
+        self._owned: set = set()
+        self._rebalance_task: Optional[asyncio.Task] = None
+        
+        self._renew_script = redis_client.register_script(LEASE_RENEW_SCRIPT)
+        self._release_script = redis_client.register_script(LEASE_RELEASE_SCRIPT)
+        
+        # 统计信息（本进程）
+        self.stats = {
+            "shards_acquired": 0,
+            "shards_released": 0,
+            "shards_lost": 0,
+            "rebalance_errors": 0
+        }
+    
+    def shard_for(self, routing_key: Any) -> int:
+        """路由键对应的分片（各进程结果一致）"""
+        return zlib.crc32(str(routing_key).encode()) % self.shard_count
+    
+    def _lease_key(self, shard: int) -> str:
+        return f"{self.stream_key}:owner:{shard}"
+    
+    async def start(self, handler: StreamHandler):
+        """加入分片分配，认领到的分片启动消费者"""
+        if self.is_running:
+            logger.warning(f"消息流消费者已在运行: {self.stream_key}")
+            return
+        
+        self.handler = handler
+        self.is_running = True
+        await self._rebalance()
+        self._rebalance_task = asyncio.create_task(self._rebalance_loop())
+        logger.info(f"分片消息流已启动: {self.stream_key} ({self.worker_id}, 分片 {sorted(self._owned)})")
+    
+    async def stop(self):
+        """停止所有分片的消费者并释放租约，未确认的消息由接管的worker认领"""
+        self.is_running = False
+        
+        if self._rebalance_task:
+            self._rebalance_task.cancel()
+            await asyncio.gather(self._rebalance_task, return_exceptions=True)
+            self._rebalance_task = None
+        
+        for shard in list(self._owned):
+            await self._release_shard(shard)
+        
+        try:
+            await redis_client.zrem(self.workers_key, self.worker_id)
+        except Exception as e:
+            logger.error(f"注销分片消费者失败: {self.stream_key}, {str(e)}")
+        logger.info(f"分片消息流已停止: {self.stream_key}")
+    
+    async def publish(self, payload: Dict[str, Any], routing_key: Any) -> Optional[str]:
+        """按路由键写入分片，返回带分片号的消息ID"""
+        shard = self.shard_for(routing_key)
+        entry_id = await self.shards[shard].publish(payload)
+        return f"{shard}:{entry_id}" if entry_id else None
+    
+    async def ack(self, *entry_ids: str) -> int:
+        """确认消息（带分片号的消息ID），分片已被其他worker接管时仍可确认"""
+        by_shard: Dict[int, List[str]] = {}
+        for qualified_id in entry_ids:
+            if not qualified_id:
+                continue
+            shard, entry_id = qualified_id.split(":", 1)
+            by_shard.setdefault(int(shard), []).append(entry_id)
+        
+        acked = 0
+        for shard, ids in by_shard.items():
+            acked += await self.shards[shard].ack(*ids)
+        return acked
+    
+    def _shard_handler(self, shard: int) -> StreamHandler:
+        """处理函数收到的消息ID带上分片号"""
+        async def handle(payload: Dict[str, Any], entry_id: str):
+            return await self.handler(payload, f"{shard}:{entry_id}")
+        return handle
+    
+    async def _rebalance_loop(self):
+        """定期续约并重新平衡分片"""
+        while self.is_running:
+            try:
+                await asyncio.sleep(self.rebalance_interval)
+                await self._rebalance()
+            
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.stats["rebalance_errors"] += 1
+                logger.error(f"分片重新平衡异常: {self.stream_key}, {str(e)}")
+    
+    async def _rebalance(self):
+        """登记存活、续约已有分片、释放多余分片、认领空闲分片"""
+        now_ms = int(time.time() * 1000)
+        await redis_client.zadd(self.workers_key, {self.worker_id: now_ms})
+        await redis_client.zremrangebyscore(self.workers_key, 0, now_ms - self.lease_ms)
+        alive = max(1, await redis_client.zcard(self.workers_key))
+        target = math.ceil(self.shard_count / alive)
+        
+        # 续约失败说明租约已过期并被其他worker接管，立即停止消费
+        for shard in sorted(self._owned):
+            renewed = await self._renew_script(keys=[self._lease_key(shard)], args=[self.worker_id, self.lease_ms])
+            if not renewed:
+                self.stats["shards_lost"] += 1
+                logger.warning(f"分片租约已丢失: {self.stream_key}:{shard}")
+                await self._release_shard(shard)
+        
+        # 新worker加入后，超出份额的分片让出
+        for shard in sorted(self._owned, reverse=True)[:max(0, len(self._owned) - target)]:
+            await self._release_shard(shard)
+        
+        # 从各自的起点开始认领，减少worker之间的争抢
+        offset = zlib.crc32(self.worker_id.encode()) % self.shard_count
+        for step in range(self.shard_count):
+            if len(self._owned) >= target:
+                break
+            shard = (offset + step) % self.shard_count
+            if shard in self._owned:
+                continue
+            if await redis_client.set(self._lease_key(shard), self.worker_id, nx=True, px=self.lease_ms):
+                self._owned.add(shard)
+                self.stats["shards_acquired"] += 1
+                await self.shards[shard].start(self._shard_handler(shard))
+    
+    async def _release_shard(self, shard: int):
+        """先停止分片消费者，再释放租约"""
+        self._owned.discard(shard)
+        await self.shards[shard].stop()
+        self.stats["shards_released"] += 1
+        try:
+            await self._release_script(keys=[self._lease_key(shard)], args=[self.worker_id])
+        except Exception as e:
+            logger.error(f"释放分片租约失败: {self.stream_key}:{shard}, {str(e)}")
+    
+    async def get_lag_metrics(self) -> Dict[str, Any]:
+        """汇总各分片的积压指标"""
+        shard_metrics = [await stream.get_lag_metrics() for stream in self.shards]
+        
+        totals = {"length": 0, "pending": 0, "lag": 0, "dead_letters": 0}
+        for metrics in shard_metrics:
+            if "error" in metrics:
+                continue
+            for field in totals:
+                if totals[field] is None:
+                    continue
+                value = metrics.get(field)
+                # 任一分片缺少 lag（Redis 7 以下）时总滞后量未知
+                totals[field] = None if value is None else totals[field] + value
+        
+        return {
+            "stream": self.stream_key,
+            "shard_count": self.shard_count,
+            **totals,
+            "shards": shard_metrics
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取本进程统计信息（各分片汇总）"""
+        totals: Dict[str, Any] = {}
+        for stream in self.shards:
+            for field, value in stream.stats.items():
+                if isinstance(value, int):
+                    totals[field] = totals.get(field, 0) + value
+        
+        return {
+            **totals,
+            **self.stats,
+            "stream": self.stream_key,
+            "consumer": self.worker_id,
+            "owned_shards": sorted(self._owned),
+            "in_flight": sum(len(stream._in_flight) for stream in self.shards),
+            "running_handlers": sum(len(stream._handler_tasks) for stream in self.shards),
+            "is_running": self.is_running
+        }
+
+
+# 全局消息流实例
+webhook_stream = MessageStream(settings.WEBHOOK_STREAM_KEY)
+ai_task_stream = ShardedMessageStream(settings.AI_TASK_STREAM_KEY, settings.AI_TASK_STREAM_SHARDS, auto_ack=False)
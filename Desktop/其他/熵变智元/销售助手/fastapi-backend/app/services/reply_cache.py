@@ -0,0 +1,265 @@
+"""
+AI回复缓存
+客户反复发送的短问题（"多少钱"、"怎么买"、"在吗"）直接复用之前的AI回复：
+按工作流单独开启，键为 工作流 + 归一化后的问题 + 相关上下文的哈希（无上下文工作流不含上下文）；
+进程内LRU作为一级缓存，Redis作为跨进程的二级缓存，工作流变更时通过发布订阅通知所有进程清除
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from typing import Dict, Any, Optional, Tuple
+
+from app.core.config import settings
+from app.core.redis import redis_client
+from app.services.resolution_cache import LRUTTLCache
+
+logger = logging.getLogger(__name__)
+
+
+# 句末语气符号不影响问题本身
+_TRAILING_PUNCTUATION = "?？!！.。,，、~～…"
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """归一化用户输入：全半角统一、小写、去空白和句末标点"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _WHITESPACE.sub("", text)
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+class AIReplyCache:
+    """AI回复缓存"""
+    
+    def __init__(self):
+        self.enabled = settings.AI_REPLY_CACHE_ENABLED
+        self.prefix = settings.AI_REPLY_CACHE_PREFIX
+        self.channel = settings.AI_REPLY_CACHE_CHANNEL
+        self.ttl = settings.AI_REPLY_CACHE_TTL
+        self.max_input_chars = settings.AI_REPLY_CACHE_MAX_INPUT_CHARS
+        self.context_turns = settings.AI_REPLY_CACHE_CONTEXT_TURNS
+        
+        # 开启缓存的工作流 -> {"context_free": bool}
+        self.workflows: Dict[str, Dict[str, Any]] = {
+            str(workflow_id): dict(options or {})
+            for workflow_id, options in settings.AI_REPLY_CACHE_WORKFLOWS.items()
+        }
+        
+        # (工作流, 摘要) -> 回复
+        self.local = LRUTTLCache(settings.AI_REPLY_CACHE_MAX_SIZE, self.ttl)
+        
+        self.is_running = False
+        self._listener_task: Optional[asyncio.Task] = None
+        
+        # 统计信息
+        self.stats = {
+            "lookups": 0,
+            "local_hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "stores": 0,
+            "purges": 0,
+            "saved_tokens": 0,
+            "saved_cost": 0.0,
+            "errors": 0
+        }
+    
+    async def start(self):
+        """启动清除通知监听"""
+        if not self.enabled or self.is_running:
+            return
+        
+        self.is_running = True
+        self._listener_task = asyncio.create_task(self._listen_purges())
+    
+    async def stop(self):
+        """停止清除通知监听"""
+        self.is_running = False
+        
+        if self._listener_task:
+            self._listener_task.cancel()
+            await asyncio.gather(self._listener_task, return_exceptions=True)
+            self._listener_task = None
+    
+    def configure_workflow(self, workflow_id: str, enabled: bool, context_free: bool = False):
+        """开启或关闭某个工作流的回复缓存"""
+        if enabled:
+            self.workflows[str(workflow_id)] = {"context_free": context_free}
+        else:
+            self.workflows.pop(str(workflow_id), None)
+    
+    def cache_key(
+        self,
+        workflow_id: str,
+        user_message: str,
+        context: Dict[str, Any]
+    ) -> Optional[Tuple[str, str]]:
+        """计算缓存键 (工作流, 摘要)，不适合缓存的请求返回None"""
+        if not self.enabled:
+            return None
+        
+        options = self.workflows.get(str(workflow_id))
+        if options is None:
+            return None
+        
+        question = normalize_question(user_message)
+        # 长消息几乎不会重复，图片消息的回复依赖图片内容
+        if not question or len(question) > self.max_input_chars or context.get("image_url"):
+            self.stats["bypassed"] += 1
+            return None
+        
+        if options.get("context_free"):
+            relevant = None
+        else:
+            # 影响回复的上下文：角色、账号、自定义变量、称呼和最近几轮对话
+            history = context.get("chat_history") or []
+            relevant = {
+                "role": context.get("role"),
+                "account_id": str(context.get("account_id", "")),
+                "nickname": context.get("contact_nickname"),
+                "variables": context.get("custom_variables"),
+                "history": [
+                    [msg.get("direction"), msg.get("content")]
+                    for msg in history[-self.context_turns:]
+                ] if self.context_turns > 0 else []
+            }
+        
+        payload = json.dumps([question, relevant], ensure_ascii=False, sort_keys=True, default=str)
+        return str(workflow_id), hashlib.sha1(payload.encode("utf-8")).hexdigest()
+    
+    def _redis_key(self, key: Tuple[str, str]) -> str:
+        """Redis中的缓存key"""
+        return f"{self.prefix}:{key[0]}:{key[1]}"
+    
+    async def get(self, key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        """读取缓存的回复（先本进程，再Redis）"""
+        self.stats["lookups"] += 1
+        
+        entry = self.local.get(key)
+        if entry is not None:
+            self.stats["local_hits"] += 1
+            self._record_saving(entry)
+            return entry
+        
+        try:
+            raw = await redis_client.get(self._redis_key(key))
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"读取AI回复缓存失败: {str(e)}")
+            raw = None
+        
+        if not raw:
+            self.stats["misses"] += 1
+            return None
+        
+        entry = json.loads(raw)
+        self.local.set(key, entry)
+        self.stats["redis_hits"] += 1
+        self._record_saving(entry)
+        return entry
+    
+    async def set(self, key: Tuple[str, str], entry: Dict[str, Any]):
+        """写入回复"""
+        entry = {**entry, "cached_at": time.time()}
+        self.local.set(key, entry)
+        
+        try:
+            await redis_client.setex(self._redis_key(key), self.ttl, json.dumps(entry, ensure_ascii=False))
+            self.stats["stores"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"写入AI回复缓存失败: {str(e)}")
+    
+    def _record_saving(self, entry: Dict[str, Any]):
+        """命中时累计节省的token和成本"""
+        self.stats["saved_tokens"] += entry.get("tokens", {}).get("total", 0)
+        self.stats["saved_cost"] += entry.get("cost", 0.0)
+    
+    async def purge(self, workflow_id: Optional[str] = None) -> int:
+        """清除某个工作流（不指定时为全部）的缓存回复，工作流配置变更后调用"""
+        self.stats["purges"] += 1
+        self._apply_purge(workflow_id)
+        
+        pattern = f"{self.prefix}:{workflow_id}:*" if workflow_id else f"{self.prefix}:*"
+        deleted = 0
+        try:
+            keys = []
+            async for redis_key in redis_client.scan_iter(match=pattern, count=500):
+                keys.append(redis_key)
+                if len(keys) >= 500:
+                    deleted += await redis_client.delete(*keys)
+                    keys = []
+            if keys:
+                deleted += await redis_client.delete(*keys)
+            
+            await redis_client.publish(self.channel, json.dumps({"workflow_id": workflow_id}))
+        except Exception as e:
+            # Redis中的条目最迟在TTL后过期
+            self.stats["errors"] += 1
+            logger.error(f"清除AI回复缓存失败: {workflow_id}, {str(e)}")
+        
+        logger.info(f"清除AI回复缓存: {workflow_id or '全部'}, {deleted} 条")
+        return deleted
+    
+    def _apply_purge(self, workflow_id: Optional[str]):
+        """清除本进程缓存"""
+        if workflow_id:
+            self.local.delete_where(lambda key, value: key[0] == str(workflow_id))
+        else:
+            self.local.clear()
+    
+    async def _listen_purges(self):
+        """监听其他进程发布的清除通知"""
+        while self.is_running:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                
+                while self.is_running:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if not message:
+                        continue
+                    
+                    data = message["data"]
+                    if isinstance(data, bytes):
+                        data = data.decode()
+                    self._apply_purge(json.loads(data).get("workflow_id"))
+            
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                # 订阅中断期间可能漏掉通知，保守起见清空本进程缓存
+                self.stats["errors"] += 1
+                logger.error(f"AI回复缓存清除监听异常: {str(e)}")
+                self._apply_purge(None)
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.unsubscribe(self.channel)
+                    await pubsub.close()
+                except Exception:
+                    pass
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        hits = self.stats["local_hits"] + self.stats["redis_hits"]
+        lookups = self.stats["lookups"]
+        return {
+            **self.stats,
+            "saved_cost": round(self.stats["saved_cost"], 6),
+            "enabled": self.enabled,
+            "ttl": self.ttl,
+            "workflows": self.workflows,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0,
+            "local": self.local.get_stats()
+        }
+
+
+# 全局AI回复缓存实例
+ai_reply_cache = AIReplyCache()
@@ -0,0 +1,195 @@
+"""
+请求调度器
+按通道（如交互式对话、批量/分析任务）排队，每个通道一个调度任务：先获取通道的并发信号量，
+再阻塞等待队列中的下一个请求，没有轮询间隔，空闲时不占用CPU；
+请求在队列中的等待时间和处理时间分开统计
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Any, Optional, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+
+# 处理函数：(请求参数, 排队时间秒) -> 结果
+DispatchHandler = Callable[[Dict[str, Any], float], Awaitable[Any]]
+
+
+class DispatchLane:
+    """调度通道"""
+    
+    def __init__(self, name: str, concurrency: int, queue_size: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = 0
+        
+        # 统计信息
+        self.stats = {
+            "submitted": 0,
+            "dispatched": 0,
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "abandoned": 0,
+            "total_queue_time": 0.0,
+            "max_queue_time": 0.0,
+            "total_service_time": 0.0
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        dispatched = self.stats["dispatched"]
+        finished = self.stats["completed"] + self.stats["failed"]
+        return {
+            **self.stats,
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "queue_size": self.queue.qsize(),
+            "avg_queue_ms": round(self.stats["total_queue_time"] / dispatched * 1000, 2) if dispatched else 0,
+            "max_queue_ms": round(self.stats["max_queue_time"] * 1000, 2),
+            "avg_service_ms": round(self.stats["total_service_time"] / finished * 1000, 2) if finished else 0
+        }
+
+
+class RequestDispatcher:
+    """多通道请求调度器"""
+    
+    def __init__(
+        self,
+        name: str,
+        handler: DispatchHandler,
+        lanes: Dict[str, Dict[str, Any]],
+        queue_size: int,
+        default_lane: str
+    ):
+        self.name = name
+        self.handler = handler
+        self.default_lane = default_lane
+        self.lanes: Dict[str, DispatchLane] = {
+            lane_name: DispatchLane(lane_name, int(config.get("concurrency", 10)), queue_size)
+            for lane_name, config in lanes.items()
+        }
+        
+        self.is_running = False
+        self._dispatch_tasks: Dict[str, asyncio.Task] = {}
+        self._request_tasks: set = set()
+    
+    async def start(self):
+        """启动各通道的调度任务"""
+        if self.is_running:
+            return
+        
+        self.is_running = True
+        for lane in self.lanes.values():
+            self._dispatch_tasks[lane.name] = asyncio.create_task(self._dispatch(lane))
+        logger.info(f"请求调度器已启动: {self.name}, 通道 {list(self.lanes)}")
+    
+    async def stop(self):
+        """停止调度，等待处理中的请求完成，未开始的请求以 CancelledError 结束"""
+        if not self.is_running:
+            return
+        
+        self.is_running = False
+        for task in self._dispatch_tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._dispatch_tasks.values(), return_exceptions=True)
+        self._dispatch_tasks.clear()
+        
+        if self._request_tasks:
+            await asyncio.gather(*list(self._request_tasks), return_exceptions=True)
+        
+        for lane in self.lanes.values():
+            while not lane.queue.empty():
+                item = lane.queue.get_nowait()
+                if not item["future"].done():
+                    item["future"].cancel()
+        
+        logger.info(f"请求调度器已停止: {self.name}")
+    
+    def lane(self, lane_name: Optional[str]) -> DispatchLane:
+        """获取通道（未知通道使用默认通道）"""
+        return self.lanes.get(lane_name) or self.lanes[self.default_lane]
+    
+    def submit(self, lane_name: Optional[str], request_args: Dict[str, Any]) -> asyncio.Future:
+        """提交请求，返回结果的 Future；通道队列已满时抛出 asyncio.QueueFull"""
+        lane = self.lane(lane_name)
+        future = asyncio.get_running_loop().create_future()
+        
+        try:
+            lane.queue.put_nowait({
+                "request_args": request_args,
+                "future": future,
+                "enqueued_at": time.monotonic()
+            })
+        except asyncio.QueueFull:
+            lane.stats["rejected"] += 1
+            raise
+        
+        lane.stats["submitted"] += 1
+        return future
+    
+    def queue_size(self) -> int:
+        """所有通道排队中的请求数"""
+        return sum(lane.queue.qsize() for lane in self.lanes.values())
+    
+    def in_flight(self) -> int:
+        """所有通道处理中的请求数"""
+        return sum(lane.in_flight for lane in self.lanes.values())
+    
+    async def _dispatch(self, lane: DispatchLane):
+        """通道调度循环：有空闲并发时才取下一个请求"""
+        while self.is_running:
+            await lane.semaphore.acquire()
+            try:
+                item = await lane.queue.get()
+            except BaseException:
+                lane.semaphore.release()
+                raise
+            
+            # 调用方已放弃（如回复被新消息取代），不再请求上游
+            if item["future"].done():
+                lane.stats["abandoned"] += 1
+                lane.semaphore.release()
+                continue
+            
+            task = asyncio.create_task(self._run(lane, item))
+            self._request_tasks.add(task)
+            task.add_done_callback(self._request_tasks.discard)
+    
+    async def _run(self, lane: DispatchLane, item: Dict[str, Any]):
+        """处理单个请求"""
+        started = time.monotonic()
+        queue_time = started - item["enqueued_at"]
+        lane.in_flight += 1
+        lane.stats["dispatched"] += 1
+        lane.stats["total_queue_time"] += queue_time
+        lane.stats["max_queue_time"] = max(lane.stats["max_queue_time"], queue_time)
+        
+        future = item["future"]
+        try:
+            result = await self.handler(item["request_args"], queue_time)
+            lane.stats["completed"] += 1
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            lane.stats["failed"] += 1
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            lane.in_flight -= 1
+            lane.stats["total_service_time"] += time.monotonic() - started
+            lane.semaphore.release()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            "name": self.name,
+            "is_running": self.is_running,
+            "queue_size": self.queue_size(),
+            "in_flight": self.in_flight(),
+            "lanes": {lane.name: lane.get_stats() for lane in self.lanes.values()}
+        }
@@ -0,0 +1,247 @@
+"""
+对冲请求
+AI上游偶发的慢请求决定了回复的尾延迟：请求超过自适应阈值（近期延迟的p95）仍未返回时，
+再发一个相同的请求，先成功返回的结果胜出，另一个被取消；
+流式请求按首个token的等待时间对冲，先收到增量的请求胜出，只转发胜出者的增量；
+额外请求受预算限制（令牌桶，每个请求积累 HEDGING_BUDGET_RATIO 个令牌），并发已满时不对冲
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Any, Optional, Callable, Awaitable, TypeVar
+
+from app.core.config import settings
+from app.services.ai_stream import DeltaCallback
+from app.services.adaptive_limiter import AdaptiveConcurrencyLimiter, fastgpt_limiter, ai_service_limiter
+
+logger = logging.getLogger(__name__)
+
+
+T = TypeVar("T")
+
+
+class RequestHedger:
+    """对冲请求执行器"""
+    
+    def __init__(self, name: str, limiter: Optional[AdaptiveConcurrencyLimiter] = None):
+        self.name = name
+        self.limiter = limiter
+        self.enabled = settings.HEDGING_ENABLED
+        self.quantile = settings.HEDGING_QUANTILE
+        self.min_delay = settings.HEDGING_MIN_DELAY
+        self.max_delay = settings.HEDGING_MAX_DELAY
+        self.min_samples = settings.HEDGING_MIN_SAMPLES
+        self.budget_ratio = settings.HEDGING_BUDGET_RATIO
+        self.budget_burst = settings.HEDGING_BUDGET_BURST
+        
+        # 最近的请求延迟，每积累一批样本重新计算阈值
+        self._latencies = deque(maxlen=500)
+        self._samples_since_update = 0
+        self._delay: Optional[float] = None
+        self._budget = float(self.budget_burst)
+        
+        # 统计信息
+        self.stats = {
+            "requests": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "budget_exhausted": 0,
+            "skipped_saturated": 0,
+            "cancelled": 0
+        }
+    
+    def delay(self) -> Optional[float]:
+        """当前的对冲阈值（秒），样本不足时为None"""
+        refresh = self._samples_since_update >= 20 or self._delay is None
+        if refresh and len(self._latencies) >= self.min_samples:
+            ordered = sorted(self._latencies)
+            value = ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))]
+            self._delay = min(self.max_delay, max(self.min_delay, value))
+            self._samples_since_update = 0
+        return self._delay
+    
+    def _record(self, latency: float):
+        """记录一次成功请求的延迟"""
+        self._latencies.append(latency)
+        self._samples_since_update += 1
+    
+    def _can_hedge(self) -> bool:
+        """预算和并发是否允许再发一个请求"""
+        if self._budget < 1:
+            self.stats["budget_exhausted"] += 1
+            return False
+        
+        if self.limiter and (self.limiter.waiting > 0 or self.limiter.in_flight >= self.limiter.limit):
+            self.stats["skipped_saturated"] += 1
+            return False
+        
+        self._budget -= 1
+        return True
+    
+    async def run(
+        self,
+        call: Callable[[], Awaitable[T]],
+        accept: Optional[Callable[[T], bool]] = None
+    ) -> T:
+        """
+        执行请求，超过阈值未返回时对冲
+        accept 判断结果是否可用（默认不抛异常即可用），不可用的结果不会胜出，除非另一个请求也失败
+        """
+        if not self.enabled:
+            return await call()
+        
+        self.stats["requests"] += 1
+        self._budget = min(float(self.budget_burst), self._budget + self.budget_ratio)
+        
+        started = time.monotonic()
+        primary = asyncio.create_task(call())
+        pending = {primary}
+        attempts = {primary: started}
+        
+        try:
+            delay = self.delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done and self._can_hedge():
+                    self.stats["hedged"] += 1
+                    logger.debug(f"请求超过 {delay:.2f}s 未返回，发起对冲请求: {self.name}")
+                    backup = asyncio.create_task(call())
+                    pending.add(backup)
+                    attempts[backup] = time.monotonic()
+            
+            fallback: Optional[asyncio.Task] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and (accept is None or accept(task.result())):
+                        self._record(time.monotonic() - attempts[task])
+                        if len(attempts) > 1:
+                            self.stats["hedge_wins" if task is not primary else "primary_wins"] += 1
+                        return task.result()
+                    # 不可用的结果优先保留主请求的，便于按原逻辑处理错误
+                    if fallback is None or task is primary:
+                        fallback = task
+            
+            return fallback.result()
+        
+        finally:
+            for task in pending:
+                task.cancel()
+                self.stats["cancelled"] += 1
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+    
+    async def run_stream(
+        self,
+        call: Callable[[DeltaCallback], Awaitable[T]],
+        on_delta: DeltaCallback,
+        accept: Optional[Callable[[T], bool]] = None
+    ) -> T:
+        """
+        执行流式请求，超过阈值仍未收到首个增量时对冲
+        call 接收本次尝试的增量回调；先收到增量的尝试胜出，其余立即取消，
+        调用方只会收到胜出者的增量。阈值按首token时间计算，应使用独立的实例
+        """
+        if not self.enabled:
+            return await call(on_delta)
+        
+        self.stats["requests"] += 1
+        self._budget = min(float(self.budget_burst), self._budget + self.budget_ratio)
+        
+        attempts: Dict[asyncio.Task, float] = {}
+        winner: Optional[asyncio.Task] = None
+        first_delta = asyncio.Event()
+        
+        async def push(delta: str):
+            nonlocal winner
+            task = asyncio.current_task()
+            if winner is None:
+                winner = task
+                self._record(time.monotonic() - attempts[task])
+                first_delta.set()
+            if task is winner:
+                await on_delta(delta)
+        
+        def start() -> asyncio.Task:
+            task = asyncio.create_task(call(push))
+            attempts[task] = time.monotonic()
+            return task
+        
+        async def wait(pending: set, timeout: Optional[float] = None) -> set:
+            """等待任一尝试结束或收到首个增量"""
+            waiter = asyncio.create_task(first_delta.wait())
+            try:
+                done, _ = await asyncio.wait(
+                    pending | {waiter}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                waiter.cancel()
+            return done - {waiter}
+        
+        primary = start()
+        pending = {primary}
+        
+        try:
+            delay = self.delay()
+            if delay is not None:
+                done = await wait(pending, delay)
+                if not done and not first_delta.is_set() and self._can_hedge():
+                    self.stats["hedged"] += 1
+                    logger.debug(f"流式请求超过 {delay:.2f}s 未收到首个token，发起对冲请求: {self.name}")
+                    pending.add(start())
+            
+            fallback: Optional[asyncio.Task] = None
+            while winner is None and pending:
+                for task in await wait(pending):
+                    pending.discard(task)
+                    if winner is not None:
+                        break
+                    if task.exception() is None and (accept is None or accept(task.result())):
+                        # 没有增量就结束的尝试（如空回复）
+                        winner = task
+                        self._record(time.monotonic() - attempts[task])
+                        break
+                    if fallback is None or task is primary:
+                        fallback = task
+            
+            if winner is None:
+                return fallback.result()
+            
+            for task in pending - {winner}:
+                task.cancel()
+                self.stats["cancelled"] += 1
+            if len(attempts) > 1:
+                self.stats["hedge_wins" if winner is not primary else "primary_wins"] += 1
+            return await winner
+        
+        finally:
+            unfinished = [task for task in attempts if not task.done()]
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                await asyncio.gather(*unfinished, return_exceptions=True)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        requests = self.stats["requests"]
+        return {
+            **self.stats,
+            "name": self.name,
+            "enabled": self.enabled,
+            "delay_ms": round(self._delay * 1000, 2) if self._delay is not None else None,
+            "hedge_rate": round(self.stats["hedged"] / requests, 4) if requests else 0,
+            "budget": round(self._budget, 2),
+            "budget_ratio": self.budget_ratio
+        }
+
+
+# 全局对冲请求实例（按上游区分）
+fastgpt_hedger = RequestHedger("fastgpt", fastgpt_limiter)
+ai_service_hedger = RequestHedger("ai_service", ai_service_limiter)
+
+# 流式请求按首token时间对冲，阈值和预算与完整请求分开
+fastgpt_stream_hedger = RequestHedger("fastgpt_stream", fastgpt_limiter)
+ai_service_stream_hedger = RequestHedger("ai_service_stream", ai_service_limiter)
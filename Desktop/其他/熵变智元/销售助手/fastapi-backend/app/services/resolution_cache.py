@@ -0,0 +1,256 @@
+"""
+解析缓存服务
+缓存入站消息热路径上的 app_id → 微信账号、(账号, wxid) → (联系人, 会话) 映射，
+账号、联系人或会话被修改时通过Redis发布订阅通知所有进程失效
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Callable, Hashable
+
+from app.core.config import settings
+from app.core.redis import redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class LRUTTLCache:
+    """容量有界、带过期时间的LRU缓存"""
+    
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        
+        # 统计信息
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0
+        }
+    
+    def get(self, key: Hashable) -> Optional[Any]:
+        """获取缓存值，过期视为未命中"""
+        item = self._data.get(key)
+        if item is None:
+            self.stats["misses"] += 1
+            return None
+        
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+        
+        self._data.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+    
+    def set(self, key: Hashable, value: Any) -> None:
+        """写入缓存，超过容量时淘汰最久未使用的条目"""
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+    
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """读取条目但不影响LRU顺序和命中统计"""
+        item = self._data.get(key)
+        return item[1] if item else None
+    
+    def delete(self, key: Hashable) -> bool:
+        """删除指定条目"""
+        if self._data.pop(key, None) is None:
+            return False
+        self.stats["invalidations"] += 1
+        return True
+    
+    def delete_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """删除满足条件的条目"""
+        keys = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+        for key in keys:
+            del self._data[key]
+        self.stats["invalidations"] += len(keys)
+        return len(keys)
+    
+    def clear(self) -> None:
+        """清空缓存"""
+        self.stats["invalidations"] += len(self._data)
+        self._data.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0
+        }
+
+
+class ResolutionCache:
+    """入站消息解析缓存"""
+    
+    def __init__(self):
+        self.enabled = settings.RESOLUTION_CACHE_ENABLED
+        self.channel = settings.RESOLUTION_CACHE_CHANNEL
+        
+        # app_id -> {"id", "organization_id"}
+        self.accounts = LRUTTLCache(settings.RESOLUTION_CACHE_MAX_SIZE, settings.RESOLUTION_CACHE_TTL)
+        # (account_id, wxid) -> {"contact_id", "session_id", "ai_enabled", "auto_reply_enabled"}
+        self.contacts = LRUTTLCache(settings.RESOLUTION_CACHE_MAX_SIZE, settings.RESOLUTION_CACHE_TTL)
+        
+        self.is_running = False
+        self._listener_task: Optional[asyncio.Task] = None
+        
+        # 统计信息
+        self.stats = {
+            "invalidations_published": 0,
+            "invalidations_received": 0,
+            "listener_errors": 0
+        }
+    
+    async def start(self):
+        """启动失效通知监听"""
+        if not self.enabled or self.is_running:
+            return
+        
+        self.is_running = True
+        self._listener_task = asyncio.create_task(self._listen_invalidations())
+        logger.info(f"解析缓存已启动，监听失效通知: {self.channel}")
+    
+    async def stop(self):
+        """停止失效通知监听"""
+        self.is_running = False
+        
+        if self._listener_task:
+            self._listener_task.cancel()
+            await asyncio.gather(self._listener_task, return_exceptions=True)
+            self._listener_task = None
+    
+    def get_account(self, app_id: str) -> Optional[Dict[str, Any]]:
+        """按GeWe app_id获取账号"""
+        if not self.enabled:
+            return None
+        return self.accounts.get(app_id)
+    
+    def set_account(self, app_id: str, account_id: Any, organization_id: Any) -> None:
+        """缓存账号"""
+        if self.enabled:
+            self.accounts.set(app_id, {"id": account_id, "organization_id": organization_id})
+    
+    def get_contact(self, account_id: Any, wxid: str) -> Optional[Dict[str, Any]]:
+        """按(账号, wxid)获取联系人和会话"""
+        if not self.enabled:
+            return None
+        return self.contacts.get((str(account_id), wxid))
+    
+    def set_contact(self, account_id: Any, wxid: str, entry: Dict[str, Any]) -> None:
+        """缓存联系人和会话"""
+        if self.enabled:
+            self.contacts.set((str(account_id), wxid), entry)
+    
+    async def invalidate_account(self, account_id: Any) -> None:
+        """账号被修改：失效账号及其下所有联系人"""
+        await self._publish("account", str(account_id))
+    
+    async def invalidate_contact(self, contact_id: Any) -> None:
+        """联系人被修改"""
+        await self._publish("contact", str(contact_id))
+    
+    async def invalidate_session(self, session_id: Any) -> None:
+        """会话被修改"""
+        await self._publish("session", str(session_id))
+    
+    def discard_app(self, app_id: str) -> None:
+        """丢弃本进程中某个app_id的全部缓存（写入失败时避免反复使用失效的ID）"""
+        account = self.accounts.peek(app_id)
+        if account:
+            self._apply("account", str(account["id"]))
+    
+    async def _publish(self, kind: str, target_id: str):
+        """本进程立即失效，并通知其他进程"""
+        if not self.enabled:
+            return
+        
+        self._apply(kind, target_id)
+        
+        try:
+            await redis_client.publish(
+                self.channel,
+                json.dumps({"kind": kind, "id": target_id})
+            )
+            self.stats["invalidations_published"] += 1
+        except Exception as e:
+            # 发布失败时其他进程依赖TTL过期
+            logger.error(f"发布缓存失效通知失败: {kind} {target_id}, {str(e)}")
+    
+    def _apply(self, kind: str, target_id: str):
+        """执行失效"""
+        if kind == "account":
+            self.accounts.delete_where(lambda key, value: str(value["id"]) == target_id)
+            self.contacts.delete_where(lambda key, value: key[0] == target_id)
+        elif kind == "contact":
+            self.contacts.delete_where(lambda key, value: str(value["contact_id"]) == target_id)
+        elif kind == "session":
+            self.contacts.delete_where(lambda key, value: str(value["session_id"]) == target_id)
+        else:
+            self.accounts.clear()
+            self.contacts.clear()
+    
+    async def _listen_invalidations(self):
+        """监听其他进程发布的失效通知"""
+        while self.is_running:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                
+                while self.is_running:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if not message:
+                        continue
+                    
+                    data = message["data"]
+                    if isinstance(data, bytes):
+                        data = data.decode()
+                    payload = json.loads(data)
+                    
+                    self._apply(payload.get("kind"), payload.get("id"))
+                    self.stats["invalidations_received"] += 1
+            
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                # 订阅中断期间可能漏掉通知，保守起见清空缓存
+                self.stats["listener_errors"] += 1
+                logger.error(f"缓存失效监听异常: {str(e)}")
+                self._apply("all", "")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.unsubscribe(self.channel)
+                    await pubsub.close()
+                except Exception:
+                    pass
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "accounts": self.accounts.get_stats(),
+            "contacts": self.contacts.get_stats()
+        }
+
+
+# 全局解析缓存实例
+resolution_cache = ResolutionCache()
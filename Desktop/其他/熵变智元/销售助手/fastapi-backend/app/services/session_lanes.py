@@ -0,0 +1,217 @@
+"""
+会话分片执行器
+按会话ID哈希到固定通道，每个通道单独的队列和处理任务：同一会话严格按顺序处理，不同通道并行。
+通道内按优先级出队，等待时间按老化速率折算为分数，低优先级任务不会被无限推迟；
+排队总数有上限，满时提交方等待，积压留在上游的消息流中
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+import zlib
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+LaneHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class LaneQueue:
+    """通道内的优先级队列"""
+    
+    def __init__(self, aging_rate: float = 0.0):
+        self.aging_rate = aging_rate
+        # [(序号, key, 优先级, 入队时间, 标签, 任务)]，按入队顺序保存
+        self._entries: List[Tuple[int, str, float, float, Optional[str], Dict[str, Any]]] = []
+        self._seq = itertools.count()
+        self._event = asyncio.Event()
+    
+    def qsize(self) -> int:
+        """队列深度"""
+        return len(self._entries)
+    
+    def put(self, key: str, item: Dict[str, Any], priority: float = 0, label: Optional[str] = None):
+        """入队"""
+        self._entries.append((next(self._seq), key, priority, time.monotonic(), label, item))
+        self._event.set()
+    
+    async def get(self) -> Tuple[Dict[str, Any], float, Optional[str]]:
+        """
+        出队老化后优先级最高的任务，返回 (任务, 入队时间, 标签)
+        同一key取最早入队的一条：高优先级消息带着同会话更早的消息先处理，会话内顺序不变
+        """
+        while not self._entries:
+            self._event.clear()
+            await self._event.wait()
+        
+        now = time.monotonic()
+        best = max(
+            self._entries,
+            key=lambda entry: (entry[2] + (now - entry[3]) * self.aging_rate, -entry[0])
+        )
+        index = next(i for i, entry in enumerate(self._entries) if entry[1] == best[1])
+        _, _, _, enqueued_at, label, item = self._entries.pop(index)
+        return item, enqueued_at, label
+
+
+class SessionLaneExecutor:
+    """会话分片执行器"""
+    
+    def __init__(self, lane_count: int, name: str = "lanes", aging_rate: float = 0.0, max_size: int = 0):
+        self.lane_count = max(1, lane_count)
+        self.name = name
+        # 所有通道排队任务的上限（0为不限制）
+        self.max_size = max_size
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self.full_waits = 0
+        
+        self.handler: Optional[LaneHandler] = None
+        self.is_running = False
+        self.queues: List[LaneQueue] = [LaneQueue(aging_rate) for _ in range(self.lane_count)]
+        self.worker_tasks: List[asyncio.Task] = []
+        
+        # 按优先级档位统计等待时间
+        self.label_stats: Dict[str, Dict[str, Any]] = {}
+        
+        # 每个通道的统计信息
+        self.lane_stats = [
+            {
+                "processed": 0,
+                "errors": 0,
+                "busy": False,
+                "total_wait": 0.0,
+                "max_wait": 0.0,
+                "last_wait": 0.0
+            }
+            for _ in range(self.lane_count)
+        ]
+    
+    def start(self, handler: LaneHandler):
+        """启动所有通道"""
+        if self.is_running:
+            return
+        
+        self.handler = handler
+        self.is_running = True
+        self.worker_tasks = [
+            asyncio.create_task(self._lane_worker(index))
+            for index in range(self.lane_count)
+        ]
+        logger.info(f"会话分片执行器已启动: {self.name}, {self.lane_count} 个通道")
+    
+    async def stop(self):
+        """停止所有通道"""
+        self.is_running = False
+        
+        for task in self.worker_tasks:
+            task.cancel()
+        
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks.clear()
+    
+    def qsize(self) -> int:
+        """所有通道排队中的任务数"""
+        return sum(queue.qsize() for queue in self.queues)
+    
+    def full(self) -> bool:
+        """排队任务是否已达上限"""
+        return self.max_size > 0 and self.qsize() >= self.max_size
+    
+    async def wait_for_space(self):
+        """队列已满时等待通道取走任务"""
+        if self.full():
+            self.full_waits += 1
+        while self.full():
+            self._not_full.clear()
+            await self._not_full.wait()
+    
+    def lane_for(self, key: str) -> int:
+        """计算分片通道（跨进程稳定的哈希）"""
+        return zlib.crc32(str(key).encode()) % self.lane_count
+    
+    async def submit(
+        self,
+        key: str,
+        item: Dict[str, Any],
+        priority: float = 0,
+        label: Optional[str] = None
+    ):
+        """提交任务到key对应的通道（priority 越高越先处理，label 为统计用的优先级档位），队列已满时等待"""
+        await self.wait_for_space()
+        self.queues[self.lane_for(key)].put(str(key), item, priority, label)
+    
+    async def _lane_worker(self, index: int):
+        """通道处理任务：顺序执行本通道的任务"""
+        queue = self.queues[index]
+        stats = self.lane_stats[index]
+        
+        while self.is_running:
+            try:
+                item, enqueued_at, label = await queue.get()
+            except asyncio.CancelledError:
+                break
+            self._not_full.set()
+            
+            wait = time.monotonic() - enqueued_at
+            stats["last_wait"] = wait
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+            stats["busy"] = True
+            
+            if label:
+                label_stats = self.label_stats.setdefault(
+                    label, {"count": 0, "total_wait": 0.0, "max_wait": 0.0}
+                )
+                label_stats["count"] += 1
+                label_stats["total_wait"] += wait
+                label_stats["max_wait"] = max(label_stats["max_wait"], wait)
+            
+            try:
+                await self.handler(item)
+                stats["processed"] += 1
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                stats["errors"] += 1
+                logger.error(f"分片通道处理异常: {self.name}[{index}], {str(e)}")
+            finally:
+                stats["busy"] = False
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息（含每个通道的队列深度和等待时间）"""
+        lanes = []
+        for index, stats in enumerate(self.lane_stats):
+            processed = stats["processed"] + stats["errors"]
+            lanes.append({
+                "lane": index,
+                "queue_depth": self.queues[index].qsize(),
+                "busy": stats["busy"],
+                "processed": stats["processed"],
+                "errors": stats["errors"],
+                "avg_wait_ms": round(stats["total_wait"] / processed * 1000, 2) if processed else 0,
+                "max_wait_ms": round(stats["max_wait"] * 1000, 2),
+                "last_wait_ms": round(stats["last_wait"] * 1000, 2)
+            })
+        
+        return {
+            "name": self.name,
+            "lane_count": self.lane_count,
+            "is_running": self.is_running,
+            "queue_depth": self.qsize(),
+            "max_size": self.max_size,
+            "full_waits": self.full_waits,
+            "busy_lanes": sum(1 for lane in lanes if lane["busy"]),
+            "max_wait_ms": max((lane["max_wait_ms"] for lane in lanes), default=0),
+            "priorities": {
+                label: {
+                    "count": stats["count"],
+                    "avg_wait_ms": round(stats["total_wait"] / stats["count"] * 1000, 2),
+                    "max_wait_ms": round(stats["max_wait"] * 1000, 2)
+                }
+                for label, stats in self.label_stats.items()
+            },
+            "lanes": lanes
+        }
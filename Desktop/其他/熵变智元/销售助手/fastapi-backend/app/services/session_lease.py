@@ -0,0 +1,136 @@
+"""
+会话处理租约
+多worker部署时，会话的AI任务正常只由持有其消息流分片的worker处理；分片交接期间新旧worker
+可能同时持有同一会话的任务，处理前按会话获取Redis租约，保证会话内AI处理跨进程串行
+"""
+
+import asyncio
+import logging
+import uuid
+from typing import Dict, Any, Optional
+
+from app.core.config import settings
+from app.core.redis import redis_client
+from app.services.message_stream import LEASE_RENEW_SCRIPT, LEASE_RELEASE_SCRIPT
+
+logger = logging.getLogger(__name__)
+
+
+class SessionLeaseManager:
+    """会话处理租约管理（持有期间后台续约）"""
+    
+    def __init__(self):
+        self.enabled = settings.CHAT_SESSION_LEASE_ENABLED
+        self.prefix = settings.CHAT_SESSION_LEASE_PREFIX
+        self.lease_ms = settings.CHAT_SESSION_LEASE_MS
+        self.poll_interval = settings.CHAT_SESSION_LEASE_POLL_MS / 1000
+        # 续约间隔取租约的三分之一
+        self.renew_interval = self.lease_ms / 1000 / 3
+        
+        self.is_running = False
+        # 会话ID -> 本进程持有的租约令牌
+        self._held: Dict[str, str] = {}
+        self._renew_task: Optional[asyncio.Task] = None
+        
+        self._renew_script = redis_client.register_script(LEASE_RENEW_SCRIPT)
+        self._release_script = redis_client.register_script(LEASE_RELEASE_SCRIPT)
+        
+        # 统计信息
+        self.stats = {
+            "acquired": 0,
+            "waits": 0,
+            "lost": 0,
+            "errors": 0
+        }
+    
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}:{session_id}"
+    
+    async def start(self):
+        """启动续约任务"""
+        if not self.enabled or self.is_running:
+            return
+        
+        self.is_running = True
+        self._renew_task = asyncio.create_task(self._renew_loop())
+    
+    async def stop(self):
+        """停止续约任务，未释放的租约到期后自动失效"""
+        self.is_running = False
+        
+        if self._renew_task:
+            self._renew_task.cancel()
+            await asyncio.gather(self._renew_task, return_exceptions=True)
+            self._renew_task = None
+    
+    async def acquire(self, session_id: str) -> Optional[str]:
+        """
+        获取会话租约，被其他worker持有时等待其释放或过期，返回租约令牌
+        Redis不可用时不阻塞处理（返回None），此时仅由消息流分片保证顺序
+        """
+        if not self.enabled:
+            return None
+        
+        token = uuid.uuid4().hex
+        waited = False
+        while True:
+            try:
+                if await redis_client.set(self._key(session_id), token, nx=True, px=self.lease_ms):
+                    break
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"获取会话租约失败，不加锁处理: {session_id}, {str(e)}")
+                return None
+            
+            if not waited:
+                waited = True
+                self.stats["waits"] += 1
+            await asyncio.sleep(self.poll_interval)
+        
+        self._held[session_id] = token
+        self.stats["acquired"] += 1
+        return token
+    
+    async def release(self, session_id: str, token: Optional[str]):
+        """释放会话租约（仍属于自己时才删除）"""
+        if not token:
+            return
+        
+        if self._held.get(session_id) == token:
+            del self._held[session_id]
+        try:
+            await self._release_script(keys=[self._key(session_id)], args=[token])
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"释放会话租约失败: {session_id}, {str(e)}")
+    
+    async def _renew_loop(self):
+        """定期续约本进程持有的全部租约"""
+        while self.is_running:
+            try:
+                await asyncio.sleep(self.renew_interval)
+                for session_id, token in list(self._held.items()):
+                    renewed = await self._renew_script(keys=[self._key(session_id)], args=[token, self.lease_ms])
+                    if not renewed and self._held.get(session_id) == token:
+                        # 续约中断超过租约时长，其他worker可能已开始处理该会话
+                        del self._held[session_id]
+                        self.stats["lost"] += 1
+                        logger.warning(f"会话租约已丢失: {session_id}")
+            
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"会话租约续约异常: {str(e)}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "held": len(self._held)
+        }
+
+
+# 全局会话租约实例
+session_lease = SessionLeaseManager()
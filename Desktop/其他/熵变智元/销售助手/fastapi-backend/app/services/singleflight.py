@@ -0,0 +1,78 @@
+"""
+并发请求合并（singleflight）
+参数相同的读请求同时发起时（如看板刷新、设备巡检），只有第一个调用真正请求上游，
+其余调用等待同一个进行中的任务并共享结果（包括异常）；任务结束后立即移除，不缓存结果
+"""
+
+import asyncio
+import logging
+from typing import Dict, Any, Hashable, Callable, Awaitable, TypeVar
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """按键合并进行中的调用"""
+    
+    def __init__(self):
+        self.enabled = settings.SINGLEFLIGHT_ENABLED
+        
+        # 键 -> 进行中的任务
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        
+        # 统计信息（按调用名称，即键的第一个元素）
+        self.stats: Dict[str, Dict[str, int]] = {}
+    
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        执行调用，相同键的调用进行中时等待其结果
+        key 建议为 (方法名, 参数...)；结果对象在调用方之间共享，调用方不应修改
+        """
+        if not self.enabled:
+            return await call()
+        
+        name = str(key[0]) if isinstance(key, tuple) and key else str(key)
+        stats = self.stats.setdefault(name, {"calls": 0, "shared": 0, "errors": 0})
+        stats["calls"] += 1
+        
+        task = self._calls.get(key)
+        if task is not None:
+            stats["shared"] += 1
+        else:
+            # 在独立任务中执行，发起者被取消不影响其他等待者
+            task = asyncio.create_task(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done, stats))
+        
+        return await asyncio.shield(task)
+    
+    def _finish(self, key: Hashable, task: asyncio.Task, stats: Dict[str, int]):
+        """任务结束后移除，并取出异常避免未读取的警告"""
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        
+        if not task.cancelled() and task.exception() is not None:
+            stats["errors"] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls),
+            "calls": {
+                name: {
+                    **item,
+                    "shared_rate": round(item["shared"] / item["calls"], 4) if item["calls"] else 0
+                }
+                for name, item in self.stats.items()
+            }
+        }
+
+
+# 全局并发请求合并实例
+singleflight = SingleFlight()
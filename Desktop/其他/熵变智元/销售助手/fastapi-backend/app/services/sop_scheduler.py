@@ -26,6 +26,7 @@ from app.models.chat import Contact, ChatMessage, MessageType
 from app.services.sop_executor import sop_executor
 from app.services.websocket_manager import websocket_manager
 from app.services.notification_service import notification_service
+from app.services.sop_trigger_index import sop_trigger_index
 
 logger = logging.getLogger(__name__)
 
@@ -66,6 +67,12 @@ class SOPScheduler:
         self.is_running = True
         logger.info("启动SOP调度器")
         
+        try:
+            await sop_trigger_index.start()
+        except Exception as e:
+            # 索引在首次匹配时重试加载
+            logger.error(f"加载SOP触发索引失败: {str(e)}")
+        
         # 启动调度任务
         self.scheduler_task = asyncio.create_task(self._scheduler_loop())
     
@@ -74,6 +81,8 @@ class SOPScheduler:
         self.is_running = False
         logger.info("停止SOP调度器")
         
+        await sop_trigger_index.stop()
+        
         if self.scheduler_task:
             self.scheduler_task.cancel()
             try:
@@ -349,26 +358,37 @@ class SOPScheduler:
             if not contact_id or not wechat_account_id:
                 return
             
+            # 内存索引一次扫描得出命中的模板，未命中时不访问数据库
+            matched = await sop_trigger_index.match(
+                message_content,
+                organization_id=event.get("organization_id"),
+                wechat_account_id=wechat_account_id
+            )
+            if not matched:
+                return
+            
             async with get_db() as db:
-                # 查找关键词触发的SOP模板
                 result = await db.execute(
                     select(SOPTemplate)
                     .where(
+                        SOPTemplate.id.in_(list(matched.keys())),
                         SOPTemplate.status == SOPStatus.ACTIVE
                     )
                 )
                 templates = result.scalars().all()
                 
                 for template in templates:
-                    trigger_config = template.trigger_config or {}
-                    keywords = trigger_config.get("keywords", [])
-                    
-                    # 检查关键词匹配
-                    if keywords and any(keyword in message_content for keyword in keywords):
-                        await self._create_triggered_instance(
-                            template, wechat_account_id, contact_id,
-                            {"trigger_type": "keyword_matched", "keywords": keywords, "message": message_content}, db
-                        )
+                    keywords = (template.trigger_config or {}).get("keywords", [])
+                    await self._create_triggered_instance(
+                        template, wechat_account_id, contact_id,
+                        {
+                            "trigger_type": "keyword_matched",
+                            "keywords": keywords,
+                            "matched_keywords": matched[str(template.id)],
+                            "message": message_content
+                        },
+                        db
+                    )
                 
         except Exception as e:
             logger.error(f"处理消息触发失败: {str(e)}")
@@ -633,7 +653,8 @@ class SOPScheduler:
             **self.stats,
             "is_running": self.is_running,
             "schedule_interval": self.schedule_interval,
-            "max_concurrent_executions": self.max_concurrent_executions
+            "max_concurrent_executions": self.max_concurrent_executions,
+            "trigger_index": sop_trigger_index.get_stats()
         }
 
 
@@ -0,0 +1,304 @@
+"""
+SOP关键词触发索引
+按组织把已激活模板的触发关键词编译为 Aho-Corasick 自动机（关键词 -> 模板ID），
+收到消息时不查询数据库、一次扫描得出命中的模板；模板创建、更新或激活时只重建所属组织的自动机，
+并通过发布订阅通知其他进程同步
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy import select
+
+from app.core.config import settings
+from app.core.database import get_db
+from app.core.redis import redis_client
+from app.models.sop import SOPTemplate, SOPStatus
+from app.models.device import WeChatAccount
+from app.services.keyword_engine import AhoCorasick
+
+logger = logging.getLogger(__name__)
+
+
+def trigger_keywords(template: SOPTemplate) -> List[str]:
+    """模板的触发关键词（未激活的模板没有）"""
+    if template.status != SOPStatus.ACTIVE:
+        return []
+    keywords = (template.trigger_config or {}).get("keywords") or []
+    return sorted({keyword for keyword in keywords if isinstance(keyword, str) and keyword})
+
+
+class OrganizationTriggers:
+    """一个组织的关键词触发模板"""
+    
+    def __init__(self):
+        # 模板ID -> 触发关键词
+        self.templates: Dict[str, List[str]] = {}
+        # 关键词变化后置空，下次匹配时重建
+        self.automaton: Optional[AhoCorasick] = None
+    
+    def set(self, template_id: str, keywords: List[str]) -> bool:
+        """设置模板的触发关键词（为空时移除），返回索引是否变化"""
+        if not keywords:
+            if self.templates.pop(template_id, None) is None:
+                return False
+        elif self.templates.get(template_id) == keywords:
+            return False
+        else:
+            self.templates[template_id] = keywords
+        
+        self.automaton = None
+        return True
+    
+    def match(self, text: str) -> Dict[str, List[str]]:
+        """扫描文本，返回 模板ID -> 命中的关键词"""
+        if self.automaton is None:
+            self.automaton = AhoCorasick(
+                (keyword, (template_id, keyword))
+                for template_id, keywords in self.templates.items()
+                for keyword in keywords
+            )
+        
+        matched: Dict[str, List[str]] = {}
+        for _, (template_id, keyword) in self.automaton.iter(text):
+            keywords = matched.setdefault(template_id, [])
+            if keyword not in keywords:
+                keywords.append(keyword)
+        return matched
+
+
+class SOPTriggerIndex:
+    """SOP关键词触发索引"""
+    
+    def __init__(self):
+        self.channel = settings.SOP_TRIGGER_INDEX_CHANNEL
+        
+        # organization_id -> 触发模板
+        self.organizations: Dict[str, OrganizationTriggers] = {}
+        # 模板ID -> organization_id（模板更新时定位所属组织）
+        self._template_orgs: Dict[str, str] = {}
+        # 微信账号ID -> organization_id（事件未携带组织时使用）
+        self._account_orgs: Dict[str, str] = {}
+        
+        self.loaded = False
+        self._load_lock = asyncio.Lock()
+        self.is_running = False
+        self._listener_task: Optional[asyncio.Task] = None
+        
+        # 统计信息
+        self.stats = {
+            "lookups": 0,
+            "matched": 0,
+            "total_match_time": 0.0,
+            "full_loads": 0,
+            "template_updates": 0,
+            "sync_published": 0,
+            "sync_received": 0,
+            "errors": 0
+        }
+    
+    async def start(self):
+        """加载索引并监听其他进程的模板变更"""
+        if self.is_running:
+            return
+        
+        self.is_running = True
+        await self.ensure_loaded()
+        self._listener_task = asyncio.create_task(self._listen_updates())
+    
+    async def stop(self):
+        """停止监听"""
+        self.is_running = False
+        
+        if self._listener_task:
+            self._listener_task.cancel()
+            await asyncio.gather(self._listener_task, return_exceptions=True)
+            self._listener_task = None
+    
+    async def ensure_loaded(self):
+        """首次使用时加载全部已激活模板"""
+        if self.loaded:
+            return
+        
+        async with self._load_lock:
+            if not self.loaded:
+                await self.reload()
+    
+    async def reload(self):
+        """从数据库全量重建索引"""
+        async with get_db() as db:
+            result = await db.execute(
+                select(SOPTemplate).where(SOPTemplate.status == SOPStatus.ACTIVE)
+            )
+            templates = result.scalars().all()
+        
+        organizations: Dict[str, OrganizationTriggers] = {}
+        template_orgs: Dict[str, str] = {}
+        for template in templates:
+            keywords = trigger_keywords(template)
+            if not keywords:
+                continue
+            organization_id = str(template.organization_id)
+            organizations.setdefault(organization_id, OrganizationTriggers()).set(str(template.id), keywords)
+            template_orgs[str(template.id)] = organization_id
+        
+        self.organizations = organizations
+        self._template_orgs = template_orgs
+        self.loaded = True
+        self.stats["full_loads"] += 1
+        logger.info(f"SOP触发索引已加载: {len(template_orgs)} 个模板, {len(organizations)} 个组织")
+    
+    def update_template(self, template: SOPTemplate) -> bool:
+        """模板创建、更新或激活后更新所属组织的索引，返回索引是否变化"""
+        template_id = str(template.id)
+        organization_id = str(template.organization_id)
+        keywords = trigger_keywords(template)
+        
+        changed = False
+        previous_org = self._template_orgs.pop(template_id, None)
+        if previous_org and previous_org != organization_id and previous_org in self.organizations:
+            changed = self.organizations[previous_org].set(template_id, [])
+        
+        if keywords:
+            triggers = self.organizations.setdefault(organization_id, OrganizationTriggers())
+            changed = triggers.set(template_id, keywords) or changed
+            self._template_orgs[template_id] = organization_id
+        elif organization_id in self.organizations:
+            changed = self.organizations[organization_id].set(template_id, []) or changed
+        
+        if changed:
+            self.stats["template_updates"] += 1
+        return changed
+    
+    async def publish_template(self, template: SOPTemplate):
+        """更新本进程索引，并通知其他进程重新加载该模板"""
+        if not self.update_template(template):
+            return
+        
+        try:
+            await redis_client.publish(self.channel, json.dumps({"template_id": str(template.id)}))
+            self.stats["sync_published"] += 1
+        except Exception as e:
+            # 其他进程在重启后重新加载
+            self.stats["errors"] += 1
+            logger.error(f"发布SOP触发索引变更失败: {template.id}, {str(e)}")
+    
+    async def match(
+        self,
+        text: str,
+        organization_id: Any = None,
+        wechat_account_id: Any = None
+    ) -> Dict[str, List[str]]:
+        """匹配消息文本，返回 模板ID -> 命中的关键词"""
+        if not text:
+            return {}
+        
+        await self.ensure_loaded()
+        
+        organization_id = organization_id or await self._account_organization(wechat_account_id)
+        triggers = self.organizations.get(str(organization_id)) if organization_id else None
+        if triggers is None:
+            return {}
+        
+        started = time.monotonic()
+        matched = triggers.match(text)
+        self.stats["lookups"] += 1
+        self.stats["total_match_time"] += time.monotonic() - started
+        if matched:
+            self.stats["matched"] += 1
+        return matched
+    
+    async def _account_organization(self, wechat_account_id: Any) -> Optional[str]:
+        """微信账号所属组织（账号不会变更组织，查询一次后缓存）"""
+        if not wechat_account_id:
+            return None
+        
+        account_id = str(wechat_account_id)
+        organization_id = self._account_orgs.get(account_id)
+        if organization_id:
+            return organization_id
+        
+        async with get_db() as db:
+            result = await db.execute(
+                select(WeChatAccount.organization_id).where(WeChatAccount.id == account_id)
+            )
+            organization_id = result.scalar_one_or_none()
+        
+        if organization_id:
+            organization_id = self._account_orgs[account_id] = str(organization_id)
+        return organization_id
+    
+    async def _reload_template(self, template_id: str):
+        """重新加载单个模板（其他进程的变更通知）"""
+        async with get_db() as db:
+            result = await db.execute(
+                select(SOPTemplate).where(SOPTemplate.id == template_id)
+            )
+            template = result.scalar_one_or_none()
+        
+        if template is not None:
+            self.update_template(template)
+            return
+        
+        organization_id = self._template_orgs.pop(template_id, None)
+        if organization_id and organization_id in self.organizations:
+            self.organizations[organization_id].set(template_id, [])
+    
+    async def _listen_updates(self):
+        """监听其他进程发布的模板变更"""
+        while self.is_running:
+            pubsub = redis_client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                
+                while self.is_running:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if not message:
+                        continue
+                    
+                    data = message["data"]
+                    if isinstance(data, bytes):
+                        data = data.decode()
+                    await self._reload_template(json.loads(data)["template_id"])
+                    self.stats["sync_received"] += 1
+            
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                # 订阅中断期间可能漏掉通知，全量重建
+                self.stats["errors"] += 1
+                logger.error(f"SOP触发索引同步异常: {str(e)}")
+                await asyncio.sleep(1)
+                try:
+                    await self.reload()
+                except Exception as reload_error:
+                    logger.error(f"重建SOP触发索引失败: {str(reload_error)}")
+            finally:
+                try:
+                    await pubsub.unsubscribe(self.channel)
+                    await pubsub.close()
+                except Exception:
+                    pass
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        lookups = self.stats["lookups"]
+        return {
+            **self.stats,
+            "loaded": self.loaded,
+            "avg_match_ms": round(self.stats["total_match_time"] / lookups * 1000, 4) if lookups else 0,
+            "organizations": len(self.organizations),
+            "templates": len(self._template_orgs),
+            "keywords": sum(
+                len(keywords)
+                for triggers in self.organizations.values()
+                for keywords in triggers.templates.values()
+            )
+        }
+
+
+# 全局SOP触发索引实例
+sop_trigger_index = SOPTriggerIndex()
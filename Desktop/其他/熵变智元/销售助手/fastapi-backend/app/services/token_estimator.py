@@ -0,0 +1,136 @@
+"""
+Token估算
+按BPE分词器的切分规律计数：汉字按字、英文按单词和字母数、数字每1~3位一个token、标点符号各一个；
+计数全部由正则 subn 在C层完成，不逐字符遍历；多行文本（格式化后的聊天历史）按行记忆，
+滑动窗口中重复出现的历史只计算一次
+"""
+
+import logging
+import math
+import re
+from collections import OrderedDict
+from typing import Dict, Any, List, Iterable, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+# CJK统一表意文字（含扩展A和兼容区）、假名和谚文
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+_LATIN_WORD = re.compile(r"[A-Za-z\u00c0-\u024f]+")
+# 分词器把长数字切成最多3位一组
+_DIGITS = re.compile(r"\d{1,3}")
+_WHITESPACE = re.compile(r"\s+")
+
+
+class TokenEstimator:
+    """共享的Token估算器"""
+    
+    def __init__(self):
+        self.cjk_ratio = settings.TOKEN_ESTIMATE_CJK_RATIO
+        self.chars_per_token = settings.TOKEN_ESTIMATE_CHARS_PER_TOKEN
+        self.message_overhead = settings.TOKEN_ESTIMATE_MESSAGE_OVERHEAD
+        self.cache_min_chars = settings.TOKEN_ESTIMATE_CACHE_MIN_CHARS
+        self.cache_max_chars = settings.TOKEN_ESTIMATE_CACHE_MAX_CHARS
+        self.cache_size = settings.TOKEN_ESTIMATE_CACHE_SIZE
+        
+        # 文本 -> token数
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        
+        # 统计信息
+        self.stats = {
+            "estimates": 0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "cache_evictions": 0
+        }
+    
+    def count(self, text: str) -> int:
+        """计算文本的token数（不经过缓存）"""
+        if not text:
+            return 0
+        
+        rest, cjk = _CJK.subn("", text)
+        stripped, words = _LATIN_WORD.subn("", rest)
+        letters = len(rest) - len(stripped)
+        stripped, numbers = _DIGITS.subn("", stripped)
+        symbols = len(_WHITESPACE.sub("", stripped))
+        
+        # 常见英文单词是一个token，长单词按平均字母数拆分
+        latin = max(words, letters / self.chars_per_token)
+        return math.ceil(cjk * self.cjk_ratio + latin + numbers + symbols)
+    
+    def estimate(self, text: Optional[str]) -> int:
+        """估算文本的token数"""
+        if not text:
+            return 0
+        
+        self.stats["estimates"] += 1
+        return self._estimate(text)
+    
+    def estimate_many(self, texts: Iterable[Optional[str]]) -> List[int]:
+        """批量估算，返回与输入顺序一致的token数"""
+        results = [self._estimate(text) if text else 0 for text in texts]
+        self.stats["estimates"] += len(results)
+        return results
+    
+    def estimate_messages(self, messages: Iterable[Dict[str, Any]], content_key: str = "content") -> int:
+        """估算对话消息列表的token数（含每条消息的角色等固定开销）"""
+        contents = [message.get(content_key) or "" for message in messages]
+        return sum(self.estimate_many(contents)) + self.message_overhead * len(contents)
+    
+    def estimate_value(self, value: Any) -> int:
+        """估算请求变量等嵌套结构中文本的token数，无需先序列化为JSON"""
+        if value is None:
+            return 0
+        if isinstance(value, str):
+            return self.estimate(value)
+        if isinstance(value, dict):
+            return sum(self.estimate(str(key)) + self.estimate_value(item) for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return sum(self.estimate_value(item) for item in value)
+        return self.count(str(value))
+    
+    def _estimate(self, text: str) -> int:
+        """带记忆的估算"""
+        length = len(text)
+        if length < self.cache_min_chars:
+            return self.count(text)
+        
+        cacheable = length <= self.cache_max_chars
+        if cacheable:
+            tokens = self._cache.get(text)
+            if tokens is not None:
+                self._cache.move_to_end(text)
+                self.stats["cache_hits"] += 1
+                return tokens
+            self.stats["cache_misses"] += 1
+        
+        if "\n" in text:
+            # 按行估算，每行单独记忆
+            lines = text.split("\n")
+            tokens = sum(self._estimate(line) for line in lines if line) + len(lines) - 1
+        else:
+            tokens = self.count(text)
+        
+        if cacheable:
+            self._cache[text] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self.stats["cache_evictions"] += 1
+        
+        return tokens
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        lookups = self.stats["cache_hits"] + self.stats["cache_misses"]
+        return {
+            **self.stats,
+            "cache_size": len(self._cache),
+            "cache_hit_rate": round(self.stats["cache_hits"] / lookups, 4) if lookups else 0
+        }
+
+
+# 全局Token估算实例
+token_estimator = TokenEstimator()
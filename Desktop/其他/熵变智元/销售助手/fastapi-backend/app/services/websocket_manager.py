@@ -18,6 +18,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.redis import redis_client
 from app.core.config import settings
+from app.services.load_shedder import load_shedder
 
 logger = logging.getLogger(__name__)
 
@@ -56,8 +57,8 @@ class WebSocketManager:
         self.user_connections: Dict[str, Set[str]] = defaultdict(set)  # user_id -> connection_ids
         self.session_connections: Dict[str, Set[str]] = defaultdict(set)  # session_id -> connection_ids
         
-        # 消息队列和事件处理
-        self.message_queue: asyncio.Queue = asyncio.Queue()
+        # 消息队列和事件处理（有界，满时丢弃新事件）
+        self.message_queue: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_MESSAGE_QUEUE_SIZE)
         self.event_handlers: Dict[str, List[Callable]] = defaultdict(list)
         
         # 统计信息
@@ -67,8 +68,10 @@ class WebSocketManager:
             "messages_sent": 0,
             "messages_received": 0,
             "disconnections": 0,
+            "queue_dropped": 0,
             "errors": 0
         }
+        load_shedder.register("websocket", self.message_queue.qsize, settings.WS_MESSAGE_QUEUE_SIZE)
         
         # 心跳配置
         self.heartbeat_interval = settings.WS_HEARTBEAT_INTERVAL
@@ -665,12 +668,19 @@ class WebSocketManager:
             target_type=target_type,
             target_id=target_id
         )
-        await self.message_queue.put(event)
+        try:
+            self.message_queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 推送是尽力而为的，过载时丢弃比阻塞调用方更可取
+            self.stats["queue_dropped"] += 1
+            load_shedder.record_drop("websocket")
+            logger.warning(f"WebSocket消息队列已满，丢弃事件: {event_type}")
     
     def get_stats(self) -> Dict[str, Any]:
         """获取统计信息"""
         return {
             **self.stats,
+            "queue_size": self.message_queue.qsize(),
             "active_users": len(self.user_connections),
             "active_sessions": len(self.session_connections),
             "total_user_connections": sum(len(connections) for connections in self.user_connections.values()),
@@ -40,6 +40,7 @@ from app.api.ws.chat import router as ws_chat_router
 from app.services.gewe_service import GeWeService
 from app.services.ai_service import AIService
 from app.services.websocket_manager import WebSocketManager
+from app.services.http_clients import http_clients
 
 # 任务调度
 from app.tasks.scheduler import start_scheduler, stop_scheduler
@@ -96,6 +97,7 @@ async def lifespan(app: FastAPI):
     logger.info("🛑 正在关闭服务...")
     try:
         await stop_scheduler()
+        await http_clients.close()
         await redis_client.close()
         logger.info("✅ 服务已安全关闭")
     except Exception as e:
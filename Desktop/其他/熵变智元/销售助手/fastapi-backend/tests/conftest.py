@@ -0,0 +1,146 @@
+"""
+测试公共夹具
+"""
+
+import asyncio
+import itertools
+import time
+from typing import Dict, Any, List, Optional
+
+import pytest
+
+
+class FakeStreamRedis:
+    """进程内的Redis Streams替身，只实现消息流服务用到的命令（单消费组）"""
+    
+    def __init__(self):
+        self.streams: Dict[str, List[tuple]] = {}
+        # (stream, 消息ID) -> {"consumer", "delivered_at", "times_delivered"}
+        self.pending: Dict[tuple, Dict[str, Any]] = {}
+        self.last_delivered: Dict[str, int] = {}
+        self._ids = itertools.count(1)
+        # 键 -> (值, 过期时间)；有序集合 -> {成员: 分数}
+        self.values: Dict[str, tuple] = {}
+        self.zsets: Dict[str, Dict[str, float]] = {}
+    
+    async def xgroup_create(self, name, groupname, id="0", mkstream=False):
+        self.streams.setdefault(name, [])
+        self.last_delivered.setdefault(name, 0)
+    
+    async def xadd(self, name, fields, maxlen=None, approximate=True):
+        entry_id = f"{next(self._ids)}-0"
+        self.streams.setdefault(name, []).append((entry_id, dict(fields)))
+        return entry_id
+    
+    async def xlen(self, name):
+        return len(self.streams.get(name, []))
+    
+    async def xreadgroup(self, groupname, consumername, streams, count=None, block=None):
+        response = []
+        for name in streams:
+            entries = self.streams.get(name, [])
+            start = self.last_delivered.get(name, 0)
+            batch = entries[start:start + (count or len(entries))]
+            self.last_delivered[name] = start + len(batch)
+            for entry_id, _ in batch:
+                self.pending[(name, entry_id)] = {
+                    "consumer": consumername,
+                    "delivered_at": time.monotonic(),
+                    "times_delivered": 1
+                }
+            if batch:
+                response.append([name, batch])
+        if not response:
+            # 模拟阻塞读取超时
+            await asyncio.sleep((block or 0) / 1000)
+        return response
+    
+    async def xack(self, name, groupname, *entry_ids):
+        return sum(1 for entry_id in entry_ids if self.pending.pop((name, entry_id), None))
+    
+    async def xpending_range(self, name, groupname, min, max, count, idle=None, consumername=None):
+        now = time.monotonic()
+        items = []
+        for (stream, entry_id), info in self.pending.items():
+            idle_ms = (now - info["delivered_at"]) * 1000
+            if stream != name or (idle is not None and idle_ms < idle):
+                continue
+            items.append({
+                "message_id": entry_id,
+                "consumer": info["consumer"],
+                "time_since_delivered": int(idle_ms),
+                "times_delivered": info["times_delivered"]
+            })
+        return items[:count]
+    
+    async def xclaim(self, name, groupname, consumername, min_idle_time, message_ids, justid=False):
+        now = time.monotonic()
+        claimed = []
+        entries = dict(self.streams.get(name, []))
+        for entry_id in message_ids:
+            info = self.pending.get((name, entry_id))
+            if not info or (now - info["delivered_at"]) * 1000 < min_idle_time:
+                continue
+            info["consumer"] = consumername
+            info["delivered_at"] = now
+            if not justid:
+                info["times_delivered"] += 1
+            claimed.append(entry_id if justid else (entry_id, entries.get(entry_id)))
+        return claimed
+    
+    async def xrange(self, name, min, max):
+        return [(entry_id, fields) for entry_id, fields in self.streams.get(name, []) if min <= entry_id <= max]
+    
+    def _get(self, name):
+        value, expires_at = self.values.get(name, (None, None))
+        if expires_at is not None and time.monotonic() >= expires_at:
+            self.values.pop(name, None)
+            return None
+        return value
+    
+    async def get(self, name):
+        return self._get(name)
+    
+    async def set(self, name, value, nx=False, px=None):
+        if nx and self._get(name) is not None:
+            return None
+        self.values[name] = (value, time.monotonic() + px / 1000 if px else None)
+        return True
+    
+    def register_script(self, script):
+        """只支持消息流服务的续约和释放脚本：值匹配时延长或删除"""
+        async def run(keys, args):
+            if self._get(keys[0]) != args[0]:
+                return 0
+            if "PEXPIRE" in script:
+                self.values[keys[0]] = (args[0], time.monotonic() + int(args[1]) / 1000)
+            else:
+                self.values.pop(keys[0], None)
+            return 1
+        return run
+    
+    async def zadd(self, name, mapping):
+        self.zsets.setdefault(name, {}).update(mapping)
+    
+    async def zrem(self, name, *members):
+        return sum(1 for member in members if self.zsets.get(name, {}).pop(member, None) is not None)
+    
+    async def zremrangebyscore(self, name, min, max):
+        zset = self.zsets.get(name, {})
+        expired = [member for member, score in zset.items() if min <= score <= max]
+        for member in expired:
+            del zset[member]
+        return len(expired)
+    
+    async def zcard(self, name):
+        return len(self.zsets.get(name, {}))
+
+
+@pytest.fixture
+def stream_redis(monkeypatch):
+    """替换消息流服务使用的Redis客户端"""
+    from app.services import message_stream
+    
+    fake = FakeStreamRedis()
+    monkeypatch.setattr(message_stream, "redis_client", fake)
+    return fake
@@ -0,0 +1,48 @@
+"""
+FAQ检索索引测试
+"""
+
+import pytest
+
+from app.services.faq_index import FAQIndex, char_ngrams
+
+
+ENTRIES = [
+    {"questions": ["多少钱", "价格是多少"], "answer": "99元"},
+    {"questions": ["什么时候发货", "几天能到"], "answer": "48小时内发货"},
+    {"questions": ["可以退货吗"], "answer": "7天无理由退货"}
+]
+
+
+def test_char_ngrams_normalizes_text():
+    assert char_ngrams("A，b!", 1, 2) == ["a", "b", "ab"]
+
+
+def test_search_returns_best_entry_and_runner_up():
+    index = FAQIndex(ENTRIES)
+    
+    best, score, second = index.search("请问价格是多少？")
+    
+    assert best == 0
+    assert score > second
+    assert 0 < score <= 1.0001
+
+
+def test_search_matches_any_question_of_entry():
+    index = FAQIndex(ENTRIES)
+    
+    assert index.search("几天能到")[0] == 1
+    assert index.search("能退货吗")[0] == 2
+
+
+def test_exact_question_scores_near_one():
+    index = FAQIndex(ENTRIES)
+    
+    _, score, _ = index.search("可以退货吗")
+    
+    assert score == pytest.approx(1.0, abs=1e-4)
+
+
+def test_search_without_usable_input():
+    assert FAQIndex([]).search("多少钱") is None
+    assert FAQIndex(ENTRIES).search("？！") is None
@@ -0,0 +1,74 @@
+"""
+会话消息缓存测试
+"""
+
+import json
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from app.models.chat import MessageType, MessageDirection, MessageStatus, AIProcessStatus
+from app.services.history_cache import history_entry, session_history_cache
+
+
+def make_message(**overrides):
+    """构造与数据库读出的行字段一致的消息（UUID列为uuid.UUID）"""
+    fields = {
+        "id": uuid.uuid4(),
+        "message_type": MessageType.TEXT,
+        "direction": MessageDirection.INCOMING,
+        "content": "你好，这个产品多少钱",
+        "sender_wxid": "wxid_customer",
+        "sender_nickname": "客户",
+        "media_url": None,
+        "media_type": None,
+        "thumbnail_url": None,
+        "status": MessageStatus.SENT,
+        "is_recalled": False,
+        "ai_process_status": AIProcessStatus.COMPLETED,
+        "ai_response_message_id": uuid.uuid4(),
+        "ai_processing_time": 1200,
+        "intent_classification": "price_inquiry",
+        "sentiment_score": "0.6",
+        "keywords": ["价格"],
+        "created_at": datetime(2026, 1, 1, 12, 0, 0)
+    }
+    fields.update(overrides)
+    return SimpleNamespace(**fields)
+
+
+def test_history_entry_serializes_uuid_fields():
+    message = make_message()
+    entry = history_entry(message)
+    
+    assert entry["id"] == str(message.id)
+    assert entry["ai_response_message_id"] == str(message.ai_response_message_id)
+    assert json.loads(json.dumps(entry))["ai_response_message_id"] == str(message.ai_response_message_id)
+
+
+def test_history_entry_without_ai_response():
+    entry = history_entry(make_message(ai_response_message_id=None, ai_process_status=None))
+    
+    assert entry["ai_response_message_id"] is None
+    assert entry["ai_process_status"] == AIProcessStatus.PENDING.value
+
+
+@pytest.mark.asyncio
+async def test_seed_with_ai_replied_message(monkeypatch):
+    calls = []
+    
+    async def seed_script(keys, args):
+        calls.append((keys, args))
+        return len(args) - 2
+    
+    monkeypatch.setattr(session_history_cache, "enabled", True)
+    monkeypatch.setattr(session_history_cache, "_seed_script", seed_script)
+    
+    entries = [history_entry(make_message()), history_entry(make_message(ai_response_message_id=None))]
+    await session_history_cache.seed("session-1", entries)
+    
+    assert len(calls) == 1
+    _, args = calls[0]
+    assert [json.loads(value)["id"] for value in args[:-2]] == [entry["id"] for entry in entries]
@@ -0,0 +1,33 @@
+"""
+关键词多模式匹配测试
+"""
+
+from app.services.keyword_engine import AhoCorasick
+
+
+def test_finds_all_patterns_with_positions():
+    automaton = AhoCorasick([("价格", "price"), ("多少钱", "price"), ("发货", "shipping")])
+    
+    assert list(automaton.iter("这个多少钱？什么时候发货")) == [(2, "price"), (10, "shipping")]
+
+
+def test_overlapping_and_nested_patterns():
+    # 经典用例：he / she / his / hers
+    automaton = AhoCorasick([("he", "he"), ("she", "she"), ("his", "his"), ("hers", "hers")])
+    
+    assert sorted(automaton.iter("ushers")) == [(1, "she"), (2, "he"), (2, "hers")]
+
+
+def test_matching_ignores_case():
+    automaton = AhoCorasick([("VIP", "vip")])
+    
+    assert list(automaton.iter("我是vip客户")) == [(2, "vip")]
+    assert list(automaton.iter("我是Vip客户")) == [(2, "vip")]
+
+
+def test_empty_patterns_and_no_match():
+    automaton = AhoCorasick([("", "empty"), ("退款", "refund")])
+    
+    assert automaton.pattern_count == 1
+    assert list(automaton.iter("随便看看")) == []
+    assert list(automaton.iter("")) == []
@@ -0,0 +1,81 @@
+"""
+连发消息合并测试
+"""
+
+import asyncio
+
+import pytest
+
+from app.services.message_coalescer import MessageCoalescer
+
+
+def make_coalescer(jobs, debounce: float = 0.05, max_wait: float = 1.0) -> MessageCoalescer:
+    coalescer = MessageCoalescer()
+    coalescer.debounce = debounce
+    coalescer.max_wait = max_wait
+    
+    async def handler(job):
+        jobs.append(job)
+    
+    coalescer.start(handler)
+    return coalescer
+
+
+@pytest.mark.asyncio
+async def test_burst_is_merged_into_one_job():
+    jobs = []
+    coalescer = make_coalescer(jobs)
+    
+    await coalescer.add("s1", "m1", "0:1-0", priority=1)
+    await coalescer.add("s1", "m2", "0:2-0", priority=3)
+    await coalescer.add("s2", "m3", "1:3-0")
+    await asyncio.sleep(0.15)
+    
+    assert len(jobs) == 2
+    job = next(job for job in jobs if job["session_id"] == "s1")
+    assert job["message_ids"] == ["m1", "m2"]
+    assert job["stream_ids"] == ["0:1-0", "0:2-0"]
+    assert job["priority"] == 3
+    assert coalescer.get_stats()["open_windows"] == 0
+
+
+@pytest.mark.asyncio
+async def test_window_closes_at_max_wait():
+    jobs = []
+    coalescer = make_coalescer(jobs, debounce=0.05, max_wait=0.12)
+    
+    # 持续连发时防抖不断重置，但不超过最长等待
+    for index in range(10):
+        await coalescer.add("s1", f"m{index}")
+        await asyncio.sleep(0.03)
+    await asyncio.sleep(0.1)
+    
+    assert len(jobs) >= 2
+    assert [m for job in jobs for m in job["message_ids"]] == [f"m{index}" for index in range(10)]
+
+
+@pytest.mark.asyncio
+async def test_carried_messages_go_first():
+    jobs = []
+    coalescer = make_coalescer(jobs)
+    
+    carried = {"message_ids": ["m1"], "stream_ids": ["0:1-0"], "priority": 5}
+    await coalescer.add("s1", "m2", "0:2-0", carried=carried)
+    await asyncio.sleep(0.1)
+    
+    assert jobs[0]["message_ids"] == ["m1", "m2"]
+    assert jobs[0]["stream_ids"] == ["0:1-0", "0:2-0"]
+    assert jobs[0]["priority"] == 5
+    assert coalescer.stats["superseded_replies"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stop_drops_open_windows():
+    jobs = []
+    coalescer = make_coalescer(jobs)
+    
+    await coalescer.add("s1", "m1")
+    await coalescer.stop()
+    await asyncio.sleep(0.1)
+    
+    assert jobs == []
@@ -0,0 +1,45 @@
+"""
+布隆过滤器测试
+"""
+
+import time
+
+from app.services.message_dedup import BloomFilter
+
+
+def test_added_keys_are_always_found():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01, rotate_seconds=3600)
+    keys = [f"app:msg-{i}" for i in range(500)]
+    
+    for key in keys:
+        bloom.add(key)
+    
+    assert all(key in bloom for key in keys)
+
+
+def test_false_positive_rate_within_bound():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01, rotate_seconds=3600)
+    for i in range(1000):
+        bloom.add(f"seen-{i}")
+    
+    false_positives = sum(1 for i in range(10000) if f"unseen-{i}" in bloom)
+    
+    # 满容量时的误判率应接近设定值，留出统计波动余量
+    assert false_positives / 10000 < 0.03
+
+
+def test_rotation_keeps_previous_generation():
+    bloom = BloomFilter(capacity=10, error_rate=0.01, rotate_seconds=3600)
+    for i in range(10):
+        bloom.add(f"old-{i}")
+    
+    # 达到容量后的下一次写入触发轮换，上一代仍参与查询
+    bloom.add("new")
+    assert bloom.count == 1
+    assert "old-0" in bloom and "new" in bloom
+    
+    # 再轮换一次后最早一代被丢弃
+    bloom._rotated_at = time.monotonic() - 3600
+    bloom.add("newer")
+    assert "new" in bloom
+    assert sum(1 for i in range(10) if f"old-{i}" in bloom) < 10
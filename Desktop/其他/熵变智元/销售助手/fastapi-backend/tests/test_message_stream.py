@@ -0,0 +1,153 @@
+"""
+消息流确认与认领测试
+"""
+
+import asyncio
+
+import pytest
+
+from app.services.message_stream import MessageStream
+
+
+def make_stream(consumer_name: str, auto_ack: bool = False) -> MessageStream:
+    stream = MessageStream("test:stream", auto_ack=auto_ack)
+    stream.consumer_name = consumer_name
+    stream.reclaim_idle_ms = 200
+    stream.reclaim_interval = 0.05
+    stream.heartbeat_interval = 0.05
+    stream.block_ms = 10
+    return stream
+
+
+async def wait_until(predicate, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("条件未在超时内满足")
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_auto_ack_after_handler(stream_redis):
+    stream = make_stream("worker-1", auto_ack=True)
+    received = []
+    
+    async def handler(payload, entry_id):
+        received.append(payload)
+    
+    await stream.start(handler)
+    try:
+        await stream.publish({"message_id": "m1"})
+        await wait_until(lambda: received)
+        await wait_until(lambda: not stream_redis.pending)
+    finally:
+        await stream.stop()
+    
+    assert received[0]["message_id"] == "m1"
+    assert stream.stats["acked"] == 1
+
+
+@pytest.mark.asyncio
+async def test_long_running_entry_is_not_reclaimed(stream_redis):
+    owner = make_stream("worker-1")
+    other = make_stream("worker-2")
+    owner_entries, other_entries = [], []
+    release = asyncio.Event()
+    
+    async def slow_handler(payload, entry_id):
+        owner_entries.append(entry_id)
+        await release.wait()
+        await owner.ack(entry_id)
+    
+    async def other_handler(payload, entry_id):
+        other_entries.append(entry_id)
+    
+    await owner.start(slow_handler)
+    try:
+        await owner.publish({"message_id": "m1"})
+        await wait_until(lambda: owner_entries)
+        await other.start(other_handler)
+        
+        # 处理时间超过认领阈值，心跳使其一直不空闲
+        await asyncio.sleep(0.6)
+        assert other_entries == []
+        assert owner.stats["heartbeats"] > 0
+        
+        release.set()
+        await wait_until(lambda: not stream_redis.pending)
+    finally:
+        await other.stop()
+        await owner.stop()
+    
+    assert other.stats["reclaimed"] == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_entry_is_reclaimed(stream_redis):
+    failing = make_stream("worker-1")
+    other = make_stream("worker-2", auto_ack=True)
+    retried = []
+    
+    async def failing_handler(payload, entry_id):
+        raise RuntimeError("boom")
+    
+    async def other_handler(payload, entry_id):
+        retried.append(payload["message_id"])
+    
+    await failing.start(failing_handler)
+    try:
+        await failing.publish({"message_id": "m1"})
+        await wait_until(lambda: failing.stats["handler_errors"] == 1)
+        assert failing.get_stats()["in_flight"] == 0
+        await failing.stop()
+        
+        await other.start(other_handler)
+        await wait_until(lambda: retried)
+        await wait_until(lambda: not stream_redis.pending)
+    finally:
+        await failing.stop()
+        await other.stop()
+    
+    assert retried == ["m1"]
+    assert other.stats["reclaimed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_entry_over_max_deliveries_is_dead_lettered(stream_redis):
+    stream = make_stream("worker-1")
+    stream.max_deliveries = 1
+    
+    await stream.publish({"message_id": "m1"})
+    response = await stream_redis.xreadgroup("g", "crashed", {stream.stream_key: ">"})
+    (entry_id, _), = response[0][1]
+    await asyncio.sleep(0.25)
+    
+    await stream._reclaim_pending()
+    
+    assert stream.stats["dead_lettered"] == 1
+    assert not stream_redis.pending
+    assert await stream_redis.xlen(stream.dead_letter_key) == 1
+
+
+@pytest.mark.asyncio
+async def test_blocked_handler_does_not_stop_reading(stream_redis):
+    stream = make_stream("worker-1")
+    started = []
+    release = asyncio.Event()
+    
+    async def handler(payload, entry_id):
+        started.append(payload["message_id"])
+        if payload["message_id"] == "m1":
+            await release.wait()
+        await stream.ack(entry_id)
+    
+    await stream.start(handler)
+    try:
+        await stream.publish({"message_id": "m1"})
+        await stream.publish({"message_id": "m2"})
+        await wait_until(lambda: "m2" in started)
+        assert stream.get_stats()["running_handlers"] == 1
+        release.set()
+        await wait_until(lambda: not stream_redis.pending)
+    finally:
+        await stream.stop()
@@ -0,0 +1,106 @@
+"""
+多通道请求调度器测试
+"""
+
+import asyncio
+
+import pytest
+
+from app.services.request_dispatcher import RequestDispatcher
+
+
+def make_dispatcher(handler, concurrency: int = 1, queue_size: int = 10) -> RequestDispatcher:
+    return RequestDispatcher(
+        "test",
+        handler,
+        {"interactive": {"concurrency": concurrency}, "batch": {"concurrency": concurrency}},
+        queue_size=queue_size,
+        default_lane="interactive"
+    )
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_limited_per_lane():
+    running = 0
+    peak = 0
+    
+    async def handler(request_args, queue_time):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return request_args["n"]
+    
+    dispatcher = make_dispatcher(handler, concurrency=2)
+    await dispatcher.start()
+    try:
+        futures = [dispatcher.submit("interactive", {"n": n}) for n in range(6)]
+        assert await asyncio.gather(*futures) == list(range(6))
+        assert peak == 2
+        assert dispatcher.lane("interactive").stats["completed"] == 6
+    finally:
+        await dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_lanes_do_not_block_each_other():
+    release = asyncio.Event()
+    
+    async def handler(request_args, queue_time):
+        if request_args["lane"] == "batch":
+            await release.wait()
+        return request_args["lane"]
+    
+    dispatcher = make_dispatcher(handler)
+    await dispatcher.start()
+    try:
+        blocked = dispatcher.submit("batch", {"lane": "batch"})
+        assert await asyncio.wait_for(dispatcher.submit("interactive", {"lane": "interactive"}), 1) == "interactive"
+        assert not blocked.done()
+        release.set()
+        assert await blocked == "batch"
+    finally:
+        await dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_unknown_lane_uses_default_and_full_queue_rejects():
+    async def handler(request_args, queue_time):
+        return None
+    
+    dispatcher = make_dispatcher(handler, queue_size=1)
+    
+    # 调度器未启动，请求只入队
+    dispatcher.submit("unknown", {})
+    assert dispatcher.lane("interactive").queue.qsize() == 1
+    with pytest.raises(asyncio.QueueFull):
+        dispatcher.submit("interactive", {})
+    assert dispatcher.lane("interactive").stats["rejected"] == 1
+
+
+@pytest.mark.asyncio
+async def test_abandoned_request_is_skipped_and_errors_propagate():
+    calls = []
+    
+    async def handler(request_args, queue_time):
+        calls.append(request_args["n"])
+        if request_args["n"] == 2:
+            raise ValueError("upstream error")
+        return request_args["n"]
+    
+    dispatcher = make_dispatcher(handler)
+    abandoned = dispatcher.submit("interactive", {"n": 1})
+    abandoned.cancel()
+    failing = dispatcher.submit("interactive", {"n": 2})
+    
+    await dispatcher.start()
+    try:
+        with pytest.raises(ValueError):
+            await failing
+        assert calls == [2]
+        lane = dispatcher.lane("interactive")
+        assert lane.stats["abandoned"] == 1
+        assert lane.stats["failed"] == 1
+    finally:
+        await dispatcher.stop()
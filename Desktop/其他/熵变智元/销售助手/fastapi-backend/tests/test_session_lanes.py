@@ -0,0 +1,100 @@
+"""
+会话分片执行器测试
+"""
+
+import asyncio
+
+import pytest
+
+from app.services.session_lanes import LaneQueue, SessionLaneExecutor
+
+
+@pytest.mark.asyncio
+async def test_lane_queue_orders_by_priority():
+    queue = LaneQueue()
+    queue.put("a", {"id": 1}, priority=1)
+    queue.put("b", {"id": 2}, priority=5)
+    queue.put("c", {"id": 3}, priority=3)
+    
+    order = [(await queue.get())[0]["id"] for _ in range(3)]
+    
+    assert order == [2, 3, 1]
+
+
+@pytest.mark.asyncio
+async def test_lane_queue_keeps_order_within_key():
+    queue = LaneQueue()
+    queue.put("s1", {"id": 1}, priority=0)
+    queue.put("s1", {"id": 2}, priority=9)
+    queue.put("s2", {"id": 3}, priority=5)
+    
+    # 高优先级消息带着同会话更早的消息先出队
+    order = [(await queue.get())[0]["id"] for _ in range(3)]
+    
+    assert order == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_lane_queue_aging_promotes_waiting_items():
+    queue = LaneQueue(aging_rate=1000.0)
+    queue.put("old", {"id": 1}, priority=0)
+    await asyncio.sleep(0.02)
+    queue.put("new", {"id": 2}, priority=5)
+    
+    item, _, _ = await queue.get()
+    
+    assert item["id"] == 1
+
+
+@pytest.mark.asyncio
+async def test_executor_runs_session_in_order_and_lanes_in_parallel():
+    executor = SessionLaneExecutor(4, name="test")
+    processed = []
+    release = asyncio.Event()
+    
+    async def handler(item):
+        if item["id"] == "slow":
+            await release.wait()
+        processed.append(item["id"])
+    
+    executor.start(handler)
+    try:
+        blocked_key = "s1"
+        other_key = next(f"s{n}" for n in range(2, 100) if executor.lane_for(f"s{n}") != executor.lane_for(blocked_key))
+        
+        await executor.submit(blocked_key, {"id": "slow"})
+        await executor.submit(blocked_key, {"id": "after-slow"})
+        await executor.submit(other_key, {"id": "other"})
+        
+        await asyncio.sleep(0.05)
+        assert processed == ["other"]
+        
+        release.set()
+        await asyncio.sleep(0.05)
+        assert processed == ["other", "slow", "after-slow"]
+    finally:
+        await executor.stop()
+
+
+@pytest.mark.asyncio
+async def test_submit_waits_when_full():
+    executor = SessionLaneExecutor(1, name="test", max_size=1)
+    await executor.submit("s1", {"id": 1})
+    
+    waiting = asyncio.create_task(executor.submit("s1", {"id": 2}))
+    await asyncio.sleep(0.02)
+    assert not waiting.done()
+    assert executor.full_waits == 1
+    
+    processed = []
+    
+    async def handler(item):
+        processed.append(item["id"])
+    
+    executor.start(handler)
+    try:
+        await asyncio.wait_for(waiting, 1)
+        await asyncio.sleep(0.02)
+        assert processed == [1, 2]
+    finally:
+        await executor.stop()
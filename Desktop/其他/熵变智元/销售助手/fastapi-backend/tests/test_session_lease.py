@@ -0,0 +1,66 @@
+"""
+会话处理租约测试
+"""
+
+import asyncio
+
+import pytest
+
+from app.services import session_lease as session_lease_module
+from app.services.session_lease import SessionLeaseManager
+
+
+@pytest.fixture
+def lease_manager(stream_redis, monkeypatch):
+    monkeypatch.setattr(session_lease_module, "redis_client", stream_redis)
+    manager = SessionLeaseManager()
+    manager.enabled = True
+    manager.lease_ms = 300
+    manager.poll_interval = 0.01
+    manager.renew_interval = 0.05
+    return manager
+
+
+@pytest.mark.asyncio
+async def test_second_holder_waits_until_release(lease_manager):
+    order = []
+    
+    first = await lease_manager.acquire("s1")
+    waiter = asyncio.create_task(lease_manager.acquire("s1"))
+    
+    await asyncio.sleep(0.05)
+    assert not waiter.done()
+    
+    order.append("first")
+    await lease_manager.release("s1", first)
+    second = await asyncio.wait_for(waiter, 1)
+    order.append("second")
+    
+    assert second != first
+    assert order == ["first", "second"]
+    assert lease_manager.stats["waits"] == 1
+    await lease_manager.release("s1", second)
+
+
+@pytest.mark.asyncio
+async def test_held_lease_is_renewed(lease_manager, stream_redis):
+    await lease_manager.start()
+    try:
+        token = await lease_manager.acquire("s1")
+        # 超过租约时长后仍由本进程持有
+        await asyncio.sleep(0.5)
+        assert await stream_redis.get(lease_manager._key("s1")) == token
+        await lease_manager.release("s1", token)
+        assert await stream_redis.get(lease_manager._key("s1")) is None
+    finally:
+        await lease_manager.stop()
+
+
+@pytest.mark.asyncio
+async def test_release_does_not_delete_other_holders_lease(lease_manager, stream_redis):
+    token = await lease_manager.acquire("s1")
+    # 租约过期后被其他worker获取
+    await stream_redis.set(lease_manager._key("s1"), "other")
+    
+    await lease_manager.release("s1", token)
+    assert await stream_redis.get(lease_manager._key("s1")) == "other"
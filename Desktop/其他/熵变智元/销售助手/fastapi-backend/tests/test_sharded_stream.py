@@ -0,0 +1,110 @@
+"""
+分片消息流测试
+"""
+
+import asyncio
+
+import pytest
+
+from app.services.message_stream import ShardedMessageStream
+
+
+def make_sharded(worker_id: str, shards: int = 4) -> ShardedMessageStream:
+    stream = ShardedMessageStream("test:sharded", shards, auto_ack=False)
+    stream.worker_id = worker_id
+    stream.lease_ms = 300
+    stream.rebalance_interval = 0.05
+    for shard in stream.shards:
+        shard.consumer_name = worker_id
+        shard.block_ms = 10
+        shard.reclaim_idle_ms = 200
+        shard.reclaim_interval = 0.05
+        shard.heartbeat_interval = 0.05
+    return stream
+
+
+async def wait_until(predicate, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("条件未在超时内满足")
+        await asyncio.sleep(0.01)
+
+
+def test_same_routing_key_maps_to_same_shard(stream_redis):
+    first = make_sharded("worker-1", shards=8)
+    second = make_sharded("worker-2", shards=8)
+    
+    for session_id in ("s1", "s2", "session-42"):
+        assert first.shard_for(session_id) == second.shard_for(session_id)
+
+
+@pytest.mark.asyncio
+async def test_single_worker_owns_all_shards_and_acks(stream_redis):
+    stream = make_sharded("worker-1")
+    received = []
+    
+    async def handler(payload, entry_id):
+        received.append((payload["message_id"], entry_id))
+        await stream.ack(entry_id)
+    
+    await stream.start(handler)
+    try:
+        assert stream.get_stats()["owned_shards"] == [0, 1, 2, 3]
+        
+        entry_id = await stream.publish({"message_id": "m1"}, routing_key="s1")
+        assert entry_id.startswith(f"{stream.shard_for('s1')}:")
+        
+        await wait_until(lambda: len(received) == 1)
+        assert received == [("m1", entry_id)]
+        await wait_until(lambda: not stream_redis.pending)
+    finally:
+        await stream.stop()
+
+
+@pytest.mark.asyncio
+async def test_workers_split_shards_and_session_goes_to_one_worker(stream_redis):
+    first = make_sharded("worker-1")
+    second = make_sharded("worker-2")
+    received = {"worker-1": [], "worker-2": []}
+    
+    def make_handler(stream):
+        async def handler(payload, entry_id):
+            received[stream.worker_id].append(payload["message_id"])
+            await stream.ack(entry_id)
+        return handler
+    
+    await first.start(make_handler(first))
+    await second.start(make_handler(second))
+    try:
+        # 第二个worker加入后，第一个worker让出超出份额的分片
+        await wait_until(lambda: len(first._owned) == 2 and len(second._owned) == 2)
+        assert first._owned.isdisjoint(second._owned)
+        
+        for index in range(5):
+            await first.publish({"message_id": f"m{index}"}, routing_key="s1")
+        
+        await wait_until(lambda: len(received["worker-1"]) + len(received["worker-2"]) == 5)
+        owner = "worker-1" if first.shard_for("s1") in first._owned else "worker-2"
+        assert received[owner] == [f"m{index}" for index in range(5)]
+    finally:
+        await first.stop()
+        await second.stop()
+
+
+@pytest.mark.asyncio
+async def test_lost_lease_stops_shard_consumer(stream_redis):
+    stream = make_sharded("worker-1", shards=2)
+    
+    async def handler(payload, entry_id):
+        pass
+    
+    await stream.start(handler)
+    try:
+        # 租约被其他worker接管
+        await stream_redis.set(stream._lease_key(1), "worker-2")
+        await wait_until(lambda: 1 not in stream._owned)
+        assert not stream.shards[1].is_running
+        assert stream.stats["shards_lost"] == 1
+    finally:
+        await stream.stop()
@@ -0,0 +1,62 @@
+"""
+Token估算测试
+"""
+
+from app.services.token_estimator import TokenEstimator
+
+
+def make_estimator() -> TokenEstimator:
+    estimator = TokenEstimator()
+    estimator.cjk_ratio = 1.0
+    estimator.chars_per_token = 4.0
+    estimator.cache_min_chars = 8
+    estimator.cache_max_chars = 1000
+    estimator.cache_size = 2
+    return estimator
+
+
+def test_count_by_character_class():
+    estimator = make_estimator()
+    
+    assert estimator.count("") == 0
+    assert estimator.count("你好") == 2
+    assert estimator.count("hi there") == 2
+    # 长单词按平均字母数拆分
+    assert estimator.count("internationalization") == 5
+    # 长数字按3位一组，标点各算一个
+    assert estimator.count("1234567") == 3
+    assert estimator.count("你好, hi!") == 5
+
+
+def test_estimate_matches_count_and_uses_cache():
+    estimator = make_estimator()
+    text = "这个产品多少钱 how much"
+    
+    assert estimator.estimate(text) == estimator.count(text)
+    assert estimator.estimate(text) == estimator.count(text)
+    assert estimator.stats["cache_hits"] == 1
+
+
+def test_multiline_text_counts_newlines():
+    estimator = make_estimator()
+    lines = ["第一行内容比较长一些", "second line here"]
+    
+    expected = sum(estimator.count(line) for line in lines) + 1
+    assert estimator.estimate("\n".join(lines)) == expected
+
+
+def test_cache_is_bounded():
+    estimator = make_estimator()
+    for text in ("第一条足够长的文本", "第二条足够长的文本", "第三条足够长的文本"):
+        estimator.estimate(text)
+    
+    assert len(estimator._cache) == 2
+    assert estimator.stats["cache_evictions"] == 1
+
+
+def test_estimate_messages_adds_overhead():
+    estimator = make_estimator()
+    estimator.message_overhead = 4
+    messages = [{"content": "你好"}, {"content": None}]
+    
+    assert estimator.estimate_messages(messages) == 2 + 4 * 2